@@ -0,0 +1,244 @@
+# ------------------------------------------------------------------
+# Контроль допуска к проверке сообщений: лимиты и очередь
+# ------------------------------------------------------------------
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import Counter, Gauge, Histogram
+
+ADMISSION_REJECTED = Counter(
+    'fishchat_admission_rejected_total',
+    'Запросы, отклонённые контролем допуска',
+    ['reason'],
+)
+ADMISSION_ACTIVE = Gauge(
+    'fishchat_admission_active',
+    'Запросы, допущенные к модели',
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'fishchat_admission_queue_depth',
+    'Запросы в очереди ожидания допуска',
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'fishchat_admission_wait_seconds',
+    'Время ожидания в очереди допуска',
+)
+
+# Настройки по умолчанию; частота — запросов в минуту
+DEFAULT_LIMITS = {
+    'user_rate': 6.0,
+    'user_burst': 3,
+    'group_rate': 60.0,
+    'group_burst': 20,
+    'max_concurrency': 4,
+    'max_queue': 16,
+    'queue_timeout': 30.0,
+}
+
+# Нижние границы; остальные лимиты — не меньше нуля
+MIN_LIMITS = {
+    'user_burst': 1,
+    'group_burst': 1,
+    'max_concurrency': 1,
+}
+
+# Сколько корзин хранить до очистки простаивающих
+MAX_BUCKETS = 4096
+
+
+class InvalidLimit(ValueError):
+    pass
+
+
+def parse_limits(values):
+    """Привести лимиты к их типам; InvalidLimit, если хоть одно значение неверно"""
+    parsed = {}
+    for name, value in values.items():
+        if name not in DEFAULT_LIMITS:
+            raise InvalidLimit(f'Неизвестный лимит {name}')
+        kind = type(DEFAULT_LIMITS[name])
+        try:
+            parsed[name] = kind(value)
+        except (TypeError, ValueError):
+            expected = 'целое число' if kind is int else 'число'
+            raise InvalidLimit(f'{name}: ожидается {expected}, получено {value!r}') from None
+        if not parsed[name] >= MIN_LIMITS.get(name, 0):
+            raise InvalidLimit(f'{name}: значение меньше {MIN_LIMITS.get(name, 0)}')
+    return parsed
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.configure(rate_per_minute, burst)
+
+    def configure(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.burst = float(burst)
+        self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self, now):
+        # now может быть взят чуть раньше создания корзины: время назад не идёт
+        if now <= self.updated:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Списать токен; вернуть 0 или число секунд до следующего токена"""
+        now = now or time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class AdmissionController:
+    def __init__(self, shared=None, **limits):
+        self.limits = dict(DEFAULT_LIMITS)
+        for name, default in DEFAULT_LIMITS.items():
+            env_value = os.environ.get('ADMISSION_' + name.upper())
+            if env_value is not None:
+                self.limits[name] = type(default)(env_value)
+        self.limits.update(limits)
+
+        # Общее хранилище узлов (shared.RedisBackend): лимиты частоты на все узлы сразу.
+        # Параллельность и очередь остаются на узле
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._buckets = {}
+        self._active = 0
+        self._waiting = 0
+
+    def update(self, **limits):
+        """Изменить лимиты на лету (из консоли администратора): все сразу или ни одного"""
+        limits = parse_limits(limits)
+        with self._lock:
+            self.limits.update(limits)
+            for (kind, _), bucket in self._buckets.items():
+                bucket.configure(self.limits[kind + '_rate'], self.limits[kind + '_burst'])
+            self._slot_freed.notify_all()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'limits': dict(self.limits),
+                'active': self._active,
+                'waiting': self._waiting,
+                'buckets': 'shared' if self.shared is not None else len(self._buckets),
+            }
+
+    def _bucket(self, kind, key):
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                now = time.monotonic()
+                for k in [k for k, b in self._buckets.items() if b.idle(now)]:
+                    del self._buckets[k]
+            bucket = self._buckets[(kind, key)] = TokenBucket(
+                self.limits[kind + '_rate'], self.limits[kind + '_burst']
+            )
+        return bucket
+
+    def _take_tokens(self, user_key, group_keys):
+        taken = []
+        now = time.monotonic()
+        for kind, key in [('user', user_key)] + [('group', g) for g in group_keys]:
+            rate, burst = self.limits[kind + '_rate'], self.limits[kind + '_burst']
+            if self.shared is not None:
+                shared_key = f'admission:{kind}:{key}'
+                wait = self.shared.take_token(shared_key, rate, burst)
+                refund = lambda k=shared_key, b=burst: self.shared.refund_token(k, b)
+            else:
+                bucket = self._bucket(kind, key)
+                wait = bucket.take(now)
+                refund = bucket.refund
+            if wait:
+                # Возвращаем уже списанные токены, чтобы отказ ничего не стоил
+                for give_back in taken:
+                    give_back()
+                ADMISSION_REJECTED.inc(reason=kind + '_rate')
+                raise AdmissionRejected(kind + '_rate', wait)
+            taken.append(refund)
+        return taken
+
+    def _wait_for_slot(self, retry_after):
+        """Дождаться свободного места под self._lock или выбросить AdmissionRejected"""
+        if self._active < self.limits['max_concurrency']:
+            return
+        if self._waiting >= self.limits['max_queue']:
+            ADMISSION_REJECTED.inc(reason='queue_full')
+            raise AdmissionRejected('queue_full', retry_after or 1)
+
+        self._waiting += 1
+        ADMISSION_QUEUE_DEPTH.inc()
+        started = time.monotonic()
+        deadline = started + self.limits['queue_timeout']
+        try:
+            while self._active >= self.limits['max_concurrency']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    ADMISSION_REJECTED.inc(reason='queue_timeout')
+                    raise AdmissionRejected('queue_timeout', retry_after or 1)
+                self._slot_freed.wait(remaining)
+        finally:
+            self._waiting -= 1
+            ADMISSION_QUEUE_DEPTH.dec()
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+
+    @contextmanager
+    def admit(self, user_key, group_keys=(), retry_after=None):
+        """Допустить запрос к модели или выбросить AdmissionRejected"""
+        taken = []
+        if self.shared is not None:
+            # Сетевой вызов к общему хранилищу — вне блокировки узла
+            taken = self._take_tokens(user_key, group_keys)
+        try:
+            with self._lock:
+                if self.shared is None:
+                    taken = self._take_tokens(user_key, group_keys)
+                try:
+                    self._wait_for_slot(retry_after)
+                except AdmissionRejected:
+                    # Отказ очереди тоже ничего не стоит: токены корзин узла возвращаются под блокировкой
+                    if self.shared is None:
+                        for give_back in taken:
+                            give_back()
+                    raise
+                self._active += 1
+                ADMISSION_ACTIVE.inc()
+        except AdmissionRejected:
+            if self.shared is not None:
+                for give_back in taken:
+                    give_back()
+            raise
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                ADMISSION_ACTIVE.dec()
+                self._slot_freed.notify()
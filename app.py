@@ -1,35 +1,93 @@
 ﻿from pathlib import Path
+from types import SimpleNamespace
 from pyexpat.errors import messages
 from unittest import case
 from functools import wraps
 from flask import (
     Flask, render_template, request,
     redirect, url_for, session, flash, jsonify,
-    Response
+    Response, abort, send_file
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import login_user, UserMixin, LoginManager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Float, Text, cast, func, literal, literal_column, select, text, union, union_all
+import itertools
 import json
+import os
 import random
 import logging
+import uuid
+
+from applog import setup_logging
+from admission import AdmissionController, AdmissionRejected, DEFAULT_LIMITS, InvalidLimit, parse_limits
+from checker import Checker, LLM_PHASE_SECONDS
+from metrics import render_all
+from querylog import query_budget
+from storage import use_replica
+import archive
+import bitsets
+import dedup
+import exports
+import imports
+import ledger
+import memprof
+import monitoring
+import pagination
+import profiling
+import querylog
+import rescoring
+import sampling
+import search
+import shared
+import storage
+import tenants
 # ------------------------------------------------------------------
 # Инициализация приложения, БД и менаджера авторизации
 # ------------------------------------------------------------------
+setup_logging()
+log = logging.getLogger('fishchat.app')
+
 BASE_DIR = Path(__file__).parent.resolve()
 app = Flask(__name__)
-app.secret_key = 'super_secret_key'
+# Все узлы одной установки должны использовать один SECRET_KEY
+app.secret_key = os.environ.get('SECRET_KEY', 'super_secret_key')
 DB_PATH = BASE_DIR.joinpath("app.db")
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH.absolute()}'
+# DATABASE_URL: другой SQLite-файл (генератор данных, бенчмарки) или PostgreSQL; пул — DB_POOL_*
+app.config['SQLALCHEMY_DATABASE_URI'] = storage.database_url(f'sqlite:///{DB_PATH.absolute()}')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-print(app.config['SQLALCHEMY_DATABASE_URI'])
+# Реплика для тяжёлых чтений аналитики (DATABASE_REPLICA_URL или SQLITE_READ_POOL=1)
+REPLICA_URL = storage.replica_url(app.config['SQLALCHEMY_DATABASE_URI'])
+if REPLICA_URL:
+    app.config['SQLALCHEMY_BINDS'] = {
+        storage.REPLICA_BIND: dict(storage.engine_options(REPLICA_URL), url=REPLICA_URL)
+    }
+# В тестах превышение бюджета SQL-запросов маршрута — ошибка, а не предупреждение
+app.config['QUERY_BUDGET_STRICT'] = os.environ.get('QUERY_BUDGET_STRICT') == '1'
 
-db = SQLAlchemy(app)
-logging.basicConfig(level=logging.INFO)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+db = SQLAlchemy(app, session_options={'class_': storage.RoutingSession})
+# WAL и PRAGMA для SQLite (SQLITE_*), периодическая контрольная точка (SQLITE_MAINTENANCE_*)
+sqlite_maintenance = storage.init_app(app, db)
+# Несколько школ (TENANTS_FILE): база школы выбирается по хосту или при входе
+tenant_registry = tenants.init_app(app, db)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
+monitoring.init_app(app)
+querylog.init_app(app)
+
+# Общее состояние узлов (SHARED_STATE_URL): сессии, кэши, лимиты, шина инвалидации
+shared_state = shared.backend_from_url(os.environ.get('SHARED_STATE_URL'))
+invalidation_bus = shared.InvalidationBus(shared_state)
+# SESSION_STORE=server: сессия в общем хранилище, в cookie — только её подписанный идентификатор
+if os.environ.get('SESSION_STORE') == 'server':
+    app.session_interface = shared.SharedSessionInterface(shared_state)
+
+# Клиент модели для проверки сообщений (настройки из переменных окружения)
+model = Checker(shared=shared_state if shared_state.shared else None)
+# Лимиты частоты и очередь к модели (меняются в /cons/limits)
+admission = AdmissionController(shared=shared_state if shared_state.shared else None)
 # ------------------------------------------------------------------
 # Модель: сообщение + правильный ответ + комментарии
 # ------------------------------------------------------------------
@@ -47,6 +105,46 @@ class Message(db.Model):
     def __repr__(self):
         return f'<Message {self.id}>'
 
+    @staticmethod
+    def by_ids(ids):
+        """Сообщения в порядке ids из банка вопросов (удалённые пропускаются)"""
+        if not ids:
+            return []
+        bank = question_bank.get()
+        return [bank[mid] for mid in ids if mid in bank]
+
+
+class MessageBand(db.Model):
+    """Полоса подписи MinHash сообщения для поиска почти дубликатов (dedup.py)"""
+    __tablename__ = 'message_band'
+    __table_args__ = (db.Index('ix_message_band_bucket', 'band', 'bucket'),)
+
+    message_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    band = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(db.BigInteger, nullable=False)
+
+
+# Почти дубликаты в банке: предупреждение при создании и отчёт по группам
+duplicate_index = dedup.DuplicateIndex(MessageBand.__table__, Message.__table__,
+                                       threshold=float(os.environ.get('DEDUP_THRESHOLD', 0.6)))
+# Групп в отчёте о почти дубликатах на странице (самые большие)
+DUPLICATE_CLUSTERS_SHOWN = 100
+
+
+def load_question_bank():
+    """Снимок банка вопросов {id: сообщение только для чтения}; всегда из основной базы школы"""
+    rows = db.session.execute(select(Message.__table__).order_by(Message.id),
+                              bind_arguments={'bind': storage.primary_engine(db)}).mappings()
+    return {row['id']: SimpleNamespace(**row) for row in rows}
+
+
+# Банк вопросов школы в памяти узла; правки сообщений очищают его на всех узлах
+question_bank = tenants.PerTenant(lambda tenant: shared.NodeCache(
+    f'question_bank:{tenant}' if tenant else 'question_bank', load_question_bank,
+    ttl=float(os.environ.get('QUESTION_BANK_TTL', 300)), bus=invalidation_bus))
+# Случайный выбор вопросов урока по снимку банка (индекс id строится раз на снимок)
+lesson_sampler = tenants.PerTenant(lambda tenant: sampling.LessonSampler(question_bank.get))
+
 # ------------------------------------------------------------------
 # Модель: пользователь + пароль + ID
 # ------------------------------------------------------------------
@@ -56,7 +154,8 @@ class User(db.Model, UserMixin):
     id =  db.Column(db.Integer, primary_key=True)
 
     username = db.Column(db.String(64), unique=True, nullable=False)
-    password_hash = db.Column(db.String(64), nullable=False)
+    # Хеши werkzeug (scrypt) длиннее 64 символов; SQLite длину не проверяет, PostgreSQL — проверяет
+    password_hash = db.Column(db.String(256), nullable=False)
 
     privileges = db.Column(db.Integer, default = 0)
 
@@ -145,7 +244,7 @@ class Group(db.Model):
     def save(self):
         db.session.add(self)
         db.session.commit()
-        print(f"Группа '{self.groupname}' создана с ID: {self.id}")
+        log.info("Группа '%s' создана с ID: %s", self.groupname, self.id)
 
 # ------------------------------------------------------------------
 # Модель: урок + участники + задания
@@ -174,17 +273,22 @@ class Lesson(db.Model):
     def set_time(self, time):
         self.time = time
 
-    def add_questions(self,  questions_id: list[int] = None, rand=True):
-        if questions_id is None:
-            all_messages = Message.query.all()
-            shuffled_ids = [m.id for m in all_messages]
-            random.shuffle(shuffled_ids)
-            questions_id = shuffled_ids[:self.count_questions]
+    def add_questions(self,  questions_id: list[int] = None, rand=True,
+                      fake_share=None, exclude=(), seed=None):
+        """Вопросы урока: выбранные id или случайные count_questions из банка
 
-        if rand:
+        Для случайного набора возвращает sampling.Sample (seed, число фейков).
+        """
+        sample = None
+        if questions_id is None:
+            sample = lesson_sampler.sample(self.count_questions, fake_share=fake_share,
+                                           exclude=exclude, seed=seed)
+            questions_id = sample.ids
+        elif rand:
             random.shuffle(questions_id)
 
         self.questions = questions_id
+        return sample
 
     def set_expirience(self, expirience_yes = 1, expirience_no = -1):
         self.price_correct = expirience_yes
@@ -193,7 +297,7 @@ class Lesson(db.Model):
     def save(self):
         db.session.add(self)
         db.session.commit()
-        print(f"Урок '{self.name}' создан с ID: {self.id}")
+        log.info("Урок '%s' создан с ID: %s", self.name, self.id)
 
 # ------------------------------------------------------------------
 # Группа/класс: пользователи + ID
@@ -226,13 +330,36 @@ class Testing(db.Model):
     def save(self):
         db.session.add(self)
         db.session.commit()
-        print(f"Тестирование '{self.name}' создан с ID: {self.id}")
+        log.info("Тестирование '%s' создано с ID: %s", self.name, self.id)
+
+# ------------------------------------------------------------------
+# Модель: раскладка вопросов для компактной записи ответов (bitsets.py)
+# ------------------------------------------------------------------
+class ResultLayout(db.Model):
+    """Упорядоченный список вопросов, по которому записаны маски ответов результатов"""
+    __tablename__ = 'result_layout'
+
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.LargeBinary(16), unique=True, nullable=False)
+    questions = db.Column(db.JSON, nullable=False)
+
+
+# Раскладки школы в памяти узла: записанная раскладка не меняется
+result_layouts = tenants.PerTenant(lambda tenant: bitsets.LayoutStore(ResultLayout.__table__))
+# Запись ответов новых результатов: json — списки id, bitset — маски по раскладке
+RESULT_ANSWERS = os.environ.get('RESULT_ANSWERS', 'json')
 
 # ------------------------------------------------------------------
 # Модель: результаты тестирования
 # ------------------------------------------------------------------
 class Result(db.Model):
     __tablename__ = 'Results'
+    # Результаты участников группы (исключение уже виденных вопросов при сборке урока),
+    # результаты урока (пересчёт после правки ключа ответов или цен)
+    # и результаты тестирования (отчёты, перенос в архив)
+    __table_args__ = (db.Index('ix_results_user_id', 'user_id'),
+                      db.Index('ix_results_lesson_id', 'lesson_id'),
+                      db.Index('ix_results_testing_id', 'testing_id'))
     id = db.Column(db.Integer, primary_key=True)
     testing_id = db.Column(db.Integer, nullable=False)
     lesson_id = db.Column(db.Integer, nullable=False)
@@ -240,6 +367,11 @@ class Result(db.Model):
     score = db.Column(db.Integer, nullable=False)
     correct_answers_id = db.Column(db.JSON, nullable=False)
     wrong_answers_id = db.Column(db.JSON, nullable=False)
+    # Ответы масками по раскладке layout_id; списки выше у таких результатов пустые
+    layout_id = db.Column(db.Integer, nullable=True)
+    answers = db.Column(db.LargeBinary, nullable=True)
+    # Время сохранения (UTC) для срока хранения до архива; у результатов до появления столбца — NULL
+    created_at = db.Column(db.DateTime, nullable=True, default=func.current_timestamp())
 
     def __repr__(self):
         return f'<Result {self.id}>'
@@ -252,14 +384,258 @@ class Result(db.Model):
         self.correct_answers_id = correct_answers_id
         self.wrong_answers_id = wrong_answers_id
 
+    @classmethod
+    def from_archive(cls, row):
+        """Результат из сегмента архива — только для чтения, в сессию не добавляется"""
+        result = cls(row['testing_id'], row['lesson_id'], row['user_id'], row['score'],
+                     row['correct_answers_id'], row['wrong_answers_id'])
+        result.id = row['id']
+        result.layout_id = row.get('layout_id')
+        result.answers = row.get('answers')
+        result.created_at = row.get('created_at')
+        return result
+
+    def set_answers(self, questions, correct_ids, wrong_ids):
+        """Записать ответы в формате RESULT_ANSWERS; questions — вопросы урока по порядку"""
+        if RESULT_ANSWERS == 'bitset':
+            self.layout_id = result_layouts.ensure(db.session, questions)
+            self.answers = bitsets.pack(questions, correct_ids, wrong_ids)
+            correct_ids, wrong_ids = [], []
+        else:
+            self.layout_id = self.answers = None
+        self.correct_answers_id = correct_ids
+        self.wrong_answers_id = wrong_ids
+
+    def answer_lists(self):
+        """(id правильных, id неправильных) при любой записи ответов"""
+        if self.answers is None:
+            return self.correct_answers_id or [], self.wrong_answers_id or []
+        questions = result_layouts.questions(storage.primary_engine(db), self.layout_id)
+        return bitsets.unpack(questions, self.answers)
+
+    def answer_counts(self):
+        """(правильных, неправильных); маски не распаковываются"""
+        if self.answers is None:
+            return len(self.correct_answers_id or []), len(self.wrong_answers_id or [])
+        return bitsets.counts(self.answers)
+
+    @property
+    def correct_ids(self):
+        return self.answer_lists()[0]
+
+    @property
+    def wrong_ids(self):
+        return self.answer_lists()[1]
+
+    @property
+    def correct_count(self):
+        return self.answer_counts()[0]
+
+    @property
+    def wrong_count(self):
+        return self.answer_counts()[1]
+
+
+# ------------------------------------------------------------------
+# Модель: архив результатов закрытых тестирований (archive.py)
+# ------------------------------------------------------------------
+class ResultSegment(db.Model):
+    """Сжатые результаты одного тестирования, перенесённые из Results"""
+    __tablename__ = 'result_archive'
+
+    id = db.Column(db.Integer, primary_key=True)
+    testing_id = db.Column(db.Integer, unique=True, nullable=False)
+    results = db.Column(db.Integer, nullable=False)
+    raw_size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, server_default=func.current_timestamp())
+
+
+class ResultSummary(db.Model):
+    """Итоги архивных результатов участника в тестировании"""
+    __tablename__ = 'result_summary'
+    __table_args__ = (db.Index('ix_result_summary_user_id', 'user_id'),)
+
+    testing_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    results = db.Column(db.Integer, nullable=False)
+    score_sum = db.Column(db.Integer, nullable=False)
+    score_min = db.Column(db.Integer, nullable=False)
+    score_max = db.Column(db.Integer, nullable=False)
+    correct = db.Column(db.Integer, nullable=False)
+    wrong = db.Column(db.Integer, nullable=False)
+    # id сообщений, на которые участник отвечал; NULL — сводка записана до появления столбца
+    seen = db.Column(db.JSON, nullable=True)
+
+
+# Архив школы; распакованные сегменты (ARCHIVE_CACHE_SEGMENTS) — в памяти узла
+results_archive = tenants.PerTenant(lambda tenant: archive.ResultArchive(
+    Result.__table__, ResultSegment.__table__, ResultSummary.__table__, Testing.__table__,
+    result_layouts, lambda: storage.primary_engine(db),
+    cache_size=int(os.environ.get('ARCHIVE_CACHE_SEGMENTS', 8))))
+# Срок хранения результатов закрытого тестирования в рабочей таблице, дней
+RESULT_RETENTION_DAYS = float(os.environ.get('RESULT_RETENTION_DAYS', 180))
+
+
+def testing_with_segment(testing_id):
+    """(тестирование, сегмент его архива (id, data) или None) одним запросом; 404, если тестирования нет"""
+    row = db.session.execute(
+        select(Testing, ResultSegment.id, ResultSegment.data)
+        .outerjoin(ResultSegment, ResultSegment.testing_id == Testing.id)
+        .where(Testing.id == testing_id)).first()
+    if row is None:
+        abort(404)
+    test, segment_id, data = row
+    return test, (SimpleNamespace(id=segment_id, data=data) if segment_id is not None else None)
+
+
+def archived_results(rows, user_ids=None):
+    """Архивные строки результатов (ResultArchive) как объекты Result (только для чтения)"""
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        rows = [row for row in rows if row['user_id'] in user_ids]
+    return [Result.from_archive(row) for row in rows]
+
+
+def find_result(testing_id, user_id):
+    """Результат пользователя в тестировании из рабочей таблицы или архива; 404, если его нет"""
+    result = Result.query.filter_by(testing_id=testing_id, user_id=user_id).first()
+    if result is None:
+        result = next(iter(archived_results(results_archive.testing_rows(db.session, testing_id), [user_id])), None)
+    if result is None:
+        abort(404)
+    return result
+
+
+# Пересчёт баллов при исправлении типа ответа сообщения или цен урока
+rescorer = rescoring.Rescorer(Result.__table__, Lesson.__table__, result_layouts,
+                              lambda: storage.primary_engine(db), archive=results_archive)
+
+# ------------------------------------------------------------------
+# Модель: журнал опыта и итоги пользователей (ledger.py)
+# ------------------------------------------------------------------
+class XpEvent(db.Model):
+    """Начисление опыта; строки журнала не меняются и не удаляются"""
+    __tablename__ = 'xp_event'
+    __table_args__ = (db.Index('ix_xp_event_user_id', 'user_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    # train, test, rescore или backfill (ledger.SOURCES)
+    source = db.Column(db.String(16), nullable=False)
+    result_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.current_timestamp())
+
+
+class XpTotal(db.Model):
+    """Опыт пользователя — сумма его событий, обновляется вместе с каждым событием"""
+    __tablename__ = 'xp_total'
+    __table_args__ = (db.Index('ix_xp_total_rank', 'total', 'user_id'),)
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    events = db.Column(db.Integer, nullable=False, default=0)
+
+
+xp_ledger = ledger.Ledger(XpEvent.__table__, XpTotal.__table__)
+
+
+def load_leaderboard():
+    """[(id пользователя, опыт)] по убыванию опыта; всегда из основной базы школы"""
+    return db.session.execute(select(XpTotal.user_id, XpTotal.total)
+                              .join(User, User.id == XpTotal.user_id)
+                              .order_by(XpTotal.total.desc()),
+                              bind_arguments={'bind': storage.primary_engine(db)}).all()
+
+
+# Рейтинг школы в памяти узла: свои начисления сразу, чужие — через LEADERBOARD_TTL
+leaderboard = tenants.PerTenant(lambda tenant: ledger.Leaderboard(
+    f'leaderboard:{tenant}' if tenant else 'leaderboard', load_leaderboard,
+    ttl=float(os.environ.get('LEADERBOARD_TTL', 60)), bus=invalidation_bus))
+# Мест в общем рейтинге и в рейтингах групп на главной странице
+LEADERBOARD_SIZE = 10
+GROUP_LEADERBOARD_SIZE = 5
+
+
+def record_xp(entries):
+    """Записать события опыта [(id пользователя, опыт, источник, id результата)] и зафиксировать сессию"""
+    totals = xp_ledger.record(db.session, entries)
+    db.session.commit()
+    leaderboard.update(totals)
+
+
+def rescore_with_xp(rescore, subject_id):
+    """Пересчёт rescore (метод rescorer); опыт участников меняется на разницу баллов
+
+    События журнала пишутся в транзакции каждой порции пересчёта: баллы
+    результатов и итоги опыта фиксируются вместе.
+    """
+    totals = {}
+
+    def on_batch(db_session, changes):
+        totals.update(xp_ledger.record(db_session, [(user_id, new - old, 'rescore', result_id)
+                                                    for result_id, user_id, old, new in changes]))
+
+    try:
+        report = rescore(db.session, subject_id, on_batch=on_batch)
+    except Exception:
+        # Часть порций могла зафиксироваться: рейтинг прочитается заново
+        leaderboard.invalidate()
+        raise
+    leaderboard.update(totals)
+    return report
 
 # ------------------------------------------------------------------
 # Создаём таблицы (первый запуск)
 # ------------------------------------------------------------------
 with app.app_context():
     db.create_all()
+    storage.ensure_columns(db.engine, db.metadata)
+    storage.ensure_indexes(db.engine, db.metadata)
+    # Индекс поиска по банку вопросов (FTS5 / GIN); базы школ — при подключении
+    search.ensure_index(db.engine)
+    # Полосы MinHash для сообщений, добавленных в обход панели управления
+    if duplicate_index.refresh(db.session):
+        db.session.commit()
+    # Баллы результатов, сохранённых до появления журнала опыта
+    if xp_ledger.backfill(db.session, Result.__table__):
+        db.session.commit()
 
 
+# ------------------------------------------------------------------
+# Метрики и проверка готовности
+# ------------------------------------------------------------------
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', 15))
+
+def probe_database():
+    with app.app_context():
+        db.session.execute(text('SELECT 1'))
+        db.session.remove()
+
+def probe_llm():
+    model.client.with_options(timeout=5).models.list()
+
+health_probes = {
+    'database': monitoring.CachedProbe(probe_database, HEALTH_CACHE_SECONDS),
+    'llm': monitoring.CachedProbe(probe_llm, HEALTH_CACHE_SECONDS),
+}
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_all(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/health')
+def health():
+    # База обязательна; без модели приложение работает частично (кроме /check).
+    # ?strict=1 требует доступности обеих зависимостей
+    checks = {name: probe() for name, probe in health_probes.items()}
+    required = checks if request.args.get('strict') else {'database': checks['database']}
+    ready = all(c['ok'] for c in required.values())
+    status = 'ok' if all(c['ok'] for c in checks.values()) else ('degraded' if ready else 'fail')
+
+    return jsonify({'status': status, 'checks': checks}), 200 if ready else 503
+
 # ------------------------------------------------------------------
 # Главная страница
 # ------------------------------------------------------------------
@@ -270,7 +646,28 @@ def index():
         return render_template('index.html')
     else:
         user = User.query.filter(User.username == username).first()
-        return render_template('index.html', user=user)
+        return render_template('index.html', user=user, **leaderboards(user))
+
+
+def leaderboards(user):
+    """Общий рейтинг и рейтинги групп пользователя для главной страницы"""
+    if user is None:
+        return {}
+    overall = leaderboard.top(LEADERBOARD_SIZE)
+    groups = []
+    for group in Group.query.order_by(Group.groupname).all():
+        if group.users and user.id in group.users:
+            groups.append({'name': group.groupname,
+                           'top': leaderboard.top(GROUP_LEADERBOARD_SIZE, group.users),
+                           'rank': leaderboard.rank(user.id, group.users)})
+    # Имена одним запросом для всех показанных мест
+    shown = {user_id for _, user_id, _ in overall}
+    for board in groups:
+        shown.update(user_id for _, user_id, _ in board['top'])
+    names = dict(db.session.execute(select(User.id, User.username).where(User.id.in_(shown))).all()) \
+        if shown else {}
+    return {'leaderboard': overall, 'my_rank': leaderboard.rank(user.id),
+            'group_leaderboards': groups, 'leader_names': names}
 
 # ------------------------------------------------------------------
 # Памятка
@@ -290,6 +687,33 @@ def check_preview():
 def check():
     return render_template('check.html')
 
+def load_group_membership():
+    """{id пользователя: [id групп]} по составу всех групп школы"""
+    membership = {}
+    for group_id, users in db.session.execute(select(Group.id, Group.users)):
+        for user_id in users or ():
+            membership.setdefault(user_id, []).append(group_id)
+    return membership
+
+
+# Группы пользователей для ключей лимитов; изменения групп очищают кэш на всех узлах
+group_membership = tenants.PerTenant(lambda tenant: shared.NodeCache(
+    f'group_membership:{tenant}' if tenant else 'group_membership', load_group_membership,
+    ttl=float(os.environ.get('GROUP_MEMBERSHIP_TTL', 300)), bus=invalidation_bus))
+
+
+def admission_keys():
+    """Ключи лимитов: пользователь (или IP для гостя) и его группы"""
+    username = session.get('curent_user')
+    user = User.query.filter(User.username == username).first() if username else None
+    if not user:
+        return 'ip:' + (request.remote_addr or 'unknown'), []
+
+    # id пользователей и групп в базах разных школ совпадают
+    prefix = tenants.key_prefix()
+    group_ids = [prefix + str(group_id) for group_id in group_membership.get().get(user.id, ())]
+    return f'user:{prefix}{user.id}', group_ids
+
 @app.route('/check_massege', methods=['POST'])
 def check_massege():
     # Получаем данные из формы
@@ -297,25 +721,34 @@ def check_massege():
     
     if not msg:
         return jsonify({'error': 'Message is required'}), 400
-    
+
+    # Идентификатор трассировки: из заголовка прокси или новый
+    trace_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
     try:
-        # Получаем ответ от модели
-        resp_json = model.check_message(msg)
+        # Получаем ответ от модели, если запрос прошёл лимиты
+        user_key, group_keys = admission_keys()
+        with admission.admit(user_key, group_keys,
+                             retry_after=model.average_call_seconds()):
+            resp_json = model.check_message(msg, trace_id=trace_id)
         
         # Проверяем, что ответ не пустой
         if not resp_json:
-            return jsonify({'error': 'Empty response from model'}), 500
+            return jsonify({'error': 'Empty response from model', 'trace_id': trace_id}), 500
         
         # Парсим JSON с обработкой ошибок
-        try:
-            data = json.loads(resp_json)
-        except json.JSONDecodeError:
-            return jsonify({'error': 'Invalid JSON response from model'}), 500
+        with LLM_PHASE_SECONDS.time(phase='parse'):
+            try:
+                data = json.loads(resp_json)
+            except json.JSONDecodeError:
+                data = None
+        if data is None:
+            return jsonify({'error': 'Invalid JSON response from model', 'trace_id': trace_id}), 500
         
         # Проверяем наличие необходимых полей
         required_fields = ['text', 'status', 'certainty', 'comment']
         if not all(field in data for field in required_fields):
-            return jsonify({'error': 'Missing required fields in response'}), 500
+            return jsonify({'error': 'Missing required fields in response', 'trace_id': trace_id}), 500
         
         # Извлекаем данные
         text = data['text']
@@ -324,14 +757,27 @@ def check_massege():
         comment = data['comment']
         
         # Возвращаем шаблон
-        return render_template('check_result.html',
-                              text=text,
-                              status=status,
-                              certainty=certainty,
-                              comment=comment)
+        response = Response(render_template('check_result.html',
+                                            text=text,
+                                            status=status,
+                                            certainty=certainty,
+                                            comment=comment))
+        response.headers['X-Trace-Id'] = trace_id
+        return response
     
+    except AdmissionRejected as e:
+        response = jsonify({
+            'error': 'Too many requests',
+            'reason': e.reason,
+            'retry_after': e.retry_after,
+            'trace_id': trace_id
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return jsonify({'error': str(e), 'trace_id': trace_id}), 500
 # ------------------------------------------------------------------------
 # Тренировка
 # ------------------------------------------------------------------------
@@ -339,12 +785,29 @@ def check_massege():
 def train_preview():
     return render_template('train_preview.html')
 
+def save_training_xp():
+    """Записать в журнал опыт тренировки, ещё не записанный: experience - experience_saved"""
+    username = session.get('curent_user')
+    if not username or 'shuffled_ids' not in session:
+        return
+    experience = float(session.get('experience', 0))
+    delta = experience - float(session.get('experience_saved', 0))
+    if not delta:
+        return
+    user = User.query.filter(User.username == username).first()
+    if not user:
+        return
+    record_xp([(user.id, delta, 'train', None)])
+    session['experience_saved'] = experience
+
 @app.route('/train/<int:step>', methods=['GET', 'POST'])
+@query_budget(3)
 def train(step):
     # Получаем все сообщения один раз
-    print(f"DEBUG: Entering train(step={step})")
-    print(f"DEBUG: Session before: {dict(session)}")
-    all_messages = Message.query.all()
+    log.debug('train step=%s', step)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('train session before: %s', dict(session))
+    all_messages = list(question_bank.get().values())
     if not all_messages:
         flash('Нет сообщений в базе. Добавьте их через /admin')
         return redirect(url_for('index'))
@@ -353,6 +816,8 @@ def train(step):
     if 'shuffled_ids' not in session or step == 0:
         # При step == 0 сбрасываем сессию
         if step == 0 and request.method == "GET":
+            # Опыт прерванной тренировки остаётся пользователю
+            save_training_xp()
             username = session.get('curent_user')  # Сохраняем
             session.clear()  # Очищаем всю сессию для новой тренировки
             session['curent_user'] = username
@@ -366,12 +831,14 @@ def train(step):
         session['shuffled_ids'] = shuffled_ids
     
     # Получаем сообщения в нужном порядке
-    messages = [Message.query.get(mid) for mid in session['shuffled_ids']]
+    messages_dict = {m.id: m for m in all_messages}
+    messages = [messages_dict[mid] for mid in session['shuffled_ids'] if mid in messages_dict]
     total_messages = len(messages)
     
     # Проверяем, что запрашиваемый шаг существует
     if step >= total_messages:
         # Показываем результаты, если вышли за пределы
+        save_training_xp()
         correct_count = sum(
             1 for m in messages
             if session.get('answers', {}).get(str(m.id)) == ('yes' if m.correct else 'no')
@@ -396,7 +863,7 @@ def train(step):
         
         # Если нажали кнопку "дальше" (из состояния с ответом)
         if action == 'next':
-            print(f"DEBUG: Next button pressed, current experience: {session.get('experience')}")
+            log.debug('train next pressed, experience=%s', session.get('experience'))
             # Сбрасываем флаг ответа для следующего вопроса
             session['answered_current'] = False
             session.pop('current_answer', None)
@@ -406,7 +873,7 @@ def train(step):
             
             # Переходим к следующему шагу
             next_step = step + 1
-            print(f"DEBUG: Redirecting to step {next_step}, experience: {session.get('experience')}")
+            log.debug('train redirect to step %s, experience=%s', next_step, session.get('experience'))
             
             # Проверяем, не закончились ли сообщения
             if next_step >= total_messages:
@@ -416,6 +883,7 @@ def train(step):
         
         # Если нажали "завершить" из любого состояния
         if answer == 'finish':
+            save_training_xp()
             # Подсчитываем правильные ответы
             answers = session.get('answers', {})
             correct_count = sum(
@@ -430,6 +898,7 @@ def train(step):
                 step=step
             )
         if action == 'finish':
+            save_training_xp()
             answers = session.get('answers', {})
             correct_count = sum(
                 1 for m in messages
@@ -494,8 +963,9 @@ def train(step):
 
 @app.route('/results', methods=['GET'])
 def results():
+    save_training_xp()
     # Получаем все сообщения
-    messages = [Message.query.get(mid) for mid in session['shuffled_ids']]
+    messages = Message.by_ids(session['shuffled_ids'])
     total = len(messages)
     
     # Подсчет правильных ответов
@@ -514,7 +984,10 @@ def results():
 # Очищение опыта после тренировки
 @app.route('/reset_experience')
 def reset_experience():
+    # Сбрасывается счётчик тренировки; заработанный опыт остаётся в журнале
+    save_training_xp()
     session['experience'] = 0
+    session.pop('experience_saved', None)
     return redirect(url_for('index'))
 # -----------------------------------------------------------
 # Авторизация: создание пользователей и вход
@@ -594,7 +1067,7 @@ def register():
     db.session.commit()
 
     user_id = user.id
-    print(f"Создан пользователь: {username}, ID: {user_id}")
+    log.info('Создан пользователь: %s, ID: %s', username, user_id)
 
     # УДАЛЯЕМ старую группу и создаем новую
     Group.query.filter_by(groupname='new').delete()
@@ -607,9 +1080,10 @@ def register():
     group.users = all_user_ids  # Все обычные пользователи
     db.session.add(group)
     db.session.commit()
+    group_membership.invalidate()
 
-    print(f"✅ Группа 'new' пересоздана с {len(all_user_ids)} пользователями")
-    print(f"Список: {all_user_ids}")
+    log.info("Группа 'new' пересоздана с %d пользователями", len(all_user_ids))
+    log.debug('Список: %s', all_user_ids)
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({
@@ -642,8 +1116,7 @@ def check_privileges():
             session.get('curent_user')
         )
     ).first()
-    print("DEBUD: curent user-teacher is",curent_user)
-    print("DEBUG: curent user-teacher privileges -",curent_user.is_admin)
+    log.debug('check_privileges user=%s', curent_user)
 
     if not curent_user or not curent_user.is_admin:
         return False
@@ -657,8 +1130,7 @@ def check_admin():
             session.get('curent_user')
         )
     ).first()
-    print("DEBUD: curent user-admin is", curent_user)
-    print("DEBUG: curent user-admin privileges -", curent_user.is_admin)
+    log.debug('check_admin user=%s', curent_user)
 
     if not curent_user or curent_user.role_name != 'admin':
         return False
@@ -671,8 +1143,7 @@ def check_user_id(usr_id: int):
             session.get('curent_user')
         )
     ).first()
-    print("DEBUD: curent user-teacher is", curent_user)
-    print("DEBUG: curent user-teacher privileges -", curent_user.is_admin)
+    log.debug('check_user_id user=%s', curent_user)
 
     if not curent_user or curent_user.id != usr_id:
         return False
@@ -698,6 +1169,166 @@ def dashboard_instruction():
         return redirect(url_for('ErAuth'))
 
     return render_template(mgn + 'dashboard_instruction.html')
+# ---------------------------------------------------------
+# Списки панели управления: страницы по ключу, сортировка, фильтры
+# ---------------------------------------------------------
+def _int_filter(column):
+    """Равенство целому значению; нечисловой ввод фильтр не включает"""
+    def build(value):
+        try:
+            return column == int(value)
+        except ValueError:
+            return None
+    return build
+
+
+def _ids_filter(column, exclude=False):
+    """id через запятую: «выбранные» / «не выбранные» в форме выбора"""
+    def build(value):
+        ids = [int(v) for v in value.split(',') if v.strip().isdigit()]
+        if exclude:
+            return column.notin_(ids) if ids else None
+        return column.in_(ids)
+    return build
+
+
+def _name_filter(column, model, name_column):
+    """column ссылается на model.id; фильтр по подстроке названия (урок, тестирование)"""
+    return lambda value: column.in_(select(model.id).where(name_column.ilike(f'%{value}%')))
+
+
+MESSAGE_LIST = pagination.ListSpec(
+    Message,
+    sorts={'id': Message.id},
+    filters={
+        'id': _int_filter(Message.id),
+        'kind': lambda value: {'fake': Message.correct.is_(True),
+                               'real': Message.correct.is_(False)}.get(value),
+        'only': _ids_filter(Message.id),
+        'exclude': _ids_filter(Message.id, exclude=True),
+    },
+    search=(Message.text,),
+    serialize=lambda m: {'id': m.id, 'text': m.text, 'correct': m.correct,
+                         'price_correct': m.price_correct, 'price_wrong': m.price_wrong},
+)
+
+USER_LIST = pagination.ListSpec(
+    User,
+    sorts={'id': User.id, 'username': User.username},
+    filters={
+        'id': _int_filter(User.id),
+        'role': lambda value: User.privileges == int(value) if value in ('0', '1', '2') else None,
+        'only': _ids_filter(User.id),
+        'exclude': _ids_filter(User.id, exclude=True),
+    },
+    search=(User.username,),
+    serialize=lambda u: {'id': u.id, 'username': u.username, 'role': u.role_name},
+)
+
+LESSON_LIST = pagination.ListSpec(
+    Lesson,
+    sorts={'id': Lesson.id, 'name': Lesson.name},
+    filters={'id': _int_filter(Lesson.id)},
+    search=(Lesson.name,),
+    serialize=lambda l: {'id': l.id, 'name': l.name, 'time': l.time, 'questions': l.questions,
+                         'price_correct': l.price_correct, 'price_wrong': l.price_wrong},
+)
+
+GROUP_LIST = pagination.ListSpec(
+    Group,
+    sorts={'id': Group.id, 'groupname': Group.groupname},
+    filters={'id': _int_filter(Group.id)},
+    search=(Group.groupname,),
+    serialize=lambda g: {'id': g.id, 'groupname': g.groupname, 'users': g.users},
+)
+
+TESTING_LIST = pagination.ListSpec(
+    Testing,
+    sorts={'id': Testing.id, 'name': Testing.name},
+    filters={
+        'id': _int_filter(Testing.id),
+        'status': lambda value: {'active': Testing.status.is_(True),
+                                 'archived': Testing.status.is_(False)}.get(value),
+        'lesson': _name_filter(Testing.lesson_id, Lesson, Lesson.name),
+    },
+    search=(Testing.name,),
+    serialize=lambda t: {'id': t.id, 'name': t.name, 'status': t.status,
+                         'lesson_id': t.lesson_id, 'group_id': t.group_id},
+)
+
+# История результатов: свежие попытки первыми
+HISTORY_LIST = pagination.ListSpec(
+    Result,
+    sorts={'id': Result.id, 'score': Result.score},
+    default_order='desc',
+    filters={
+        'id': _int_filter(Result.id),
+        'testing': _name_filter(Result.testing_id, Testing, Testing.name),
+        'lesson': _name_filter(Result.lesson_id, Lesson, Lesson.name),
+    },
+    serialize=lambda r: {'id': r.id, 'testing_id': r.testing_id, 'lesson_id': r.lesson_id,
+                         'score': r.score, 'correct': r.correct_count, 'wrong': r.wrong_count},
+)
+
+# Имя списка: (описание, базовые условия, доступ, строки для форм выбора: (шаблон, переменная))
+LIST_APIS = {
+    'messages': (MESSAGE_LIST, (), 'teacher', ('_message_pick_rows.html', 'messages')),
+    'students': (USER_LIST, (User.privileges == 0,), 'teacher', ('_user_pick_rows.html', 'users')),
+    'users': (USER_LIST, (), 'admin', None),
+    'lessons': (LESSON_LIST, (), 'teacher', None),
+    'groups': (GROUP_LIST, (), 'teacher', None),
+    'testings': (TESTING_LIST, (), 'teacher', None),
+    'history': (HISTORY_LIST, None, 'user', None),
+}
+
+
+@app.route('/dashboard/lists/<name>')
+@query_budget(2)
+def list_api(name):
+    """Страница списка в JSON: ?cursor=&limit=&sort=&order=&q=&<фильтры>
+
+    view=rows — готовые строки таблицы для форм выбора (дозагрузка
+    «Показать ещё» и фильтры без перезагрузки страницы).
+    """
+    if name not in LIST_APIS:
+        abort(404)
+    spec, base, access, rows = LIST_APIS[name]
+
+    if access == 'user':
+        curent_user = User.query.filter(User.username.ilike(session.get('curent_user'))).first()
+        if not curent_user:
+            return jsonify({'error': 'Login required'}), 401
+        base = (Result.user_id == curent_user.id,)
+    elif not (check_admin() if access == 'admin' else check_privileges()):
+        return jsonify({'error': 'Access denied'}), 403
+
+    page = spec.page(db.session, request.args, base)
+    if request.args.get('view') == 'rows' and rows:
+        template, variable = rows
+        html = render_template(mgn + template, **{variable: page.items},
+                               selected=(), filtered=bool(page.filters))
+        return jsonify({'html': html, 'next_cursor': page.next_cursor})
+    return jsonify(spec.to_json(page))
+
+
+@app.route('/dashboard/search/messages')
+@query_budget(3)
+def search_messages():
+    """Поиск по банку вопросов: ?q=&cursor=&limit=&kind=&id=&only=&exclude=, по релевантности
+
+    view=rows — строки формы выбора сообщений с подсвеченными фрагментами.
+    """
+    if not check_privileges():
+        return jsonify({'error': 'Access denied'}), 403
+
+    page = search.search_messages(db.session, storage.primary_engine(db), request.args)
+    if request.args.get('view') == 'rows':
+        html = render_template(mgn + '_message_pick_rows.html', messages=page.items,
+                               snippets=page.snippets, selected=(), filtered=True)
+        return jsonify({'html': html, 'next_cursor': page.next_cursor})
+    return jsonify(search.to_json(page))
+
+
 # ---------------------------------------------------------
 # Панель управления БД
 # ---------------------------------------------------------
@@ -733,6 +1364,8 @@ def DB_msg_create():
     price_correct = float(request.form.get('price_correct', 0))
     price_wrong = float(request.form.get('price_wrong', 0))
 
+    similar = duplicate_index.similar(db.session, text, limit=5)
+
     msg = Message(
         text=text,
         correct=correct,
@@ -742,17 +1375,60 @@ def DB_msg_create():
         price_wrong=price_wrong
     )
     db.session.add(msg)
+    db.session.flush()
+    duplicate_index.index(db.session, msg.id, msg.text)
     db.session.commit()
-    flash('Сообщение добавлено')
+    question_bank.invalidate()
+    if similar:
+        found = ', '.join(f'#{mid} ({score:.0%})' for score, mid, _ in similar)
+        flash(f'Сообщение добавлено. Похожие сообщения уже есть в банке: {found}')
+    else:
+        flash('Сообщение добавлено')
     return redirect(url_for('DB_msg_create'))
 
+
+@app.route('/dashboard/DB_management/DB_msg_similar', methods=['POST'])
+@query_budget(3)
+def DB_msg_similar():
+    """Почти дубликаты текста из формы сообщения: {"items": [{id, text, similarity}]}"""
+    if not check_privileges():
+        return jsonify({'error': 'Access denied'}), 403
+
+    exclude = request.form.get('exclude', type=int)
+    similar = duplicate_index.similar(db.session, request.form.get('text', ''), exclude=exclude, limit=5)
+    return jsonify({'items': [{'id': mid, 'text': text, 'similarity': round(score, 3)}
+                              for score, mid, text in similar]})
+
+
+@app.route('/dashboard/DB_management/DB_msg_duplicates')
+def DB_msg_duplicates():
+    """Отчёт: группы почти дубликатов во всём банке, от больших к маленьким"""
+    if not check_privileges():
+        return redirect(url_for('ErAuth'))
+
+    if duplicate_index.refresh(db.session):
+        db.session.commit()
+    clusters = duplicate_index.clusters(db.session)
+    shown = clusters[:DUPLICATE_CLUSTERS_SHOWN]
+    ids = [mid for cluster in shown for mid in cluster]
+    messages = {m.id: m for m in db.session.execute(
+        select(Message.id, Message.text, Message.correct).where(Message.id.in_(ids))).all()} if ids else {}
+    return render_template(mgn + 'DB_msg_duplicates.html',
+                           clusters=[[messages[mid] for mid in cluster if mid in messages] for cluster in shown],
+                           total_clusters=len(clusters),
+                           total_duplicates=sum(len(cluster) - 1 for cluster in clusters),
+                           threshold=duplicate_index.threshold)
+
 @app.route('/dashboard/DB_management/DB_msg_list')
 def DB_msg_list():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    messages = Message.query.order_by(Message.id).all()
-    return render_template(mgn + 'DB_msg_list.html', messages=messages)
+    page = MESSAGE_LIST.page(db.session, request.args)
+    # Счётчики по всему банку, а не по странице: фейк — correct = True
+    counts = dict(db.session.execute(select(Message.correct, func.count()).group_by(Message.correct)).all())
+    return render_template(mgn + 'DB_msg_list.html', messages=page.items, page=page,
+                           fake_count=counts.get(True, 0), real_count=counts.get(False, 0))
 
 @app.route('/dashboard/DB_msg_list/DB_msg_delete/<int:msg_id>', methods=['POST'])
 def DB_msg_delete(msg_id):
@@ -761,10 +1437,15 @@ def DB_msg_delete(msg_id):
 
     msg = Message.query.get_or_404(msg_id)
     db.session.delete(msg)
+    duplicate_index.remove(db.session, msg_id)
     db.session.commit()
+    question_bank.invalidate()
     flash(f'Сообщение "{msg_id}" удалено')
 
-    return redirect(url_for('dashboard/DB_msg_list'))
+    # Удаление из отчёта о похожих сообщениях возвращает к отчёту
+    if request.args.get('back') == 'duplicates':
+        return redirect(url_for('DB_msg_duplicates'))
+    return redirect(url_for('DB_msg_list'))
 
 @app.route('/dashboard/DB_msg_edit/<int:msg_id>', methods=['GET', 'POST'])
 def DB_msg_edit(msg_id):
@@ -774,17 +1455,27 @@ def DB_msg_edit(msg_id):
     msg = Message.query.get_or_404(msg_id)
 
     if request.method == 'GET':
-        return render_template(mgn + 'DB_msg_edit.html', message=msg)
+        lessons, answered = rescorer.message_preview(db.session, msg_id)
+        return render_template(mgn + 'DB_msg_edit.html', message=msg,
+                               rescore_lessons=lessons, rescore_results=answered)
 
+    key_changed = msg.correct != (request.form['correct'] == 'yes')
     msg.text = request.form['text']
     msg.correct = request.form['correct'] == 'yes'
     msg.comment_yes = request.form['comment_yes']
     msg.comment_no = request.form['comment_no']
     msg.price_correct = float(request.form.get('price_correct', 0))
     msg.price_wrong = float(request.form.get('price_wrong', 0))
+    duplicate_index.index(db.session, msg.id, msg.text)
     db.session.commit()
-    flash('Сообщение обновлено')
-    return redirect(url_for('dashboard/DB_management/DB_msg_list'))
+    question_bank.invalidate()
+    if key_changed:
+        # Ответы на сообщение в прошлых результатах оценены по старому ключу
+        report = rescore_with_xp(rescorer.rescore_message, msg_id)
+        flash(f'Сообщение обновлено; пересчитано результатов: {report.changed}')
+    else:
+        flash('Сообщение обновлено')
+    return redirect(url_for('DB_msg_list'))
 
 # ---------------------------------------------------------
 # Панель управления Уроками
@@ -794,10 +1485,13 @@ def lesson_create():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    messages = Message.query.order_by(Message.id).all()
     lesson_names = [l.name for l in Lesson.query.order_by(Lesson.name).all()]
     if request.method == 'GET':
-        return render_template(mgn + 'lesson_create.html', messages=messages, lesson_names=lesson_names)
+        # Первая страница банка; остальные подгружаются из /dashboard/lists/messages
+        page = MESSAGE_LIST.page(db.session, {})
+        groups = db.session.execute(select(Group.id, Group.groupname).order_by(Group.groupname)).all()
+        return render_template(mgn + 'lesson_create.html', messages=page.items, page=page,
+                               lesson_names=lesson_names, groups=groups)
 
     lesson_name = request.form.get('lesson_name')
     time = request.form.get('time', 0)
@@ -818,19 +1512,66 @@ def lesson_create():
         lesson.add_questions(selected_ids)
     else:
         lesson.set_count_questions(int(msg_count))
-        lesson.add_questions()
+        try:
+            fake_share = request.form.get('fake_share', '').strip()
+            fake_share = float(fake_share) / 100 if fake_share else None
+            seed = request.form.get('seed', '').strip()
+            seed = int(seed) if seed else None
+        except ValueError:
+            flash('Доля фейков и seed должны быть числами')
+            return redirect(url_for('lesson_create'))
+        exclude_group = request.form.get('exclude_group', type=int)
+        exclude = seen_by_group(exclude_group) if exclude_group else ()
+        try:
+            sample = lesson.add_questions(fake_share=fake_share, exclude=exclude, seed=seed)
+        except sampling.SampleError as e:
+            flash(str(e))
+            return redirect(url_for('lesson_create'))
+        if not sample.ids:
+            flash('В банке нет подходящих сообщений: урок не создан')
+            return redirect(url_for('lesson_create'))
+        note = (f'Урок создан: {len(sample.ids)} сообщений '
+                f'(фейков {sample.fakes}, реальных {sample.reals}), seed {sample.seed}')
+        if sample.short:
+            note += f' — подходящих сообщений меньше, чем запрошено ({sample.requested})'
+        flash(note)
 
     lesson.save()
 
     return redirect(url_for('testing_management'))
 
+
+def seen_by_group(group_id):
+    """id сообщений, на которые участники группы уже отвечали в прошлых результатах, включая архив"""
+    users = db.session.execute(select(Group.users).where(Group.id == group_id)).scalar()
+    if not users:
+        return set()
+    seen = set()
+    # Только ответы, по индексу ix_results_user_id
+    rows = db.session.execute(select(Result.correct_answers_id, Result.wrong_answers_id,
+                                     Result.layout_id, Result.answers)
+                              .where(Result.user_id.in_(users))).all()
+    engine = storage.primary_engine(db)
+    result_layouts.preload(engine, {row.layout_id for row in rows})
+    for correct_ids, wrong_ids, layout_id, answers in rows:
+        if answers is not None:
+            correct_ids, wrong_ids = bitsets.unpack(result_layouts.questions(engine, layout_id), answers)
+        seen.update(correct_ids or ())
+        seen.update(wrong_ids or ())
+    return seen | results_archive.seen(db.session, users)
+
 @app.route('/dashboard/testing_management/lesson_list')
 def lesson_list():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    lessons = Lesson.query.order_by(Lesson.id).all()
-    return render_template(mgn + 'lesson_list.html', lessons=lessons)
+    page = LESSON_LIST.page(db.session, request.args)
+    # Статистика по всем урокам, а не только по странице
+    total, questions = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(func.json_array_length(Lesson.questions)), 0))
+    ).one()
+    return render_template(mgn + 'lesson_list.html', lessons=page.items, page=page,
+                           total_lessons=total, total_questions=questions)
 
 @app.route('/dashboard/lesson_list/lesson_edit/<int:less_id>', methods=['GET', 'POST'])
 def lesson_edit(less_id):
@@ -838,11 +1579,13 @@ def lesson_edit(less_id):
         return redirect(url_for('ErAuth'))
 
     lesson = Lesson.query.get_or_404(less_id)
-    messages = Message.query.order_by(Message.id).all()
     lesson_names = [l.name for l in Lesson.query.order_by(Lesson.name).all() if l.id != less_id]
 
     if request.method == 'GET':
-        return render_template(mgn + 'lesson_edit.html', lesson=lesson, messages=messages, lesson_names=lesson_names)
+        page = MESSAGE_LIST.page(db.session, {})
+        total_results, _ = rescorer.lesson_preview(db.session, less_id, lesson.price_correct, lesson.price_wrong)
+        return render_template(mgn + 'lesson_edit.html', lesson=lesson, messages=page.items, page=page,
+                               lesson_names=lesson_names, total_results=total_results)
 
     lesson.name = request.form.get('lesson_name')
 
@@ -852,6 +1595,7 @@ def lesson_edit(less_id):
     else:
         lesson.time = 0
 
+    old_prices = (str(lesson.price_correct), str(lesson.price_wrong))
     lesson.price_correct = request.form.get('price_correct')
     lesson.price_wrong = request.form.get('price_wrong')
 
@@ -864,8 +1608,22 @@ def lesson_edit(less_id):
 
     db.session.commit()
     #flash(f'Урок "{lesson.id}" успешно обновлен', 'success')
+    if (str(lesson.price_correct), str(lesson.price_wrong)) != old_prices:
+        # Баллы прошлых результатов посчитаны по старым ценам
+        report = rescore_with_xp(rescorer.rescore_lesson, less_id)
+        flash(f'Урок "{lesson.name}" обновлён; пересчитано результатов: {report.changed}')
     return redirect(url_for('lesson_list'))
 
+@app.route('/dashboard/lesson_list/lesson_rescore_preview/<int:less_id>', methods=['POST'])
+def lesson_rescore_preview(less_id):
+    """Сколько результатов урока изменят балл при ценах из формы"""
+    if not check_privileges():
+        return redirect(url_for('ErAuth'))
+
+    total, changed = rescorer.lesson_preview(db.session, less_id, request.form.get('price_correct'),
+                                             request.form.get('price_wrong'))
+    return jsonify({'total': total, 'changed': changed})
+
 @app.route('/dashboard/testing_management/lesson_delete/<int:less_id>', methods=['POST'])
 def lesson_delete(less_id):
     if not check_privileges():
@@ -892,10 +1650,12 @@ def group_create():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    users = [u for u in User.query.order_by(User.id).all() if u.role_name == 'user']
     group_names = [g.groupname for g in Group.query.order_by(Group.groupname).all()]
     if request.method == 'GET':
-        return render_template(mgn + 'group_create.html', users=users, group_names=group_names)
+        # Первая страница учеников; остальные подгружаются из /dashboard/lists/students
+        page = USER_LIST.page(db.session, {}, base=(User.privileges == 0,))
+        return render_template(mgn + 'group_create.html', users=page.items, page=page,
+                               group_names=group_names)
 
     group_name = request.form.get('group_name')
     users_ids = request.form.get('selected_ids')
@@ -906,6 +1666,7 @@ def group_create():
     group.add_users(users_ids)
 
     group.save()
+    group_membership.invalidate()
 
     return redirect(url_for('testing_management'))
 
@@ -914,8 +1675,12 @@ def group_list():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    groups = Group.query.order_by(Group.id).all()
-    return render_template(mgn + 'group_list.html', groups=groups)
+    page = GROUP_LIST.page(db.session, request.args)
+    total, members = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(func.json_array_length(Group.users)), 0))
+    ).one()
+    return render_template(mgn + 'group_list.html', groups=page.items, page=page,
+                           total_groups=total, total_members=members)
 
 @app.route('/dashboard/lesson_list/group_edit/<int:group_id>', methods=['GET', 'POST'])
 def group_edit(group_id):
@@ -923,11 +1688,12 @@ def group_edit(group_id):
         return redirect(url_for('ErAuth'))
 
     group = Group.query.get_or_404(group_id)
-    users = [u for u in User.query.order_by(User.id).all() if u.role_name == 'user']
     group_names = [g.groupname for g in Group.query.order_by(Group.groupname).all() if g.id != group_id]
 
     if request.method == 'GET':
-        return render_template(mgn + 'group_edit.html', group=group, users=users, group_names=group_names)
+        page = USER_LIST.page(db.session, {}, base=(User.privileges == 0,))
+        return render_template(mgn + 'group_edit.html', group=group, users=page.items, page=page,
+                               group_names=group_names)
 
     group_name = request.form.get('group_name')
     users_ids = request.form.get('selected_ids')
@@ -938,6 +1704,7 @@ def group_edit(group_id):
     group.add_users(users_ids)
 
     db.session.commit()
+    group_membership.invalidate()
 
     return redirect(url_for('group_list'))
 
@@ -950,6 +1717,7 @@ def group_delete(group_id):
     db.session.delete(group)
     flash(f"Группа '{group_id}' удалена")
     db.session.commit()
+    group_membership.invalidate()
 
     return redirect(url_for('group_list'))
 
@@ -1007,10 +1775,17 @@ def testing_list():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    testings = Testing.query.order_by(Testing.id).all()
-    lessons = Lesson.query.order_by(Lesson.id).all()
+    page = TESTING_LIST.page(db.session, request.args)
+    lesson_ids = {t.lesson_id for t in page.items}
+    lessons = Lesson.query.filter(Lesson.id.in_(lesson_ids)).all() if lesson_ids else []
     lessons_dict = {lesson.id: lesson for lesson in lessons}
-    return render_template(mgn + 'testing_list.html', testings=testings, lessons_dict=lessons_dict)
+    total, active, groups = db.session.execute(
+        select(func.count(), func.count().filter(Testing.status.is_(True)),
+               func.coalesce(func.sum(func.json_array_length(Testing.group_id)), 0))
+    ).one()
+    return render_template(mgn + 'testing_list.html', testings=page.items, page=page,
+                           lessons_dict=lessons_dict,
+                           total_testings=total, active_testings=active, total_group_links=groups)
 
 @app.route('/dashboard/testing_management/testing_list/testing_edit/<int:testing_id>', methods=['GET','POST'])
 def testing_edit(testing_id):
@@ -1066,6 +1841,7 @@ def testing_delete(testing_id):
 # Тестирование: режим
 # ---------------------------------------------------------
 @app.route('/test_room_preview')
+@query_budget(5)
 def test_room_preview():
     curent_user = User.query.filter(
         User.username.ilike(
@@ -1074,14 +1850,17 @@ def test_room_preview():
     ).first()
     testings_all = Testing.query.order_by(Testing.id).all()
     testings = list()
-    user_results = Result.query.filter_by(user_id=curent_user.id).all()
+    # Пройденные тестирования, в том числе перенесённые в архив
+    passed_ids = set(db.session.execute(union(
+        select(Result.testing_id).where(Result.user_id == curent_user.id),
+        select(ResultSummary.testing_id).where(ResultSummary.user_id == curent_user.id))).scalars())
+    groups_dict = {group.id: group for group in Group.query.all()}
     for test in testings_all:
         groups = test.group_id
         for group_id in groups:
-            group = Group.query.get_or_404(group_id)
-            users = group.users
-            user_result = [r for r in user_results if r.testing_id == test.id]
-            if curent_user.id in users and len(user_result) == 0:
+            group = groups_dict.get(group_id)
+            users = group.users if group else []
+            if curent_user.id in users and test.id not in passed_ids:
                 testings.append(test)
     lessons = Lesson.query.order_by(Lesson.id).all()
     lessons_dict = {lesson.id: lesson for lesson in lessons}
@@ -1098,7 +1877,7 @@ def test_room_memo():
 
 def save_test_result(session):
     if session.get('result_saved_to_db'):
-        print("DEBUG: Результат уже сохранен в БД ранее")
+        log.debug('Результат уже сохранен в БД ранее')
         return
 
     testing_id = session.get('testing', {}).get('id')
@@ -1109,15 +1888,15 @@ def save_test_result(session):
     answers = session.get('answers', {})
 
     if not testing_id or not username or not messages_id:
-        print("DEBUG: Недостаточно данных для сохранения")
+        log.debug('Недостаточно данных для сохранения')
         return
 
     user = User.query.filter(User.username == username).first()
     if not user:
-        print("DEBUG: Пользователь не найден")
+        log.debug('Пользователь не найден: %s', username)
         return
 
-    messages = [Message.query.get(mid) for mid in messages_id]
+    messages = Message.by_ids(messages_id)
 
     correct_ids = []
     wrong_ids = []
@@ -1131,8 +1910,8 @@ def save_test_result(session):
             else:
                 wrong_ids.append(m.id)
 
-    print(f"DEBUG: Сохраняем результат в БД - user_id={user.id}, score={experience}")
-    print(f"DEBUG: correct_ids={correct_ids}, wrong_ids={wrong_ids}")
+    log.debug('Сохраняем результат в БД: user_id=%s score=%s correct_ids=%s wrong_ids=%s',
+              user.id, experience, correct_ids, wrong_ids)
 
     try:
         result = Result(
@@ -1143,15 +1922,19 @@ def save_test_result(session):
             correct_answers_id=correct_ids,
             wrong_answers_id=wrong_ids
         )
+        result.set_answers(messages_id, correct_ids, wrong_ids)
         db.session.add(result)
-        db.session.commit()
-        print("DEBUG: Результат успешно сохранен в БД")
+        db.session.flush()
+        # Балл тестирования — опыт участника, в одной транзакции с результатом
+        record_xp([(user.id, experience, 'test', result.id)])
+        log.info('Результат сохранен: testing_id=%s user_id=%s score=%s',
+                 testing_id, user.id, experience)
 
         session['result_saved_to_db'] = True
 
     except Exception as e:
         db.session.rollback()
-        print(f"DEBUG: Ошибка сохранения в БД: {e}")
+        log.exception('Ошибка сохранения результата в БД')
 
 
 def show_test_results(session, messages):
@@ -1171,6 +1954,7 @@ def show_test_results(session, messages):
     return redirect(url_for('test_room_result'))
 
 @app.route('/test_room/<int:test>/<int:step>', methods=['GET', 'POST'])
+@query_budget(6)
 def test_room(test, step):
 
     if 'testing' not in session or step == 0:
@@ -1179,6 +1963,7 @@ def test_room(test, step):
         ).first()
 
         if step == 0 or request.method == 'GET':
+            save_training_xp()
             username = session.get('curent_user')
             session.clear()
             session['curent_user'] = username
@@ -1204,7 +1989,7 @@ def test_room(test, step):
         session['messages_id'] = messages_id
 
     messages_id = session['messages_id']
-    messages = [Message.query.get(m) for m in messages_id]
+    messages = Message.by_ids(messages_id)
     total_messages = len(messages)
 
     if step >= total_messages:
@@ -1228,7 +2013,7 @@ def test_room(test, step):
             session.pop('current_is_correct', None)
 
             next_step = step + 1
-            print(f"DEBUG: Redirecting to step {next_step}, experience: {session.get('experience')}")
+            log.debug('test_room redirect to step %s, experience=%s', next_step, session.get('experience'))
 
             if next_step >= total_messages:
                 return show_test_results(session, messages)
@@ -1288,7 +2073,7 @@ def test_room_result():
             correct_count=0,
         )
 
-    messages = [Message.query.get(mid) for mid in messages_id]
+    messages = Message.by_ids(messages_id)
     total = len(messages)
 
     price_correct = lesson_data.get('price_correct', 1)
@@ -1311,9 +2096,9 @@ def test_room_result():
 
     session_experience = session.get('experience', 0)
 
-    print(f"DEBUG: Опыт из сессии: {session_experience}, Рассчитанный: {calculated_experience}")
-    print(f"DEBUG: price_correct={price_correct}, price_wrong={price_wrong}")
-    print(f"DEBUG: Правильных: {correct_count}, Неправильных: {wrong_count}")
+    log.debug('test_room_result experience session=%s calculated=%s price_correct=%s '
+              'price_wrong=%s correct=%s wrong=%s', session_experience, calculated_experience,
+              price_correct, price_wrong, correct_count, wrong_count)
 
     final_experience = calculated_experience
 
@@ -1346,6 +2131,7 @@ def clear_test_results():
 # Результаты тестирований
 # ---------------------------------------------------------
 @app.route('/dashboard/testing_management/result_list')
+@use_replica
 def result_list():
     if not check_privileges():
         return redirect(url_for('ErAuth'))
@@ -1357,16 +2143,11 @@ def result_list():
     lessons_dict = {lesson.id: lesson for lesson in lessons}
     groups_dict = {group.id: group for group in groups}
 
-    all_results = Result.query.all()
-
-    test_completed_users = {}
-    for result in all_results:
-        test_id = result.testing_id
-        user_id = result.user_id
-
-        if test_id not in test_completed_users:
-            test_completed_users[test_id] = set()
-        test_completed_users[test_id].add(user_id)
+    # Прошедшие тестирование — по рабочим результатам и сводке архива, без загрузки строк
+    passed = union(select(Result.testing_id, Result.user_id),
+                   select(ResultSummary.testing_id, ResultSummary.user_id)).subquery()
+    completed_users = dict(db.session.execute(
+        select(passed.c.testing_id, func.count()).group_by(passed.c.testing_id)).all())
 
     for test in testings:
         total_users = 0
@@ -1384,7 +2165,7 @@ def result_list():
 
             total_users = len(all_users_id)
 
-        completed_count = len(test_completed_users.get(test.id, set()))
+        completed_count = completed_users.get(test.id, 0)
 
         test.total_users = total_users
         test.completed_count = completed_count
@@ -1412,12 +2193,14 @@ def result_testing():
 
 
 @app.route('/dashboard/testing_management/results_detailed/<int:testing_id>')
+@use_replica
+@query_budget(6)
 def results_detailed(testing_id):
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    test = Testing.query.get_or_404(testing_id)
-    results = Result.query.filter_by(testing_id=testing_id).all()
+    test, segment = testing_with_segment(testing_id)
+    results = Result.query.filter_by(testing_id=testing_id).all() + archived_results(results_archive.unpack(segment))
     groups = Group.query.filter(Group.id.in_(test.group_id)).all() if test.group_id else []
 
     user_to_groups = {}
@@ -1435,8 +2218,7 @@ def results_detailed(testing_id):
             scores = []
 
             for result in group_results:
-                correct = len(result.correct_answers_id)
-                wrong = len(result.wrong_answers_id)
+                correct, wrong = result.answer_counts()
                 total_questions = (correct + wrong)
                 total_correct = correct
                 scores.append(result.score)
@@ -1456,12 +2238,16 @@ def results_detailed(testing_id):
                 'total_correct': total_correct
             })
 
+    users_dict = {}
+    if results:
+        result_user_ids = {r.user_id for r in results}
+        users_dict = {u.id: u for u in User.query.filter(User.id.in_(result_user_ids)).all()}
+
     users_data = []
     for result in results:
-        user = User.query.get(result.user_id)
+        user = users_dict.get(result.user_id)
         if user:
-            correct = len(result.correct_answers_id)
-            wrong = len(result.wrong_answers_id)
+            correct, wrong = result.answer_counts()
             total = correct + wrong
 
             user_groups = user_to_groups.get(user.id, [])
@@ -1500,29 +2286,41 @@ def results_detailed(testing_id):
 
 
 @app.route('/dashboard/testing_management/group_results/<int:testing_id>/<int:group_id>')
+@use_replica
+@query_budget(9)
 def group_results(testing_id, group_id):
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
-    test = Testing.query.get_or_404(testing_id)
+    test, segment = testing_with_segment(testing_id)
     group = Group.query.get_or_404(group_id)
     lesson = Lesson.query.get_or_404(test.lesson_id)
 
     group_user_ids = group.users or []
 
     # Результаты пользователей группы
-    results = Result.query.filter_by(testing_id=testing_id).all()
-
-    # Фильтруем результаты по пользователям группы
-    group_results = [r for r in results if r.user_id in group_user_ids]
+    group_results = Result.query.filter(
+        Result.testing_id == testing_id,
+        Result.user_id.in_(group_user_ids)
+    ).all() + archived_results(results_archive.unpack(segment), group_user_ids) if group_user_ids else []
+
+    # Пользователи и ошибочные вопросы загружаем одним запросом каждые
+    users_dict = {}
+    if group_results:
+        users_dict = {u.id: u for u in User.query.filter(
+            User.id.in_({r.user_id for r in group_results})
+        ).all()}
+
+    result_layouts.preload(storage.primary_engine(db), {r.layout_id for r in group_results})
+    wrong_ids = {wrong_id for r in group_results for wrong_id in r.wrong_ids}
+    wrong_messages = {m.id: m for m in Message.by_ids(list(wrong_ids))}
 
     # Собираем статистику пользователей
     users_data = []
     for result in group_results:
-        user = User.query.get(result.user_id)
+        user = users_dict.get(result.user_id)
         if user:
-            correct = len(result.correct_answers_id)
-            wrong = len(result.wrong_answers_id)
+            correct, wrong = result.answer_counts()
             total = correct + wrong
 
             users_data.append({
@@ -1546,8 +2344,8 @@ def group_results(testing_id, group_id):
 
     # Собираем все ошибки
     for result in group_results:
-        for wrong_id in result.wrong_answers_id:
-            message = Message.query.get(wrong_id)
+        for wrong_id in result.wrong_ids:
+            message = wrong_messages.get(wrong_id)
             if message:
                 if wrong_id not in all_errors_dict:
                     all_errors_dict[wrong_id] = {
@@ -1557,7 +2355,7 @@ def group_results(testing_id, group_id):
                     }
                 all_errors_dict[wrong_id]['count'] += 1
                 all_errors_dict[wrong_id]['users'].append(
-                    User.query.get(result.user_id)
+                    users_dict.get(result.user_id)
                 )
 
     # Разделяем на общие и индивидуальные ошибки
@@ -1581,8 +2379,8 @@ def group_results(testing_id, group_id):
             })
 
     # Общая статистика группы
-    total_questions_all = sum([len(r.correct_answers_id) + len(r.wrong_answers_id) for r in group_results])
-    total_correct_all = sum([len(r.correct_answers_id) for r in group_results])
+    total_questions_all = sum([r.correct_count + r.wrong_count for r in group_results])
+    total_correct_all = sum([r.correct_count for r in group_results])
 
     group_stats = {
         'total_users': len(group_user_ids),
@@ -1590,7 +2388,7 @@ def group_results(testing_id, group_id):
         'avg_score': round(sum([r.score for r in group_results]) / len(group_results), 1) if group_results else 0,
         'total_score': sum([r.score for r in group_results]),
         'total_correct': total_correct_all,
-        'total_wrong': sum([len(r.wrong_answers_id) for r in group_results]),
+        'total_wrong': sum([r.wrong_count for r in group_results]),
         'total_questions': total_questions_all,
         'accuracy': round((total_correct_all / total_questions_all * 100) if total_questions_all > 0 else 0, 1)
     }
@@ -1607,13 +2405,14 @@ def group_results(testing_id, group_id):
                            total_questions_count=total_questions_count)
 
 @app.route('/dashboard/testing_management/user_results/<int:testing_id>/<int:user_id>')
+@use_replica
 def user_results(testing_id, user_id):
     if not check_privileges():
         return redirect(url_for('ErAuth'))
 
     test = Testing.query.get_or_404(testing_id)
     user = User.query.get_or_404(user_id)
-    result = Result.query.filter_by(testing_id=testing_id, user_id=user_id).first_or_404()
+    result = find_result(testing_id, user_id)
 
     groups = Group.query.filter(Group.id.in_(test.group_id)).all() if test.group_id else []
     user_groups = []
@@ -1624,15 +2423,9 @@ def user_results(testing_id, user_id):
 
     user_group_display = ', '.join(user_groups) if user_groups else 'Без группы'
 
-    wrong_questions = []
-    if result.wrong_answers_id:
-        for question_id in result.wrong_answers_id:
-            question = Message.query.get(question_id)
-            if question:
-                wrong_questions.append(question)
+    wrong_questions = Message.by_ids(result.wrong_ids)
 
-    correct_count = len(result.correct_answers_id)
-    wrong_count = len(result.wrong_answers_id)
+    correct_count, wrong_count = result.answer_counts()
     total_count = correct_count + wrong_count
 
     return render_template(mgn + 'user_results.html',
@@ -1658,7 +2451,32 @@ def history_result():
     if not curent_user:
         return redirect(url_for('login'))
 
-    results = Result.query.filter_by(user_id=curent_user.id).all()
+    page = HISTORY_LIST.page(db.session, request.args, base=(Result.user_id == curent_user.id,))
+    results = page.items
+    # Итоги по всей истории пользователя, а не только по странице
+    total, score, correct, wrong = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(Result.score), 0),
+               func.coalesce(func.sum(func.json_array_length(Result.correct_answers_id)), 0),
+               func.coalesce(func.sum(func.json_array_length(Result.wrong_answers_id)), 0))
+        .where(Result.user_id == curent_user.id)
+    ).one()
+    # Результаты с масками: списки у них пустые, ответы считаются по битам
+    masked_correct, masked_wrong = bitsets.totals(db.session.execute(
+        select(Result.answers).where(Result.user_id == curent_user.id, Result.answers.is_not(None))).scalars())
+    stats = {'total': total, 'score': score, 'correct': correct + sum(masked_correct),
+             'wrong': wrong + sum(masked_wrong)}
+    # Тестирования в архиве: строки не хранятся в Results, итоги — из сводки
+    archived = db.session.execute(
+        select(ResultSummary.testing_id, Testing.name, ResultSummary.results, ResultSummary.score_sum,
+               ResultSummary.score_max, ResultSummary.correct, ResultSummary.wrong)
+        .outerjoin(Testing, Testing.id == ResultSummary.testing_id)
+        .where(ResultSummary.user_id == curent_user.id)
+        .order_by(ResultSummary.testing_id.desc())).all()
+    for row in archived:
+        stats['total'] += row.results
+        stats['score'] += row.score_sum
+        stats['correct'] += row.correct
+        stats['wrong'] += row.wrong
 
     testing_ids = {r.testing_id for r in results if r.testing_id}
     lesson_ids = {r.lesson_id for r in results if r.lesson_id}
@@ -1676,6 +2494,9 @@ def history_result():
     return render_template('history_result.html',
                            user=curent_user,
                            results=results,
+                           archived=archived,
+                           page=page,
+                           stats=stats,
                            testings_dict=testings_dict,
                            lessons_dict=lessons_dict)
 
@@ -1694,7 +2515,7 @@ def user_result(testing_id, user_id):
 
     test = Testing.query.get_or_404(testing_id)
     user = User.query.get_or_404(user_id)
-    result = Result.query.filter_by(testing_id=testing_id, user_id=user_id).first_or_404()
+    result = find_result(testing_id, user_id)
     lesson = Lesson.query.get_or_404(test.lesson_id)
 
     groups = Group.query.filter(Group.id.in_(test.group_id)).all() if test.group_id else []
@@ -1706,15 +2527,9 @@ def user_result(testing_id, user_id):
 
     user_group_display = ', '.join(user_groups) if user_groups else 'Без группы'
 
-    wrong_questions = []
-    if result.wrong_answers_id:
-        for question_id in result.wrong_answers_id:
-            question = Message.query.get(question_id)
-            if question:
-                wrong_questions.append(question)
+    wrong_questions = Message.by_ids(result.wrong_ids)
 
-    correct_count = len(result.correct_answers_id)
-    wrong_count = len(result.wrong_answers_id)
+    correct_count, wrong_count = result.answer_counts()
     total_count = len(lesson.questions)
 
     return render_template(mgn + 'user_result.html',
@@ -1733,6 +2548,7 @@ def user_result(testing_id, user_id):
 # Консоль администратора
 # ---------------------------------------------------------
 @app.route('/cons')
+@use_replica
 def cons():
     if not check_admin():
         return redirect(url_for('ErAuth'))
@@ -1745,7 +2561,8 @@ def cons():
     total_groups = Group.query.count()
     total_lessons = Lesson.query.count()
     total_testings = Testing.query.count()
-    total_results = Result.query.count()
+    total_results = Result.query.count() + db.session.execute(
+        select(func.coalesce(func.sum(ResultSummary.results), 0))).scalar()
 
     # Последние N пользователей
     N = 5
@@ -1771,8 +2588,9 @@ def console_users():
     if not check_admin():
         return redirect(url_for('ErAuth'))
 
-    users = User.query.order_by(User.id).all()
-    return render_template(con + 'console_users.html', users=users)
+    page = USER_LIST.page(db.session, request.args)
+    role_counts = dict(db.session.execute(select(User.privileges, func.count()).group_by(User.privileges)).all())
+    return render_template(con + 'console_users.html', users=page.items, page=page, role_counts=role_counts)
 
 
 @app.route('/cons/users/edit/<int:user_id>', methods=['GET', 'POST'])
@@ -1823,43 +2641,153 @@ def console_user_delete(user_id):
 
     # Удаление результатов пользователя
     Result.query.filter_by(user_id=user_id).delete()
+    results_archive.delete_user(db.session, user_id)
 
     db.session.delete(user)
     db.session.commit()
+    # Опыт удалённого пользователя остаётся в журнале, но в рейтинг не входит
+    leaderboard.invalidate()
     flash(f'Пользователь {user.username} удален', 'success')
     return redirect(url_for('console_users'))
 
 
+# ---------------------------------------------------------
+# Лимиты проверки сообщений
+# ---------------------------------------------------------
+@app.route('/cons/limits', methods=['GET', 'POST'])
+def console_limits():
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    if request.method == 'POST':
+        try:
+            new_limits = parse_limits({name: request.form[name] for name in DEFAULT_LIMITS
+                                       if request.form.get(name, '').strip()})
+        except InvalidLimit as e:
+            flash(f'Лимиты не изменены: {e}', 'danger')
+            return redirect(url_for('console_limits'))
+        admission.update(**new_limits)
+        flash('Лимиты обновлены', 'success')
+        return redirect(url_for('console_limits'))
+
+    return render_template(con + 'console_limits.html', state=admission.snapshot())
+
+
+# ---------------------------------------------------------
+# Профилирование запросов (заголовок X-Profile: 1 или ?_profile=1)
+# ---------------------------------------------------------
+profile_store = profiling.ProfileStore(
+    os.environ.get('PROFILE_DIR', BASE_DIR.joinpath('profiles')),
+    keep=int(os.environ.get('PROFILE_KEEP', 50))
+)
+profiling.init_app(app, profile_store, is_allowed=lambda: check_admin())
+
+@app.route('/cons/profiles')
+def console_profiles():
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    return render_template(con + 'console_profiles.html', profiles=profile_store.list())
+
+@app.route('/cons/profiles/<profile_id>')
+def console_profile(profile_id):
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'ncalls'):
+        sort = 'cumulative'
+    try:
+        profile = profile_store.load(profile_id)
+        stats_text = profile_store.stats_text(profile_id, sort=sort)
+    except KeyError:
+        abort(404)
+
+    return render_template(con + 'console_profile.html',
+                           profile=profile,
+                           stats_text=stats_text,
+                           sort=sort)
+
+@app.route('/cons/profiles/<profile_id>/download')
+def console_profile_download(profile_id):
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    try:
+        path = profile_store.stats_path(profile_id)
+    except KeyError:
+        abort(404)
+
+    return send_file(path, as_attachment=True, download_name=f'{profile_id}.prof')
+
+
+# ---------------------------------------------------------
+# Профилирование памяти (MEMPROFILE=1 или кнопка в консоли)
+# ---------------------------------------------------------
+memory_profiler = memprof.MemoryProfiler(
+    interval=float(os.environ.get('MEMPROFILE_INTERVAL', 300)),
+    frames=int(os.environ.get('MEMPROFILE_FRAMES', 10))
+)
+memprof.init_app(app, memory_profiler)
+
+@app.route('/cons/memory', methods=['GET', 'POST'])
+def console_memory():
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'start':
+            memory_profiler.start()
+            flash('Профилирование памяти включено', 'success')
+        elif action == 'stop':
+            memory_profiler.stop()
+            flash('Профилирование памяти выключено', 'success')
+        elif action == 'snapshot':
+            memory_profiler.take_snapshot()
+            flash('Снимок памяти сохранён', 'success')
+        return redirect(url_for('console_memory'))
+
+    key_type = 'traceback' if request.args.get('group') == 'traceback' else 'lineno'
+    return render_template(con + 'console_memory.html',
+                           enabled=memory_profiler.enabled,
+                           interval=memory_profiler.interval,
+                           history=list(memory_profiler.history),
+                           report=memory_profiler.report(key_type),
+                           endpoints=memory_profiler.endpoint_report(),
+                           key_type=key_type,
+                           rss=memprof.current_rss())
+
+
 # ---------------------------------------------------------
 # Очистка истории результатов
 # ---------------------------------------------------------
 @app.route('/cons/cleanup')
+@use_replica
 def console_cleanup():
     if not check_admin():
         return redirect(url_for('ErAuth'))
 
-    total_results = Result.query.count()
+    # Результаты по парам (пользователь, тестирование): рабочие — подсчётом в базе, архивные — из сводки
+    counts = union_all(
+        select(literal(False).label('archived'), Result.user_id, Result.testing_id, func.count().label('results'))
+        .group_by(Result.user_id, Result.testing_id),
+        select(literal(True), ResultSummary.user_id, ResultSummary.testing_id, ResultSummary.results))
 
-    # Фильтр по пользователям
     results_by_user = {}
-    all_results = Result.query.all()
-
-    for result in all_results:
-        user_id = result.user_id
-        if user_id not in results_by_user:
-            results_by_user[user_id] = 0
-        results_by_user[user_id] += 1
-
-    # Фильтр по тестированиям
     results_by_testing = {}
-    for result in all_results:
-        testing_id = result.testing_id
-        if testing_id not in results_by_testing:
-            results_by_testing[testing_id] = 0
-        results_by_testing[testing_id] += 1
+    total_results = archived_results = 0
+    for is_archived, user_id, testing_id, count in db.session.execute(counts):
+        results_by_user[user_id] = results_by_user.get(user_id, 0) + count
+        results_by_testing[testing_id] = results_by_testing.get(testing_id, 0) + count
+        total_results += count
+        if is_archived:
+            archived_results += count
 
     return render_template(con + 'console_cleanup.html',
                            total_results=total_results,
+                           archived_results=archived_results,
+                           retention_days=RESULT_RETENTION_DAYS,
                            results_by_user=results_by_user,
                            results_by_testing=results_by_testing,
                            total_users=len(results_by_user),
@@ -1877,6 +2805,7 @@ def console_cleanup_execute():
     if action == 'clear_all_results':
         count = Result.query.count()
         Result.query.delete()
+        count += results_archive.delete_all(db.session)
         db.session.commit()
         flash(f'Удалено {count} результатов тестирований', 'success')
 
@@ -1886,6 +2815,7 @@ def console_cleanup_execute():
         if user_id:
             count = Result.query.filter_by(user_id=user_id).count()
             Result.query.filter_by(user_id=user_id).delete()
+            count += results_archive.delete_user(db.session, int(user_id))
             db.session.commit()
             flash(f'Удалено {count} результатов пользователя', 'success')
 
@@ -1895,9 +2825,21 @@ def console_cleanup_execute():
         if testing_id:
             count = Result.query.filter_by(testing_id=testing_id).count()
             Result.query.filter_by(testing_id=testing_id).delete()
+            count += results_archive.delete_testing(db.session, int(testing_id))
             db.session.commit()
             flash(f'Удалено {count} результатов тестирования', 'success')
 
+    elif action == 'archive_results':
+        # Перенос результатов закрытых тестирований старше срока хранения в архив
+        try:
+            days = float(request.form.get('days') or RESULT_RETENTION_DAYS)
+            report = results_archive.run(db.session, days)
+        except ValueError as e:
+            flash(f'Архивация не выполнена: {e}', 'danger')
+        else:
+            flash(f'В архив перенесено {report.results} результатов из {report.testings} тестирований '
+                  f'({report.raw_bytes // 1024} КБ → {report.stored_bytes // 1024} КБ)', 'success')
+
     return redirect(url_for('console_cleanup'))
 
 
@@ -1909,32 +2851,175 @@ def console_export():
     if not check_admin():
         return redirect(url_for('ErAuth'))
 
-    return render_template(con + 'console_export.html')
+    testings = db.session.execute(select(Testing.id, Testing.name).order_by(Testing.id.desc())).all()
+    return render_template(con + 'console_export.html', testings=testings,
+                           formats=list(exports.FORMATS), compressions=exports.COMPRESSIONS)
+
+
+ROLE_NAMES = {0: 'Пользователь', 1: 'Учитель', 2: 'Администратор'}
+
+
+def export_users(fmt, compress):
+    rows = exports.query_rows(db.session, select(User.id, User.username, User.privileges).order_by(User.id))
+    return exports.stream('users', ((uid, name, ROLE_NAMES.get(p, p)) for uid, name, p in rows),
+                          ['id', 'username', 'role'], fmt, compress, filename='users_export')
+
+
+def export_results(fmt, compress):
+    statement = (
+        select(Result.id, Result.testing_id, Testing.name, Result.lesson_id, Result.user_id, User.username,
+               Result.score, cast(Result.correct_answers_id, Text), cast(Result.wrong_answers_id, Text),
+               Result.layout_id, Result.answers)
+        .outerjoin(Testing, Testing.id == Result.testing_id)
+        .outerjoin(User, User.id == Result.user_id)
+        .order_by(Result.id)
+    )
+    name = 'results_export'
+    testing_id = request.args.get('testing_id', type=int)
+    if testing_id:
+        statement = statement.where(Result.testing_id == testing_id)
+        name = f'results_testing_{testing_id}'
+    user_id = request.args.get('user_id', type=int)
+    if user_id:
+        statement = statement.where(Result.user_id == user_id)
+        name += f'_user_{user_id}'
+    layouts, engine = result_layouts.current(), storage.primary_engine(db)
+
+    def archived_rows():
+        # Архивные результаты — порциями сегментов, раньше рабочих: их id меньше
+        testing_names = None
+        for batch in results_archive.segment_rows(db.session, testing_id or None, user_id or None):
+            if testing_names is None:
+                testing_names = dict(db.session.execute(select(Testing.id, Testing.name)).all())
+            usernames = dict(db.session.execute(select(User.id, User.username).where(
+                User.id.in_({row['user_id'] for row in batch}))).all())
+            for row in batch:
+                yield [row['id'], row['testing_id'], testing_names.get(row['testing_id']), row['lesson_id'],
+                       row['user_id'], usernames.get(row['user_id']), row['score'],
+                       json.dumps(row['correct_answers_id']), json.dumps(row['wrong_answers_id']),
+                       row.get('layout_id'), row.get('answers')]
+
+    def rows():
+        # Ответы масками выгружаются теми же списками id, что и в записи JSON
+        for *row, layout_id, answers in itertools.chain(archived_rows(),
+                                                        exports.query_rows(db.session, statement)):
+            if answers is not None:
+                correct_ids, wrong_ids = bitsets.unpack(layouts.questions(engine, layout_id), answers)
+                row[-2:] = json.dumps(correct_ids), json.dumps(wrong_ids)
+            yield row
+
+    return exports.stream('results', rows(),
+                          ['id', 'testing_id', 'testing', 'lesson_id', 'user_id', 'username',
+                           'score', 'correct_answers_id', 'wrong_answers_id'],
+                          fmt, compress, filename=name, raw_json=('correct_answers_id', 'wrong_answers_id'))
+
+
+def export_messages(fmt, compress):
+    statement = select(Message.id, Message.text, Message.correct, Message.price_correct, Message.price_wrong,
+                       Message.comment_yes, Message.comment_no).order_by(Message.id)
+    return exports.stream('messages', exports.query_rows(db.session, statement),
+                          ['id', 'text', 'correct', 'price_correct', 'price_wrong', 'comment_yes', 'comment_no'],
+                          fmt, compress, filename='messages_export')
+
+
+EXPORTS = {
+    'users': export_users,
+    'results': export_results,
+    'messages': export_messages,
+}
+
+
+# Администратор, страница сегментов архива, рабочие строки; при непустом
+# архиве — ещё названия тестирований и имена пользователей порции
+# (каждая следующая порция из SEGMENT_BATCH сегментов — ещё два запроса)
+@app.route('/cons/export/<kind>')
+@use_replica
+@query_budget(5)
+def export_data(kind):
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+    if kind not in EXPORTS:
+        abort(404)
+    try:
+        fmt, compress = exports.parse_options(request.args)
+    except exports.ExportError as e:
+        abort(400, str(e))
+    return EXPORTS[kind](fmt, compress)
+
+
+@app.route('/cons/import/messages', methods=['POST'])
+def import_messages():
+    """Импорт банка вопросов из файла экспорта (CSV, JSONL, msgpack; .zst — сжатый)"""
+    if not check_admin():
+        return redirect(url_for('ErAuth'))
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Выберите файл для импорта')
+        return redirect(url_for('console_export'))
+    try:
+        fmt, compress = imports.parse_options(upload.filename, request.form.get('format') or None)
+        report = imports.import_messages(db.session, Message.__table__, upload.stream, fmt, compress)
+        db.session.commit()
+    except imports.ImportDataError as e:
+        db.session.rollback()
+        flash(f'Импорт отменён, банк не изменён. {e}')
+        return redirect(url_for('console_export'))
+
+    question_bank.invalidate()
+    if report.inserted:
+        # Подписи для поиска похожих сообщений строятся в фоне
+        duplicate_index.refresh_later(storage.primary_engine(db))
+    flash(f'Импортировано сообщений: {report.inserted}, пропущено совпадающих с банком: '
+          f'{report.duplicates} ({report.seconds:.1f} с)')
+    return redirect(url_for('console_export'))
 
 
 @app.route('/cons/export/users_csv')
+@use_replica
+@query_budget(2)
 def export_users_csv():
     if not check_admin():
         return redirect(url_for('ErAuth'))
 
-    users = User.query.all()
+    return export_users('csv', None)
 
-    # Создаем CSV вручную
-    csv_data = "ID,Username,Role,Registration\n"
-    for user in users:
-        role = "Пользователь"
-        if user.privileges == 1:
-            role = "Учитель"
-        elif user.privileges == 2:
-            role = "Администратор"
 
-        csv_data += f"{user.id},{user.username},{role}\n"
+@app.route('/dashboard/testing_management/testing_report/<int:testing_id>')
+@use_replica
+@query_budget(3)
+def testing_report(testing_id):
+    """Отчёт по тестированию: попытки и баллы каждого ученика"""
+    if not check_privileges():
+        return redirect(url_for('ErAuth'))
+    try:
+        fmt, compress = exports.parse_options(request.args)
+    except exports.ExportError as e:
+        abort(400, str(e))
 
-    return Response(
-        csv_data,
-        mimetype="text/csv",
-        headers={"Content-disposition": "attachment; filename=users_export.csv"}
+    test = Testing.query.get_or_404(testing_id)
+    # Попытки из рабочей таблицы и итоги архива складываются в одном запросе
+    attempts = union_all(
+        select(Result.user_id, func.count(Result.id).label('results'), func.sum(Result.score).label('score_sum'),
+               func.max(Result.score).label('score_max'), func.min(Result.score).label('score_min'))
+        .where(Result.testing_id == test.id)
+        .group_by(Result.user_id),
+        select(ResultSummary.user_id, ResultSummary.results, ResultSummary.score_sum,
+               ResultSummary.score_max, ResultSummary.score_min)
+        .where(ResultSummary.testing_id == test.id)).subquery()
+    statement = (
+        select(attempts.c.user_id, User.username, func.sum(attempts.c.results), func.max(attempts.c.score_max),
+               # 1.0 — литерал: numeric в PostgreSQL (round(double precision, int) там нет), real в SQLite
+               cast(func.round(func.sum(attempts.c.score_sum) * literal_column('1.0')
+                               / func.sum(attempts.c.results), 2), Float),
+               func.min(attempts.c.score_min))
+        .outerjoin(User, User.id == attempts.c.user_id)
+        .group_by(attempts.c.user_id, User.username)
+        .order_by(User.username)
     )
+    return exports.stream('testing_report', exports.query_rows(db.session, statement),
+                          ['user_id', 'username', 'attempts', 'best_score', 'avg_score', 'worst_score'],
+                          fmt, compress, filename=f'testing_{test.id}_report')
 # ---------------------------------------------------------
 # Запуск дебагера
 # ---------------------------------------------------------
@@ -1947,8 +3032,7 @@ def test():
 
     return render_template('index.html', user=user)
 if __name__ == '__main__':
-    print("Регистрация маршрутов:")
     for rule in app.url_map.iter_rules():
-        print(f"{rule.methods} {rule.rule}")
+        log.debug('route %s %s', sorted(rule.methods), rule.rule)
     app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,95 @@
+# ------------------------------------------------------------------
+# Логирование: JSON-записи, фоновая очередь, уровни по подсистемам
+# ------------------------------------------------------------------
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Уровни по умолчанию; переопределяются переменной LOG_LEVELS
+DEFAULT_LEVELS = {
+    'sqlalchemy.engine': 'WARNING',
+    'werkzeug': 'INFO',
+}
+
+# Поля LogRecord, которые не выводятся как пользовательские
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей ниже уровня ERROR"""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.ERROR or random.random() < self.rate
+
+
+def _parse_pairs(value):
+    pairs = {}
+    for item in (value or '').split(','):
+        name, sep, setting = item.partition('=')
+        if sep and name.strip():
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+def setup_logging():
+    """Настроить логирование один раз при запуске приложения.
+
+    LOG_LEVEL   — уровень корневого логгера (INFO)
+    LOG_LEVELS  — уровни подсистем: "sqlalchemy.engine=INFO,fishchat.app=DEBUG"
+    LOG_SAMPLE  — доли записей шумных логгеров: "fishchat.querylog=0.1"
+    LOG_FORMAT  — json (по умолчанию) или text
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if os.environ.get('LOG_FORMAT', 'json') == 'text':
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    else:
+        formatter = JsonFormatter()
+
+    # Запись в stdout выполняет фоновый поток; запросы только кладут запись в очередь
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    levels = dict(DEFAULT_LEVELS, **_parse_pairs(os.environ.get('LOG_LEVELS')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    for name, rate in _parse_pairs(os.environ.get('LOG_SAMPLE')).items():
+        logging.getLogger(name).addFilter(SamplingFilter(float(rate)))
@@ -0,0 +1,422 @@
+# ------------------------------------------------------------------
+# Архив результатов закрытых тестирований
+#
+# Результаты тестирования со status == False, самый свежий из которых
+# старше срока хранения, переносятся из Results в сегмент архива: одна
+# строка result_archive на тестирование, его результаты — JSON, сжатый
+# zlib. В базе остаётся сводка по участнику (result_summary: попыток,
+# сумма, минимум и максимум баллов, правильных и неправильных ответов,
+# id сообщений, на которые он отвечал) только по архивным результатам —
+# списки тестирований, статистика, история, отчёт по попыткам и
+# исключение уже виденных вопросов при сборке урока читают её и не
+# распаковывают сегменты. Отчёт по отдельному результату или
+# тестированию распаковывает сегмент по запросу; последние
+# распакованные сегменты хранятся в памяти узла по хэшу сжатых данных,
+# поэтому перезапись сегмента (повторная архивация тестирования,
+# удаление пользователя, пересчёт баллов) не требует очистки кэша.
+#
+# Пересчёт баллов (rescoring.py) переписывает и сегменты тестирований
+# урока вместе со сводкой. Ответы масками (bitsets.py) архивируются
+# как есть — раскладки из result_layout не удаляются.
+# ------------------------------------------------------------------
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, insert, or_, select, update
+
+import bitsets
+from metrics import Counter
+
+log = logging.getLogger('fishchat.archive')
+
+ARCHIVED_RESULTS = Counter(
+    'fishchat_archived_results_total',
+    'Результаты, перенесённые в архив',
+)
+ARCHIVE_LOADS = Counter(
+    'fishchat_archive_segment_loads_total',
+    'Чтения сегментов архива',
+    ['result'],
+)
+
+# Версия формата сегмента
+SEGMENT_VERSION = 1
+# Сегментов в одном запросе выгрузки архива
+SEGMENT_BATCH = 100
+# Результатов в одной транзакции переноса (тестирования не делятся между транзакциями)
+BATCH = 1000
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def cutoff(days):
+    """Граница срока хранения: результаты новее — в рабочей таблице (UTC, как CURRENT_TIMESTAMP)"""
+    if days < 0:
+        raise ArchiveError('Срок хранения не может быть отрицательным')
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+
+
+def _plain(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'b64': base64.b64encode(bytes(value)).decode()}
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _restore(value):
+    if isinstance(value, dict):
+        if 'b64' in value:
+            return base64.b64decode(value['b64'])
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode(columns, rows):
+    """(сжатый сегмент, байт до сжатия) для строк rows — словарей со столбцами columns"""
+    raw = json.dumps({'v': SEGMENT_VERSION, 'columns': columns,
+                      'rows': [[_plain(row[name]) for name in columns] for row in rows]},
+                     ensure_ascii=False, separators=(',', ':')).encode()
+    return zlib.compress(raw, 6), len(raw)
+
+
+def decode(data):
+    """Строки сегмента — словари {столбец: значение}"""
+    segment = json.loads(zlib.decompress(data))
+    if segment.get('v') != SEGMENT_VERSION:
+        raise ArchiveError(f'Неизвестная версия сегмента архива: {segment.get("v")}')
+    columns = segment['columns']
+    return [{name: _restore(value) for name, value in zip(columns, row)} for row in segment['rows']]
+
+
+def answer_counts(row):
+    """(правильных, неправильных) строки результата при любой записи ответов"""
+    if row.get('answers') is not None:
+        return bitsets.counts(row['answers'])
+    return len(row.get('correct_answers_id') or ()), len(row.get('wrong_answers_id') or ())
+
+
+def _add_to_summary(totals, row, correct_ids, wrong_ids):
+    """Добавить результат row с ответами на сообщения correct_ids / wrong_ids к итогам
+
+    totals — {(тестирование, пользователь): строка сводки}.
+    """
+    key = (row['testing_id'], row['user_id'])
+    total = totals.get(key)
+    if total is None:
+        total = totals[key] = {'testing_id': row['testing_id'], 'user_id': row['user_id'], 'results': 0,
+                               'score_sum': 0, 'score_min': row['score'], 'score_max': row['score'],
+                               'correct': 0, 'wrong': 0, 'seen': []}
+    total['results'] += 1
+    total['score_sum'] += row['score']
+    total['score_min'] = min(total['score_min'], row['score'])
+    total['score_max'] = max(total['score_max'], row['score'])
+    total['correct'] += len(correct_ids)
+    total['wrong'] += len(wrong_ids)
+    total['seen'] = sorted(set(total['seen']).union(correct_ids, wrong_ids))
+
+
+class ArchiveReport:
+    def __init__(self):
+        self.testings = 0
+        self.results = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.seconds = 0.0
+
+
+class ResultArchive:
+    """Архив таблицы результатов result_table: сегменты segment_table и сводка summary_table
+
+    Архивируются тестирования testing_table со status == False.
+    layouts — bitsets.LayoutStore раскладок масок ответов, engine() —
+    база, из которой они читаются. cache_size — сколько распакованных
+    сегментов хранить в памяти узла.
+    """
+    def __init__(self, result_table, segment_table, summary_table, testing_table, layouts, engine,
+                 cache_size=8):
+        self.results = result_table
+        self.segments = segment_table
+        self.summary = summary_table
+        self.testings = testing_table
+        self.layouts = layouts
+        self.engine = engine
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _answers(self, rows):
+        """(id правильных, id неправильных) каждой строки; маски — по раскладкам результатов"""
+        engine = self.engine()
+        self.layouts.preload(engine, {row.get('layout_id') for row in rows if row.get('answers') is not None})
+        return [bitsets.unpack(self.layouts.questions(engine, row['layout_id']), row['answers'])
+                if row.get('answers') is not None
+                else (row.get('correct_answers_id') or [], row.get('wrong_answers_id') or [])
+                for row in rows]
+
+    def _summaries(self, rows):
+        """Строки сводки по архивным результатам rows"""
+        totals = {}
+        for row, (correct_ids, wrong_ids) in zip(rows, self._answers(rows)):
+            _add_to_summary(totals, row, correct_ids, wrong_ids)
+        return list(totals.values())
+
+    # ---------------------------------------------------------
+    # Перенос в архив
+    # ---------------------------------------------------------
+    def candidates(self, db_session, before):
+        """[(id тестирования, результатов)]: закрытые тестирования, все результаты которых старше before
+
+        Результаты без даты сохранены до её появления и считаются старыми.
+        """
+        r, t = self.results.c, self.testings.c
+        newest = func.max(r.created_at)
+        return db_session.execute(
+            select(r.testing_id, func.count())
+            .join(self.testings, t.id == r.testing_id)
+            .where(t.status.is_(False))
+            .group_by(r.testing_id)
+            .having(or_(newest.is_(None), newest < before))
+            .order_by(r.testing_id)).all()
+
+    def archive(self, db_session, testing_ids, report=None):
+        """Перенести результаты тестирований testing_ids в их сегменты; фиксирует вызывающий код"""
+        r, g, s = self.results.c, self.segments.c, self.summary.c
+        rows = db_session.execute(select(self.results).where(r.testing_id.in_(testing_ids))
+                                  .order_by(r.id)).mappings().all()
+        if not rows:
+            return 0
+        by_testing = {}
+        for row in rows:
+            by_testing.setdefault(row['testing_id'], []).append(row)
+        testing_ids = sorted(by_testing)
+        existing = {segment.testing_id: segment for segment in db_session.execute(
+            select(g.id, g.testing_id, g.data).where(g.testing_id.in_(testing_ids)))}
+
+        columns = [column.name for column in self.results.columns]
+        segments, summaries = [], []
+        for testing_id in testing_ids:
+            # Тестирование уже архивировали (его снова открывали): сегмент и сводка записываются заново целиком
+            archived = decode(existing[testing_id].data) if testing_id in existing else []
+            testing_rows = archived + [dict(row) for row in by_testing[testing_id]]
+            data, raw_size = encode(columns, testing_rows)
+            segments.append({'testing_id': testing_id, 'results': len(testing_rows),
+                             'raw_size': raw_size, 'data': data})
+            summaries.extend(self._summaries(testing_rows))
+            if report is not None:
+                report.raw_bytes += raw_size
+                report.stored_bytes += len(data)
+
+        if existing:
+            db_session.execute(delete(self.segments).where(g.id.in_([seg.id for seg in existing.values()])))
+        db_session.execute(insert(self.segments), segments)
+        db_session.execute(delete(self.summary).where(s.testing_id.in_(testing_ids)))
+        db_session.execute(insert(self.summary), summaries)
+        # Результаты, сохранённые во время переноса, остаются в рабочей таблице
+        db_session.execute(delete(self.results).where(r.testing_id.in_(testing_ids), r.id <= rows[-1]['id']))
+        ARCHIVED_RESULTS.inc(len(rows))
+        if report is not None:
+            report.testings += len(testing_ids)
+            report.results += len(rows)
+        return len(rows)
+
+    def run(self, db_session, days):
+        """Перенести в архив все подходящие тестирования; транзакция — не меньше BATCH результатов"""
+        started = time.perf_counter()
+        report = ArchiveReport()
+        batch, size = [], 0
+        for testing_id, count in self.candidates(db_session, cutoff(days)) + [(None, 0)]:
+            if testing_id is not None:
+                batch.append(testing_id)
+                size += count
+                if size < BATCH:
+                    continue
+            if batch:
+                self.archive(db_session, batch, report)
+                db_session.commit()
+            batch, size = [], 0
+        report.seconds = time.perf_counter() - started
+        log.info('Archived %d results of %d testings in %.2fs (%d -> %d bytes)', report.results,
+                 report.testings, report.seconds, report.raw_bytes, report.stored_bytes)
+        return report
+
+    def restore_testing(self, db_session, testing_id):
+        """Вернуть архивные результаты тестирования в рабочую таблицу с прежними id; фиксирует вызывающий код"""
+        segment = self._segment_row(db_session, testing_id, with_data=True)
+        if segment is None:
+            return 0
+        rows = decode(segment.data)
+        if rows:
+            db_session.execute(insert(self.results), rows)
+        db_session.execute(delete(self.segments).where(self.segments.c.id == segment.id))
+        db_session.execute(delete(self.summary).where(self.summary.c.testing_id == testing_id))
+        return len(rows)
+
+    # ---------------------------------------------------------
+    # Чтение по запросу
+    # ---------------------------------------------------------
+    def _segment_row(self, db_session, testing_id, with_data=False):
+        g = self.segments.c
+        columns = (g.id, g.data) if with_data else (g.id,)
+        return db_session.execute(select(*columns).where(g.testing_id == testing_id)).first()
+
+    def unpack(self, segment):
+        """Строки сегмента (id, data), например прочитанного вместе с тестированием; None — []
+
+        Распакованные недавно сегменты — из памяти узла. Ключ кэша — хэш
+        сжатых данных: id сегмента после перезаписи может достаться
+        сегменту с другими строками.
+        """
+        if segment is None:
+            return []
+        key = hashlib.blake2b(segment.data, digest_size=16).digest()
+        with self._lock:
+            rows = self._cache.get(key)
+            if rows is not None:
+                self._cache.move_to_end(key)
+        if rows is not None:
+            ARCHIVE_LOADS.inc(result='hit')
+            return rows
+        ARCHIVE_LOADS.inc(result='miss')
+        rows = decode(segment.data)
+        with self._lock:
+            self._cache[key] = rows
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return rows
+
+    def testing_rows(self, db_session, testing_id):
+        """Архивные результаты тестирования (словари строк); [] — если архива у него нет
+
+        Сжатый сегмент читается одним запросом вместе с id (порядка
+        килобайта на тестирование); распаковка — только при промахе кэша.
+        """
+        return self.unpack(self._segment_row(db_session, testing_id, with_data=True))
+
+    def seen(self, db_session, user_ids):
+        """id сообщений, на которые пользователи user_ids отвечали в архивных результатах"""
+        s = self.summary.c
+        seen, unknown = set(), []
+        for testing_id, ids in db_session.execute(select(s.testing_id, s.seen).where(s.user_id.in_(user_ids))):
+            if ids is None:
+                # Сводка записана до появления столбца seen: ответы — из сегмента
+                unknown.append(testing_id)
+            else:
+                seen.update(ids)
+        if unknown:
+            user_ids = set(user_ids)
+            g = self.segments.c
+            for data in db_session.execute(select(g.data).where(g.testing_id.in_(sorted(set(unknown))))).scalars():
+                rows = [row for row in decode(data) if row['user_id'] in user_ids]
+                for correct_ids, wrong_ids in self._answers(rows):
+                    seen.update(correct_ids)
+                    seen.update(wrong_ids)
+        return seen
+
+    def segment_rows(self, db_session, testing_id=None, user_id=None):
+        """Архивные результаты для выгрузки: порции по SEGMENT_BATCH сегментов в порядке тестирований
+
+        Кэш узла не используется: полная выгрузка вытеснила бы из него
+        сегменты, которые открывают в отчётах.
+        """
+        g = self.segments.c
+        statement = select(g.testing_id, g.data).order_by(g.testing_id).limit(SEGMENT_BATCH)
+        if testing_id is not None:
+            statement = statement.where(g.testing_id == testing_id)
+        if user_id is not None:
+            s = self.summary.c
+            statement = statement.where(g.testing_id.in_(
+                select(s.testing_id).where(s.user_id == user_id)))
+        last = None
+        while True:
+            batch = db_session.execute(statement if last is None else statement.where(g.testing_id > last)).all()
+            if not batch:
+                return
+            last = batch[-1].testing_id
+            rows = [row for segment in batch for row in decode(segment.data)
+                    if user_id is None or row['user_id'] == user_id]
+            if rows:
+                yield rows
+            if len(batch) < SEGMENT_BATCH:
+                return
+
+    # ---------------------------------------------------------
+    # Пересчёт баллов
+    # ---------------------------------------------------------
+    def lesson_segments(self, db_session, lesson_ids):
+        """(id сегмента, строки) архивов тестирований уроков lesson_ids; сегменты читаются по одному
+
+        Раскладки масок строк загружаются заранее. Вызывающий код может
+        фиксировать транзакцию между сегментами.
+        """
+        g, t = self.segments.c, self.testings.c
+        segment_ids = db_session.execute(
+            select(g.id).join(self.testings, t.id == g.testing_id)
+            .where(t.lesson_id.in_(sorted(lesson_ids))).order_by(g.id)).scalars().all()
+        engine = self.engine()
+        for segment_id in segment_ids:
+            data = db_session.execute(select(g.data).where(g.id == segment_id)).scalar()
+            if data is None:
+                continue
+            rows = decode(data)
+            self.layouts.preload(engine, {row.get('layout_id') for row in rows})
+            yield segment_id, rows
+
+    def rewrite(self, db_session, segment_id, rows):
+        """Записать изменённые строки сегмента и сводку его тестирования; фиксирует вызывающий код"""
+        g, s = self.segments.c, self.summary.c
+        data, raw_size = encode(list(rows[0]), rows)
+        db_session.execute(update(self.segments).where(g.id == segment_id)
+                           .values(results=len(rows), raw_size=raw_size, data=data))
+        db_session.execute(delete(self.summary).where(s.testing_id == rows[0]['testing_id']))
+        db_session.execute(insert(self.summary), self._summaries(rows))
+
+    # ---------------------------------------------------------
+    # Удаление
+    # ---------------------------------------------------------
+    def delete_testing(self, db_session, testing_id):
+        """Удалить архив тестирования; возвращает число его результатов, фиксирует вызывающий код"""
+        s = self.summary.c
+        count = db_session.execute(select(func.coalesce(func.sum(s.results), 0))
+                                   .where(s.testing_id == testing_id)).scalar()
+        db_session.execute(delete(self.segments).where(self.segments.c.testing_id == testing_id))
+        db_session.execute(delete(self.summary).where(s.testing_id == testing_id))
+        return count
+
+    def delete_all(self, db_session):
+        """Удалить весь архив; возвращает число результатов в нём"""
+        count = db_session.execute(select(func.coalesce(func.sum(self.summary.c.results), 0))).scalar()
+        db_session.execute(delete(self.segments))
+        db_session.execute(delete(self.summary))
+        return count
+
+    def delete_user(self, db_session, user_id):
+        """Удалить архивные результаты пользователя: сегменты с ними записываются заново"""
+        s, g = self.summary.c, self.segments.c
+        count = 0
+        testing_ids = db_session.execute(select(s.testing_id).where(s.user_id == user_id)).scalars().all()
+        for testing_id in testing_ids:
+            segment = self._segment_row(db_session, testing_id, with_data=True)
+            if segment is None:
+                continue
+            rows = decode(segment.data)
+            kept = [row for row in rows if row['user_id'] != user_id]
+            count += len(rows) - len(kept)
+            if kept:
+                data, raw_size = encode(list(kept[0]), kept)
+                db_session.execute(update(self.segments).where(g.id == segment.id)
+                                   .values(results=len(kept), raw_size=raw_size, data=data))
+            else:
+                db_session.execute(delete(self.segments).where(g.id == segment.id))
+        db_session.execute(delete(self.summary).where(s.user_id == user_id))
+        return count
@@ -0,0 +1,70 @@
+# ------------------------------------------------------------------
+# Перенос результатов закрытых тестирований в архив (archive.py)
+#
+#   python archive_results.py                          # старше RESULT_RETENTION_DAYS
+#   python archive_results.py --days 30 --dry-run      # только показать, что будет перенесено
+#   python archive_results.py --restore 12             # вернуть архив тестирования 12 в Results
+#   python archive_results.py --database postgresql://fishchat:secret@db/school1 --vacuum
+#
+# Архивируются тестирования со status == False, последний результат
+# которых старше срока. Порция тестирований (около тысячи результатов) —
+# своя транзакция: прерванный перенос продолжается повторным запуском.
+# То же делает кнопка «Перенести в архив» на странице /cons/cleanup.
+# ------------------------------------------------------------------
+import argparse
+import os
+import time
+
+from sqlalchemy import func, select, text
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Перенести результаты закрытых тестирований в архив')
+    parser.add_argument('--database', help='URL базы (по умолчанию DATABASE_URL приложения)')
+    parser.add_argument('--days', type=float, help='срок хранения, дней (по умолчанию RESULT_RETENTION_DAYS)')
+    parser.add_argument('--dry-run', action='store_true', help='показать тестирования, ничего не переносить')
+    parser.add_argument('--restore', type=int, metavar='TESTING_ID', help='вернуть архив тестирования в Results')
+    parser.add_argument('--vacuum', action='store_true', help='SQLite: сжать файл базы после переноса')
+    return parser.parse_args(argv)
+
+
+def main(args):
+    if args.database:
+        # Приложение читает DATABASE_URL при импорте и создаёт таблицы архива
+        os.environ['DATABASE_URL'] = args.database
+
+    import archive
+    from app import app, db, Result, RESULT_RETENTION_DAYS, results_archive
+
+    days = RESULT_RETENTION_DAYS if args.days is None else args.days
+    started = time.perf_counter()
+    with app.app_context():
+        engine = db.engine
+        store = results_archive.current()
+        target = engine.url.render_as_string(hide_password=True)
+        if args.restore is not None:
+            restored = store.restore_testing(db.session, args.restore)
+            db.session.commit()
+            print(f'{target}: testing {args.restore}: {restored} results restored')
+            return
+        if args.dry_run:
+            candidates = store.candidates(db.session, archive.cutoff(days))
+            for testing_id, count in candidates:
+                print(f'testing {testing_id}: {count} results')
+            print(f'{target}: {sum(count for _, count in candidates)} results of {len(candidates)} testings '
+                  f'older than {days:g} days would be archived')
+            return
+        report = store.run(db.session, days)
+        remaining = db.session.execute(select(func.count()).select_from(Result)).scalar()
+        db.session.close()
+        if args.vacuum and engine.dialect.name == 'sqlite':
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM'))
+
+    print(f'{target}: {report.results} results of {report.testings} testings archived '
+          f'in {time.perf_counter() - started:.1f}s, {remaining} left in Results')
+    print(f'archive: {report.raw_bytes} bytes -> {report.stored_bytes} bytes compressed')
+
+
+if __name__ == '__main__':
+    main(parse_args())
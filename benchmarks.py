@@ -0,0 +1,246 @@
+# ------------------------------------------------------------------
+# Бенчмарки горячих путей на синтетических базах разного размера
+#
+#   python benchmarks.py                       # small и medium, сравнение с базовой линией
+#   python benchmarks.py --sizes large         # миллион результатов
+#   python benchmarks.py --update-baseline     # записать bench/baseline.json
+#
+# Для каждого размера база строится gen_data.py (один раз, в bench/data),
+# сценарии выполняются в отдельном процессе приложения через тестовый
+# клиент Flask. Записываются время, число SQL-запросов и пик памяти.
+# Базовая линия зависит от машины: обновляйте её на той же машине, где сравниваете.
+# ------------------------------------------------------------------
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).parent.resolve().joinpath('bench')
+DATA_DIR = BENCH_DIR.joinpath('data')
+RESULTS_DIR = BENCH_DIR.joinpath('results')
+BASELINE = BENCH_DIR.joinpath('baseline.json')
+
+SIZES = {
+    'small': ['--messages', '500', '--users', '1000', '--lessons', '50', '--results', '10000'],
+    'medium': ['--messages', '2000', '--users', '5000', '--lessons', '200', '--results', '100000'],
+    'large': ['--messages', '5000', '--users', '20000', '--lessons', '500', '--results', '1000000'],
+}
+
+SCENARIOS = [
+    'train', 'test_room', 'save_test_result', 'test_room_preview', 'result_list',
+    'results_detailed', 'group_results', 'console_cleanup', 'export_users_csv', 'export_results',
+    'msg_list', 'group_create',
+]
+
+
+def drain(response):
+    """Прочитать ответ по частям, не собирая тело целиком (потоковые выгрузки)"""
+    for _ in response.response:
+        pass
+    response.close()
+
+
+def dataset(size):
+    path = DATA_DIR.joinpath(f'{size}.db')
+    if not path.exists():
+        subprocess.run([sys.executable, str(Path(__file__).parent.joinpath('gen_data.py')),
+                        '--db', str(path), *SIZES[size]], check=True)
+    return path
+
+
+# ------------------------------------------------------------------
+# Выполняется внутри дочернего процесса с DATABASE_URL нужной базы
+# ------------------------------------------------------------------
+def run_size(repeat):
+    from sqlalchemy import func
+    from app import app, db, Group, Result, Testing, User
+    from querylog import record
+
+    client = app.test_client()
+    # train хранит весь перемешанный банк в cookie; предупреждения о размере здесь не нужны
+    warnings.filterwarnings('ignore', message="The 'session' cookie is too large")
+
+    with app.app_context():
+        # Тестирование с наибольшим числом результатов и его первая группа
+        testing_id, _ = db.session.query(Result.testing_id, func.count(Result.id)) \
+            .group_by(Result.testing_id).order_by(func.count(Result.id).desc()).first()
+        testing = db.session.get(Testing, testing_id)
+        group = db.session.get(Group, testing.group_id[0])
+        student = db.session.get(User, group.users[0])
+        student_name = student.username
+        last_result_id = db.session.query(func.max(Result.id)).scalar()
+
+    def as_user(username):
+        with client.session_transaction() as s:
+            s.clear()
+            s['curent_user'] = username
+
+    def start_test():
+        as_user(student_name)
+        client.get(f'/test_room/{testing_id}/0')
+
+    # Сценарий: (подготовка перед каждым повтором, запрос)
+    scenarios = {
+        'train': (lambda: as_user(student_name),
+                  lambda: client.get('/train/0')),
+        'test_room': (start_test,
+                      lambda: client.get(f'/test_room/{testing_id}/1')),
+        'save_test_result': (start_test,
+                             lambda: client.post(f'/test_room/{testing_id}/1', data={'action': 'finish'})),
+        'test_room_preview': (lambda: as_user(student_name),
+                              lambda: client.get('/test_room_preview')),
+        'result_list': (lambda: as_user('admin'),
+                        lambda: client.get('/dashboard/testing_management/result_list')),
+        'results_detailed': (lambda: as_user('admin'),
+                             lambda: client.get(f'/dashboard/testing_management/results_detailed/{testing_id}')),
+        'group_results': (lambda: as_user('admin'),
+                          lambda: client.get(f'/dashboard/testing_management/group_results/{testing_id}/{group.id}')),
+        'console_cleanup': (lambda: as_user('admin'),
+                            lambda: client.get('/cons/cleanup')),
+        'export_users_csv': (lambda: as_user('admin'),
+                             lambda: client.get('/cons/export/users_csv')),
+        'export_results': (lambda: as_user('admin'),
+                           lambda: client.get('/cons/export/results?format=jsonl')),
+        'msg_list': (lambda: as_user('admin'),
+                     lambda: client.get('/dashboard/DB_management/DB_msg_list?q=а&kind=fake')),
+        'group_create': (lambda: as_user('admin'),
+                         lambda: client.get('/dashboard/testing_management/group_create')),
+    }
+
+    results = {}
+    try:
+        for name in SCENARIOS:
+            prepare, call = scenarios[name]
+
+            prepare()
+            response = call()  # прогрев
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: HTTP {response.status_code}')
+            drain(response)
+
+            timings = []
+            for _ in range(repeat):
+                prepare()
+                started = time.perf_counter()
+                drain(call())
+                timings.append(time.perf_counter() - started)
+
+            prepare()
+            with record() as queries:
+                drain(call())
+
+            prepare()
+            tracemalloc.start()
+            drain(call())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[name] = {
+                'wall_ms': round(statistics.median(timings) * 1000, 2),
+                'wall_ms_min': round(min(timings) * 1000, 2),
+                'queries': queries.count,
+                'peak_kb': round(peak / 1024, 1),
+            }
+    finally:
+        # Результаты, сохранённые сценарием save_test_result, удаляем
+        with app.app_context():
+            Result.query.filter(Result.id > last_result_id).delete()
+            db.session.commit()
+
+    return results
+
+
+# ------------------------------------------------------------------
+# Сравнение с базовой линией
+# ------------------------------------------------------------------
+def compare(current, baseline, threshold):
+    """Список регрессий: лучшее время и память — с допуском, SQL-запросы — строго"""
+    regressions = []
+    for size, scenarios in current.items():
+        for name, now in scenarios.items():
+            before = baseline.get(size, {}).get(name)
+            if not before:
+                continue
+            if now['queries'] > before['queries']:
+                regressions.append(f'{size}/{name}: queries {before["queries"]} -> {now["queries"]}')
+            for key in ('wall_ms_min', 'peak_kb'):
+                if now[key] > before[key] * (1 + threshold):
+                    regressions.append(f'{size}/{name}: {key} {before[key]} -> {now[key]} '
+                                       f'(+{(now[key] / before[key] - 1) * 100:.0f}%)')
+    return regressions
+
+
+def print_table(current, baseline):
+    print(f'{"scenario":<28}{"wall ms":>10}{"base":>10}{"queries":>9}{"base":>6}{"peak KB":>11}{"base":>11}')
+    for size, scenarios in current.items():
+        for name, now in scenarios.items():
+            before = baseline.get(size, {}).get(name, {})
+            print(f'{size + "/" + name:<28}{now["wall_ms"]:>10}{before.get("wall_ms", "-"):>10}'
+                  f'{now["queries"]:>9}{before.get("queries", "-"):>6}'
+                  f'{now["peak_kb"]:>11}{before.get("peak_kb", "-"):>11}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки горячих путей')
+    parser.add_argument('--sizes', default='small,medium', help='через запятую: ' + ', '.join(SIZES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.25, help='допустимый рост времени и памяти')
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--out', help='файл для результатов (по умолчанию bench/results/<время>.json)')
+    parser.add_argument('--child-out', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child_out:
+        Path(args.child_out).write_text(json.dumps(run_size(args.repeat)), encoding='utf-8')
+        return 0
+
+    current = {}
+    for size in args.sizes.split(','):
+        path = dataset(size)
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + str(path), LOG_LEVEL='ERROR')
+        child_out = path.with_suffix('.result.json')
+        subprocess.run([sys.executable, __file__, '--child-out', str(child_out),
+                        '--repeat', str(args.repeat)], env=env, check=True)
+        current[size] = json.loads(child_out.read_text(encoding='utf-8'))
+        child_out.unlink()
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': current,
+    }
+    out = Path(args.out) if args.out else RESULTS_DIR.joinpath(datetime.now().strftime('%Y%m%d-%H%M%S.json'))
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding='utf-8')
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8'))['results'] if baseline_path.exists() else {}
+    print_table(current, baseline)
+    print(f'\nresults: {out}')
+
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2, ensure_ascii=False) + '\n', encoding='utf-8')
+        print(f'baseline updated: {baseline_path}')
+        return 0
+
+    regressions = compare(current, baseline, args.threshold)
+    for line in regressions:
+        print('REGRESSION', line)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
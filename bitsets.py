@@ -0,0 +1,213 @@
+# ------------------------------------------------------------------
+# Компактная запись ответов результата: битовые маски
+#
+# Вместо двух JSON-списков id (correct_answers_id, wrong_answers_id)
+# результат хранит раскладку — упорядоченный список вопросов урока на
+# момент прохождения (таблица result_layout, одна строка на все
+# результаты с тем же списком) — и blob из двух масок по этому списку:
+#   [маска ответов][маска правильных], по ceil(n / 8) байт каждая;
+# бит i — вопрос questions[i], старший бит байта первый (как у
+# numpy.packbits). Урок из 30 вопросов — 8 байт вместо ~200 байт JSON.
+# Раскладки не меняются: правка урока создаёт новую, старые результаты
+# читаются по своей.
+#
+# Для аналитики маски многих результатов распаковываются одним вызовом
+# numpy.unpackbits в матрицы результатов × вопросов; без numpy те же
+# функции считают в Python (int.bit_count).
+# ------------------------------------------------------------------
+import hashlib
+import json
+import threading
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+try:
+    import numpy
+except ImportError:  # необязательная зависимость: без неё — подсчёт в Python
+    numpy = None
+
+
+class BitsetError(ValueError):
+    pass
+
+
+def mask_size(count):
+    """Байт в одной маске для count вопросов"""
+    return (count + 7) // 8
+
+
+def _check(blob, size):
+    if len(blob) != 2 * size:
+        raise BitsetError(f'Маски на {len(blob)} байт не подходят к раскладке на {size} байт')
+
+
+def pack(questions, correct_ids, wrong_ids):
+    """Маски ответов по раскладке questions"""
+    # Повторяющийся в раскладке вопрос отмечается по первому вхождению
+    positions = {}
+    for position, mid in enumerate(questions):
+        positions.setdefault(mid, position)
+    size = mask_size(len(questions))
+    masks = bytearray(2 * size)
+    for ids, is_correct in ((correct_ids, True), (wrong_ids, False)):
+        for mid in ids or ():
+            position = positions.get(mid)
+            if position is None:
+                raise BitsetError(f'Сообщения {mid} нет в раскладке')
+            bit = 0x80 >> (position & 7)
+            masks[position >> 3] |= bit
+            if is_correct:
+                masks[size + (position >> 3)] |= bit
+    return bytes(masks)
+
+
+def unpack(questions, blob):
+    """(id правильных, id неправильных) в порядке раскладки"""
+    size = mask_size(len(questions))
+    _check(blob, size)
+    correct_ids, wrong_ids = [], []
+    for position, mid in enumerate(questions):
+        bit = 0x80 >> (position & 7)
+        if blob[position >> 3] & bit:
+            (correct_ids if blob[size + (position >> 3)] & bit else wrong_ids).append(mid)
+    return correct_ids, wrong_ids
+
+
+def counts(blob):
+    """(правильных, неправильных) — без раскладки, по числу единичных битов"""
+    size = len(blob) // 2
+    answered = int.from_bytes(blob[:size], 'big').bit_count()
+    correct = int.from_bytes(blob[size:], 'big').bit_count()
+    return correct, answered - correct
+
+
+def flip(questions, blob, message_id):
+    """Маски, где ответ на message_id оценён наоборот; None, если на него не отвечали"""
+    size = mask_size(len(questions))
+    _check(blob, size)
+    masks = bytearray(blob)
+    changed = False
+    for position, mid in enumerate(questions):
+        bit = 0x80 >> (position & 7)
+        if mid == message_id and masks[position >> 3] & bit:
+            masks[size + (position >> 3)] ^= bit
+            changed = True
+    return bytes(masks) if changed else None
+
+
+def _matrix(blobs, width):
+    """Маски одной длины как матрица uint8: строка — результат"""
+    return numpy.frombuffer(b''.join(blobs), dtype=numpy.uint8).reshape(len(blobs), width)
+
+
+def totals(blobs):
+    """([правильных], [неправильных]) по каждому blob
+
+    С numpy маски одной длины распаковываются вместе, и единицы
+    считаются по строкам матрицы.
+    """
+    blobs = list(blobs)
+    if numpy is None or not blobs:
+        pairs = [counts(blob) for blob in blobs]
+        return [c for c, _ in pairs], [w for _, w in pairs]
+    correct = numpy.zeros(len(blobs), dtype=numpy.int64)
+    answered = numpy.zeros(len(blobs), dtype=numpy.int64)
+    by_width = {}
+    for i, blob in enumerate(blobs):
+        by_width.setdefault(len(blob), []).append(i)
+    for width, rows in by_width.items():
+        if not width:
+            continue
+        bits = numpy.unpackbits(_matrix([blobs[i] for i in rows], width), axis=1)
+        half = width // 2 * 8
+        answered[rows] = bits[:, :half].sum(axis=1)
+        correct[rows] = bits[:, half:].sum(axis=1)
+    return correct.tolist(), (answered - correct).tolist()
+
+
+def matrices(blobs, count):
+    """Маски результатов одной раскладки из count вопросов: (ответы, правильные)
+
+    numpy: две bool-матрицы len(blobs) × count; без numpy — списки списков.
+    """
+    blobs = list(blobs)
+    size = mask_size(count)
+    for blob in blobs:
+        _check(blob, size)
+    if numpy is None or not blobs:
+        answered = [[bool(blob[p >> 3] & (0x80 >> (p & 7))) for p in range(count)] for blob in blobs]
+        correct = [[bool(blob[size + (p >> 3)] & (0x80 >> (p & 7))) for p in range(count)] for blob in blobs]
+        return answered, correct
+    packed = _matrix(blobs, 2 * size)
+    answered = numpy.unpackbits(packed[:, :size], axis=1, count=count).astype(bool)
+    correct = numpy.unpackbits(packed[:, size:], axis=1, count=count).astype(bool)
+    return answered, correct
+
+
+def question_totals(blobs, count):
+    """По каждому вопросу раскладки: ([ответили], [ответили правильно])"""
+    answered, correct = matrices(blobs, count)
+    if numpy is not None and len(answered):
+        return answered.sum(axis=0).tolist(), correct.sum(axis=0).tolist()
+    return ([sum(row[p] for row in answered) for p in range(count)],
+            [sum(row[p] for row in correct) for p in range(count)])
+
+
+def layout_digest(questions):
+    return hashlib.blake2b(json.dumps(list(questions)).encode(), digest_size=16).digest()
+
+
+class LayoutStore:
+    """Раскладки вопросов из таблицы table (id, digest, questions)
+
+    Раскладка не меняется после записи, поэтому прочитанные из базы
+    хранятся в памяти процесса без срока. Только что вставленная
+    раскладка в память не попадает: транзакция с ней может откатиться.
+    """
+    def __init__(self, table):
+        self.table = table
+        self._lock = threading.Lock()
+        self._questions = {}
+        self._ids = {}
+
+    def questions(self, engine, layout_id):
+        """Список вопросов раскладки (tuple)"""
+        if layout_id not in self._questions:
+            self.preload(engine, [layout_id])
+        try:
+            return self._questions[layout_id]
+        except KeyError:
+            raise BitsetError(f'Нет раскладки {layout_id}') from None
+
+    def preload(self, engine, layout_ids):
+        """Прочитать недостающие раскладки одним запросом"""
+        missing = {layout_id for layout_id in layout_ids if layout_id is not None} - self._questions.keys()
+        if not missing:
+            return
+        c = self.table.c
+        with engine.connect() as conn:
+            rows = conn.execute(select(c.id, c.digest, c.questions).where(c.id.in_(sorted(missing)))).all()
+        with self._lock:
+            for row in rows:
+                self._questions[row.id] = tuple(row.questions)
+                self._ids[bytes(row.digest)] = row.id
+
+    def ensure(self, db_session, questions):
+        """id раскладки с этим списком вопросов; новая вставляется в транзакции сессии"""
+        digest = layout_digest(questions)
+        if digest in self._ids:
+            return self._ids[digest]
+        c = self.table.c
+        layout_id = db_session.execute(select(c.id).where(c.digest == digest)).scalar()
+        if layout_id is not None:
+            with self._lock:
+                self._ids[digest] = layout_id
+            return layout_id
+        try:
+            # Точка сохранения: ту же раскладку могла вставить параллельная запись
+            with db_session.begin_nested():
+                return db_session.execute(
+                    insert(self.table).values(digest=digest, questions=list(questions)).returning(c.id)).scalar()
+        except IntegrityError:
+            return db_session.execute(select(c.id).where(c.digest == digest)).scalar_one()
@@ -0,0 +1,255 @@
+# ------------------------------------------------------------------
+# Проверка сообщений языковой моделью (OpenAI-совместимый бэкенд)
+# ------------------------------------------------------------------
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import Counter, Gauge, Histogram
+
+log = logging.getLogger('fishchat.checker')
+
+SYSTEM_PROMPT = (
+    'Ты помощник, который распознаёт мошеннические сообщения. '
+    'Проанализируй сообщение пользователя и ответь строго одним JSON-объектом '
+    'без пояснений вокруг него, с полями: '
+    '"text" — исходный текст сообщения, '
+    '"status" — "мошенничество" или "безопасно", '
+    '"certainty" — уверенность в процентах (число от 0 до 100), '
+    '"comment" — краткое объяснение на русском языке.'
+)
+
+# Фазы одного вызова: префилл (до первого токена), генерация (до последнего
+# токена) и разбор JSON в обработчике. Ожидание в очереди — fishchat_admission_wait_seconds
+LLM_PHASE_SECONDS = Histogram(
+    'fishchat_llm_phase_seconds',
+    'Длительность фаз вызова модели',
+    ['phase'],
+)
+LLM_CALL_SECONDS = Histogram(
+    'fishchat_llm_call_seconds',
+    'Полная длительность вызова модели',
+    ['outcome'],
+)
+LLM_TOKENS = Counter(
+    'fishchat_llm_tokens_total',
+    'Токены запросов и ответов модели',
+    ['kind'],
+)
+LLM_CALL_TOKENS = Histogram(
+    'fishchat_llm_call_tokens',
+    'Количество токенов на один вызов модели',
+    ['kind'],
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+LLM_CACHE = Counter(
+    'fishchat_llm_cache_total',
+    'Попадания и промахи кэша ответов модели',
+    ['result'],
+)
+LLM_RETRIES = Counter(
+    'fishchat_llm_retries_total',
+    'Повторные попытки вызова модели',
+)
+LLM_ERRORS = Counter(
+    'fishchat_llm_errors_total',
+    'Ошибки вызова модели',
+    ['error'],
+)
+LLM_INFLIGHT = Gauge(
+    'fishchat_llm_inflight',
+    'Вызовы модели, выполняющиеся прямо сейчас',
+)
+
+
+class CheckerError(Exception):
+    pass
+
+
+class Checker:
+    def __init__(self, base_url=None, api_key=None, model_id=None,
+                 max_retries=None, timeout=None,
+                 cache_size=None, cache_ttl=None, slow_threshold=None, shared=None):
+        self.base_url = base_url or os.environ.get('BASE_URL', 'http://localhost:1234/v1')
+        self.api_key = api_key or os.environ.get('API_KEY', 'lmstudio')
+        self.model_id = model_id or os.environ.get('MODEL_ID', 'openai/gpt-oss-20b')
+        self.max_retries = int(max_retries if max_retries is not None
+                               else os.environ.get('CHECKER_MAX_RETRIES', 2))
+        self.timeout = float(timeout or os.environ.get('CHECKER_TIMEOUT', 120))
+        self.cache_size = int(cache_size if cache_size is not None
+                              else os.environ.get('CHECKER_CACHE_SIZE', 256))
+        self.cache_ttl = float(cache_ttl or os.environ.get('CHECKER_CACHE_TTL', 3600))
+        self.slow_threshold = float(slow_threshold or os.environ.get('CHECKER_SLOW_SECONDS', 10))
+
+        # Параллельность вызовов ограничивает контроль допуска (admission.py), здесь второго лимита нет
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Общее хранилище узлов (shared.RedisBackend): ответ модели виден всем узлам
+        self.shared = shared
+        self._client = None
+
+    @property
+    def client(self):
+        # Клиент создаётся лениво: импорт приложения не требует доступного бэкенда
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=0,  # повторы считаем сами
+            )
+        return self._client
+
+    # --------------------------------------------------------------
+    # Кэш ответов
+    # --------------------------------------------------------------
+    @staticmethod
+    def _cache_key(msg):
+        return hashlib.sha256(' '.join(msg.split()).lower().encode('utf-8')).hexdigest()
+
+    def _cache_get(self, key):
+        if self.shared is not None:
+            value = self.shared.get('checker:' + key)
+            return value.decode('utf-8') if value is not None else None
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.cache_ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, key, value):
+        if self.cache_size <= 0:
+            return
+        if self.shared is not None:
+            self.shared.set('checker:' + key, value.encode('utf-8'), ttl=self.cache_ttl)
+            return
+        with self._cache_lock:
+            self._cache[key] = (time.monotonic(), value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def average_call_seconds(default=5.0):
+        count = LLM_CALL_SECONDS.count(outcome='ok')
+        if not count:
+            return default
+        return LLM_CALL_SECONDS.total(outcome='ok') / count
+
+    # --------------------------------------------------------------
+    # Вызов модели
+    # --------------------------------------------------------------
+    def check_message(self, msg, trace_id=None):
+        """Вернуть JSON-строку с оценкой сообщения"""
+        trace_id = trace_id or uuid.uuid4().hex
+        key = self._cache_key(msg)
+
+        cached = self._cache_get(key)
+        if cached is not None:
+            LLM_CACHE.inc(result='hit')
+            log.debug('checker cache hit trace_id=%s', trace_id)
+            return cached
+        LLM_CACHE.inc(result='miss')
+
+        started = time.perf_counter()
+        outcome = 'error'
+        stats = {}
+        try:
+            with LLM_INFLIGHT.track_inprogress():
+                content, stats = self._call_with_retries(msg)
+            outcome = 'ok'
+        finally:
+            total = time.perf_counter() - started
+            LLM_CALL_SECONDS.observe(total, outcome=outcome)
+            if total >= self.slow_threshold:
+                log.warning(
+                    'slow checker call trace_id=%s total=%.2fs '
+                    'prefill=%.2fs generation=%.2fs retries=%d '
+                    'prompt_tokens=%s completion_tokens=%s outcome=%s',
+                    trace_id, total,
+                    stats.get('prefill', 0.0), stats.get('generation', 0.0),
+                    stats.get('retries', 0),
+                    stats.get('prompt_tokens'), stats.get('completion_tokens'),
+                    outcome,
+                )
+
+        if content:
+            self._cache_put(key, content)
+        return content
+
+    def _call_with_retries(self, msg):
+        attempt = 0
+        while True:
+            try:
+                content, stats = self._call_once(msg)
+                stats['retries'] = attempt
+                return content, stats
+            except Exception as e:
+                LLM_ERRORS.inc(error=type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise CheckerError(f'Модель недоступна: {e}') from e
+                attempt += 1
+                LLM_RETRIES.inc()
+                log.info('checker retry %d after %s: %s', attempt, type(e).__name__, e)
+                time.sleep(min(2 ** (attempt - 1) * 0.5, 5.0))
+
+    def _call_once(self, msg):
+        sent = time.perf_counter()
+        stream = self.client.chat.completions.create(
+            model=self.model_id,
+            messages=[
+                {'role': 'system', 'content': SYSTEM_PROMPT},
+                {'role': 'user', 'content': msg},
+            ],
+            stream=True,
+            stream_options={'include_usage': True},
+        )
+
+        parts = []
+        first_token = None
+        chunks = 0
+        usage = None
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                parts.append(delta)
+                chunks += 1
+        finished = time.perf_counter()
+
+        first_token = first_token or finished
+        prefill = first_token - sent
+        generation = finished - first_token
+        LLM_PHASE_SECONDS.observe(prefill, phase='prefill')
+        LLM_PHASE_SECONDS.observe(generation, phase='generation')
+
+        # Если бэкенд не прислал usage, считаем токены ответа по чанкам
+        prompt_tokens = usage.prompt_tokens if usage else None
+        completion_tokens = usage.completion_tokens if usage else chunks
+        if prompt_tokens is not None:
+            LLM_TOKENS.inc(prompt_tokens, kind='prompt')
+            LLM_CALL_TOKENS.observe(prompt_tokens, kind='prompt')
+        LLM_TOKENS.inc(completion_tokens, kind='completion')
+        LLM_CALL_TOKENS.observe(completion_tokens, kind='completion')
+
+        return ''.join(parts), {
+            'prefill': prefill,
+            'generation': generation,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+        }
@@ -0,0 +1,259 @@
+# ------------------------------------------------------------------
+# Поиск похожих сообщений в банке вопросов (почти дубликатов)
+#
+# Текст нормализуется (регистр, числа, адреса ссылок), разбивается на
+# символьные шинглы по SHINGLE символов, и по ним считается подпись
+# MinHash из BANDS * ROWS значений. Подпись делится на BANDS полос; хэш
+# полосы хранится в таблице message_band с индексом (band, bucket).
+# Кандидаты для нового текста — сообщения, совпавшие с ним хотя бы в
+# одной полосе (LSH): один запрос по индексу вместо сравнения со всем
+# банком. Кандидаты проверяются точным сходством Жаккара по шинглам.
+#
+# Полосы обновляются при создании, правке и удалении сообщения
+# (DuplicateIndex.index / remove); сообщения, добавленные в обход
+# панели управления (генератор данных, копирование в базу школы),
+# индексирует refresh() — при запуске и перед отчётом о группах,
+# после импорта банка — в фоновом потоке (refresh_later).
+#
+# С BANDS=20, ROWS=3 пара со сходством 0.6 становится кандидатом
+# с вероятностью 0.99, со сходством 0.3 — 0.42.
+# ------------------------------------------------------------------
+import hashlib
+import logging
+import re
+import struct
+import threading
+import time
+
+from sqlalchemy import and_, delete, exists, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+from metrics import Histogram
+
+log = logging.getLogger('fishchat.dedup')
+
+DEDUP_SECONDS = Histogram(
+    'fishchat_dedup_seconds',
+    'Поиск похожих сообщений: проверка одного текста и отчёт по банку',
+    ['operation'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+
+SHINGLE = 5
+BANDS = 20
+ROWS = 3
+# Сообщений в одной порции при индексации банка
+BATCH = 500
+
+_URL = re.compile(r'https?://([^/\s]+)\S*')
+_DIGITS = re.compile(r'\d+')
+_NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+_HASHES = struct.Struct(f'<{BANDS * ROWS}I')
+_BAND = struct.Struct(f'<{ROWS}I')
+
+
+def normalize(value):
+    """Текст без различий, которыми отличаются копии: регистр, числа, пути ссылок"""
+    value = _URL.sub(r' \1 ', (value or '').lower())
+    value = _DIGITS.sub('0', value)
+    return _NON_WORD.sub(' ', value).strip()
+
+
+def shingles(value):
+    value = normalize(value)
+    if len(value) <= SHINGLE:
+        return {value} if value else set()
+    return {value[i:i + SHINGLE] for i in range(len(value) - SHINGLE + 1)}
+
+
+def similarity(a, b):
+    """Сходство Жаккара двух наборов шинглов"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def signature(items):
+    """MinHash: BANDS * ROWS минимумов независимых хэшей по шинглам
+
+    Все хэши шингла берутся из одного вызова shake_128, минимумы
+    по столбцам считает zip в C.
+    """
+    rows = [_HASHES.unpack(hashlib.shake_128(s.encode()).digest(_HASHES.size)) for s in items]
+    return [min(column) for column in zip(*rows)]
+
+
+def bands(value):
+    """[(номер полосы, хэш полосы)] текста; для пустого текста — пусто"""
+    items = shingles(value)
+    if not items:
+        return []
+    values = signature(items)
+    result = []
+    for band in range(BANDS):
+        packed = _BAND.pack(*values[band * ROWS:(band + 1) * ROWS])
+        bucket = int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), 'little', signed=True)
+        result.append((band, bucket))
+    return result
+
+
+class _Clusters:
+    """Объединение сообщений в группы (система непересекающихся множеств)"""
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        while parent != item:
+            grandparent = self.parent[parent]
+            self.parent[item] = grandparent
+            item, parent = parent, grandparent
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+    def groups(self):
+        result = {}
+        for item in self.parent:
+            result.setdefault(self.find(item), []).append(item)
+        return [sorted(group) for group in result.values() if len(group) > 1]
+
+
+class DuplicateIndex:
+    """Полосы MinHash сообщений в таблице band_table (message_id, band, bucket)
+
+    threshold — минимальное сходство Жаккара, при котором сообщения
+    считаются почти дубликатами.
+    """
+    def __init__(self, band_table, message_table, threshold=0.6):
+        self.bands = band_table
+        self.messages = message_table
+        self.threshold = threshold
+        self._refresh_lock = threading.Lock()
+
+    def index(self, db_session, message_id, value):
+        """Заменить полосы сообщения (в транзакции вызывающего)"""
+        self.remove(db_session, message_id)
+        rows = [{'message_id': message_id, 'band': band, 'bucket': bucket} for band, bucket in bands(value)]
+        if rows:
+            db_session.execute(insert(self.bands), rows)
+
+    def remove(self, db_session, message_id):
+        db_session.execute(delete(self.bands).where(self.bands.c.message_id == message_id))
+
+    def similar(self, db_session, value, exclude=None, limit=10):
+        """Похожие сообщения: [(сходство, id, текст)] по убыванию сходства"""
+        started = time.perf_counter()
+        keys = bands(value)
+        if not keys:
+            return []
+        message = self.messages.c
+        candidates = (select(self.bands.c.message_id)
+                      .where(or_(*(and_(self.bands.c.band == band, self.bands.c.bucket == bucket)
+                                   for band, bucket in keys)))
+                      .distinct())
+        if exclude is not None:
+            candidates = candidates.where(self.bands.c.message_id != exclude)
+        rows = db_session.execute(select(message.id, message.text).where(message.id.in_(candidates))).all()
+
+        items = shingles(value)
+        found = []
+        for row in rows:
+            score = similarity(items, shingles(row.text))
+            if score >= self.threshold:
+                found.append((score, row.id, row.text))
+        found.sort(key=lambda item: (-item[0], item[1]))
+        DEDUP_SECONDS.observe(time.perf_counter() - started, operation='similar')
+        return found[:limit]
+
+    def refresh(self, db_session):
+        """Проиндексировать сообщения без полос и убрать полосы удалённых; число проиндексированных"""
+        message = self.messages.c
+        # NOT EXISTS по первичному ключу полос: поиск по индексу для каждого сообщения
+        indexed = exists().where(self.bands.c.message_id == message.id)
+        db_session.execute(delete(self.bands).where(self.bands.c.message_id.not_in(select(message.id))))
+        total = 0
+        last_id = 0
+        while True:
+            # Порциями по id: текст всего банка не держится в памяти целиком
+            rows = db_session.execute(
+                select(message.id, message.text)
+                .where(message.id > last_id, ~indexed)
+                .order_by(message.id).limit(BATCH)).all()
+            if not rows:
+                break
+            batch = [{'message_id': row.id, 'band': band, 'bucket': bucket}
+                     for row in rows for band, bucket in bands(row.text)]
+            if batch:
+                db_session.execute(insert(self.bands), batch)
+            total += len(rows)
+            last_id = rows[-1].id
+        return total
+
+    def refresh_later(self, engine):
+        """refresh() в фоновом потоке: импорт не ждёт подписей десятков тысяч сообщений"""
+        def run():
+            # Один фоновый проход на процесс: второй нашёл бы те же сообщения
+            with self._refresh_lock, Session(engine) as session:
+                try:
+                    started = time.perf_counter()
+                    total = self.refresh(session)
+                    session.commit()
+                    log.info('Near-duplicate index: %d messages indexed in %.1fs',
+                             total, time.perf_counter() - started)
+                except Exception:
+                    log.exception('Near-duplicate index refresh failed')
+
+        threading.Thread(target=run, name='dedup-refresh', daemon=True).start()
+
+    def clusters(self, db_session):
+        """Группы почти дубликатов во всём банке: [[id, ...]] от больших к маленьким
+
+        Сообщения одной корзины полосы сравниваются с первым сообщением
+        корзины, а не попарно: группа из сотни копий даёт сотню проверок,
+        а не пять тысяч. Связи через разные корзины объединяют группы.
+        """
+        started = time.perf_counter()
+        band = self.bands.c
+        shared_buckets = (select(band.band, band.bucket)
+                          .group_by(band.band, band.bucket)
+                          .having(func.count() > 1)
+                          .subquery())
+        rows = db_session.execute(
+            select(band.band, band.bucket, band.message_id)
+            .join(shared_buckets, and_(band.band == shared_buckets.c.band,
+                                       band.bucket == shared_buckets.c.bucket))
+            .order_by(band.band, band.bucket, band.message_id)).all()
+
+        buckets = {}
+        for row in rows:
+            buckets.setdefault((row.band, row.bucket), []).append(row.message_id)
+        ids = {message_id for members in buckets.values() for message_id in members}
+        texts = {}
+        ids_list = sorted(ids)
+        for i in range(0, len(ids_list), BATCH):
+            chunk = ids_list[i:i + BATCH]
+            texts.update(db_session.execute(
+                select(self.messages.c.id, self.messages.c.text).where(self.messages.c.id.in_(chunk))).all())
+        items = {message_id: shingles(text) for message_id, text in texts.items()}
+
+        clusters = _Clusters()
+        checked = set()
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                if (first, other) in checked or first not in items or other not in items:
+                    continue
+                checked.add((first, other))
+                if clusters.find(first) == clusters.find(other):
+                    continue
+                if similarity(items[first], items[other]) >= self.threshold:
+                    clusters.union(first, other)
+        groups = sorted(clusters.groups(), key=lambda group: (-len(group), group[0]))
+        DEDUP_SECONDS.observe(time.perf_counter() - started, operation='clusters')
+        log.info('Near-duplicate report: %d clusters over %d candidates in %.2fs',
+                 len(groups), len(ids), time.perf_counter() - started)
+        return groups
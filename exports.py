@@ -0,0 +1,189 @@
+# ------------------------------------------------------------------
+# Потоковый экспорт: CSV, JSONL и msgpack, при необходимости со сжатием zstd
+#
+# Строки читаются из базы частями по CHUNK_ROWS (yield_per; в PostgreSQL
+# это серверный курсор) и отправляются клиенту по мере формирования.
+# Память процесса не зависит от размера выгрузки.
+# ------------------------------------------------------------------
+import csv
+import io
+import json
+import logging
+import time
+
+from flask import Response, stream_with_context
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger('fishchat.exports')
+
+EXPORT_ROWS = Counter(
+    'fishchat_export_rows_total',
+    'Строки, отданные потоковым экспортом',
+    ['export', 'format'],
+)
+EXPORT_SECONDS = Histogram(
+    'fishchat_export_seconds',
+    'Длительность потокового экспорта',
+    ['export'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+
+# Формат: (тип содержимого, расширение файла)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', '.csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', '.jsonl'),
+    # Первая запись — список колонок, далее каждая строка — список значений
+    'msgpack': ('application/x-msgpack', '.msgpack'),
+}
+COMPRESSIONS = ('zstd',)
+
+# Строк в одной выборке из курсора и примерный размер отправляемого фрагмента
+CHUNK_ROWS = 1000
+CHUNK_BYTES = 64 * 1024
+ZSTD_LEVEL = 3
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_options(args):
+    """Формат и сжатие из параметров запроса ?format=csv|jsonl&compress=zstd"""
+    fmt = args.get('format', 'csv')
+    if fmt not in FORMATS:
+        raise ExportError(f'Неизвестный формат: {fmt}')
+    compress = args.get('compress') or None
+    if compress is not None and compress not in COMPRESSIONS:
+        raise ExportError(f'Неизвестное сжатие: {compress}')
+    return fmt, compress
+
+
+def _jsonl_writer(buffer, columns, raw_json):
+    """Запись строки JSONL; колонки raw_json — готовый текст JSON из базы, вставляется как есть"""
+    if not raw_json:
+        return lambda row: buffer.write(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n')
+
+    plain = [(i, c) for i, c in enumerate(columns) if c not in raw_json]
+    raw = [(i, ', ' + json.dumps(c) + ': ') for i, c in enumerate(columns) if c in raw_json]
+
+    def write(row):
+        # Обычные колонки — одним json.dumps, готовый JSON дописывается перед закрывающей скобкой
+        head = json.dumps({c: row[i] for i, c in plain}, ensure_ascii=False, default=str)
+        buffer.write(head[:-1] + ''.join(key + (row[i] or 'null') for i, key in raw) + '}\n')
+    return write
+
+
+def _msgpack_chunks(rows, columns):
+    import msgpack
+
+    packer = msgpack.Packer(default=str)
+    buffer = io.BytesIO()
+    buffer.write(packer.pack(list(columns)))
+    for row in rows:
+        buffer.write(packer.pack(list(row)))
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode_rows(rows, columns, fmt, raw_json=()):
+    """Фрагменты файла (bytes) по CHUNK_BYTES"""
+    if fmt == 'msgpack':
+        # Колонки raw_json остаются строками JSON
+        yield from _msgpack_chunks(rows, columns)
+        return
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+        write = _jsonl_writer(buffer, columns, raw_json)
+
+    for row in rows:
+        write(row)
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def zstd_chunks(chunks, level=ZSTD_LEVEL):
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def query_rows(db_session, statement):
+    """Строки запроса, читаемые из базы частями по CHUNK_ROWS (без обработки строк ORM)
+
+    База выбирается сессией (школа, реплика) сразу, а запрос выполняется
+    уже при отправке ответа в собственном соединении: сессия запроса
+    закрывается при завершении контекста приложения, не дожидаясь конца
+    потока, и серверный курсор PostgreSQL закрылся бы вместе с ней.
+    """
+    engine = db_session.get_bind(clause=statement)
+
+    def rows():
+        with engine.connect() as conn:
+            yield from conn.execute(statement.execution_options(yield_per=CHUNK_ROWS))
+    return rows()
+
+
+def stream(name, rows, columns, fmt='csv', compress=None, filename=None, raw_json=()):
+    """Ответ, формирующий файл экспорта по мере чтения строк
+
+    raw_json — колонки, выбранные из базы текстом JSON (CAST AS TEXT):
+    в CSV они попадают как есть, в JSONL — как вложенные значения,
+    без разбора и повторной сериализации каждой строки.
+    """
+    mimetype, extension = FORMATS[fmt]
+    filename = (filename or name) + extension
+    if compress == 'zstd':
+        mimetype = 'application/zstd'
+        filename += '.zst'
+
+    counted = {'rows': 0}
+
+    def counting(rows):
+        for row in rows:
+            counted['rows'] += 1
+            yield row
+
+    def generate():
+        started = time.perf_counter()
+        chunks = encode_rows(counting(rows), columns, fmt, raw_json)
+        if compress == 'zstd':
+            chunks = zstd_chunks(chunks)
+        try:
+            yield from chunks
+        except Exception:
+            # Заголовки уже отправлены: обрываем файл, клиент получит неполную выгрузку
+            log.exception('export %s failed after %d rows', name, counted['rows'])
+            raise
+        finally:
+            EXPORT_ROWS.inc(counted['rows'], export=name, format=fmt)
+            EXPORT_SECONDS.observe(time.perf_counter() - started, export=name)
+            log.info('export %s: %d rows in %.1fs', name, counted['rows'], time.perf_counter() - started)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            # Прокси не должен накапливать ответ целиком
+            'X-Accel-Buffering': 'no',
+        },
+    )
@@ -0,0 +1,269 @@
+# ------------------------------------------------------------------
+# Генератор синтетических данных для нагрузочных тестов и бенчмарков
+#
+#   python gen_data.py --db bench/data/large.db --results 1000000
+#   python gen_data.py --db /tmp/bitset.db --answers bitset   # ответы масками, как RESULT_ANSWERS=bitset
+#
+# Заполняет пустую базу (или пересоздаёт её с --reset) сообщениями,
+# учениками, учителями, группами, уроками, тестированиями и результатами.
+# Все вставки пакетные, поэтому миллион результатов строится за секунды.
+# ------------------------------------------------------------------
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+SCAM_TEMPLATES = [
+    'Ваша банковская карта {card} заблокирована. Для разблокировки перейдите по ссылке {link} и введите данные карты.',
+    'Поздравляем! Вы выиграли {prize} в розыгрыше {shop}. Чтобы получить приз, оплатите доставку {price} ₽: {link}',
+    'Служба безопасности банка: по вашему счёту замечена подозрительная операция на {price} ₽. Назовите код из СМС.',
+    'Ваша посылка {track} задержана на таможне. Оплатите пошлину {price} ₽ по ссылке {link}, иначе она вернётся отправителю.',
+    'Мама, я потерял телефон, пишу с чужого номера. Срочно переведи {price} ₽ на карту {card}, потом всё объясню.',
+    'Госуслуги: вам положена компенсация {price} ₽. Подтвердите получение по ссылке {link} до конца дня.',
+    'Ваш аккаунт {shop} будет удалён через 24 часа. Подтвердите логин и пароль: {link}',
+    'Инвестиционный проект: вложите {price} ₽ сегодня и получите доход 30% в неделю. Подробности: {link}',
+]
+LEGIT_TEMPLATES = [
+    'Ваш заказ {track} в {shop} передан в службу доставки. Отследить его можно в личном кабинете.',
+    'Код для входа в {shop}: {code}. Никому не сообщайте этот код, даже сотрудникам магазина.',
+    'Списание {price} ₽ по карте *{last4} в {shop}. Если это были не вы, позвоните по номеру на обороте карты.',
+    'Напоминаем: завтра в {hour}:00 родительское собрание в актовом зале школы.',
+    'Посылка {track} прибыла в пункт выдачи. Срок хранения — 7 дней.',
+    'Зачисление {price} ₽ на счёт *{last4}. Баланс доступен в приложении банка.',
+    'Ваша запись к врачу подтверждена на {hour}:30. Для отмены ответьте на это сообщение.',
+    'Урок информатики перенесён на {hour}:00, кабинет 21. Возьмите с собой тетради.',
+]
+SHOPS = ['Озон', 'Вайлдберриз', 'Яндекс Маркет', 'Мегамаркет', 'Спортмастер', 'ДНС']
+PRIZES = ['iPhone 15', 'ноутбук', 'сертификат на 50 000 ₽', 'автомобиль', 'путёвку на море']
+DOMAINS = ['secure-bank24.ru', 'pochta-oplata.com', 'gosuslugi-pay.net', 'prize-win.club', 'account-verify.info']
+
+
+def fill(template, rng):
+    return template.format(
+        card='*' + str(rng.randint(1000, 9999)),
+        last4=rng.randint(1000, 9999),
+        link='https://' + rng.choice(DOMAINS) + '/' + ''.join(rng.choices('abcdefghjkmnpqrstuvwxyz0123456789', k=6)),
+        prize=rng.choice(PRIZES),
+        shop=rng.choice(SHOPS),
+        price=rng.choice([99, 299, 499, 1500, 4999, 15000, 49900]),
+        track='RU' + str(rng.randint(10 ** 8, 10 ** 9 - 1)),
+        code=rng.randint(100000, 999999),
+        hour=rng.randint(8, 19),
+    )
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Заполнить базу синтетическими данными')
+    parser.add_argument('--db', required=True, help='путь к файлу SQLite или URL базы')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=5000, help='учеников')
+    parser.add_argument('--teachers', type=int, default=20)
+    parser.add_argument('--class-size', type=int, default=25, help='средний размер группы')
+    parser.add_argument('--lessons', type=int, default=200)
+    parser.add_argument('--testings', type=int, default=300, help='минимум тестирований')
+    parser.add_argument('--results', type=int, default=100000)
+    parser.add_argument('--answers', choices=('json', 'bitset'), default='json',
+                        help='запись ответов результатов: списки id или маски (RESULT_ANSWERS)')
+    parser.add_argument('--accuracy', type=float, default=0.7, help='средняя доля верных ответов')
+    parser.add_argument('--password', default='password', help='пароль всех пользователей')
+    parser.add_argument('--batch', type=int, default=20000, help='строк в одной пакетной вставке')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reset', action='store_true', help='удалить существующие таблицы')
+    return parser.parse_args(argv)
+
+
+def database_url(value):
+    if '://' in value:
+        return value
+    return 'sqlite:///' + str(Path(value).resolve())
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+
+    # Приложение читает DATABASE_URL при импорте
+    os.environ['DATABASE_URL'] = database_url(args.db)
+    if os.environ['DATABASE_URL'].startswith('sqlite:///'):
+        Path(os.environ['DATABASE_URL'][len('sqlite:///'):]).parent.mkdir(parents=True, exist_ok=True)
+
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from app import app, db, Message, User, Group, Lesson, Testing, Result, ResultLayout
+    import bitsets
+    import storage
+
+    started = time.perf_counter()
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        elif db.session.query(Message.id).first() or db.session.query(User.id).first():
+            sys.exit('База не пуста: используйте --reset или укажите другой файл')
+
+        connection = db.session.connection()
+        if connection.dialect.name == 'sqlite':
+            # Только на время генерации: надёжность записи здесь не нужна
+            connection.exec_driver_sql('PRAGMA synchronous=OFF')
+            connection.exec_driver_sql('PRAGMA journal_mode=MEMORY')
+
+        def bulk(model, rows):
+            count = 0
+            for batch in batched(rows, args.batch):
+                db.session.execute(insert(model.__table__), batch)
+                count += len(batch)
+            return count
+
+        # Сообщения: примерно поровну мошеннических и обычных
+        messages = []
+        for message_id in range(1, args.messages + 1):
+            scam = rng.random() < 0.5
+            messages.append({
+                'id': message_id,
+                'text': fill(rng.choice(SCAM_TEMPLATES if scam else LEGIT_TEMPLATES), rng),
+                'correct': scam,
+                'price_correct': float(rng.choice([1, 1, 2, 3])),
+                'price_wrong': float(rng.choice([0, -1, -1, -2])),
+                'comment_yes': 'Верно! Обратите внимание на ссылку и срочность.' if scam else 'Верно! Это обычное уведомление.',
+                'comment_no': 'Неверно: это мошенничество.' if scam else 'Неверно: сообщение безопасно.',
+            })
+        bulk(Message, messages)
+        message_ids = [m['id'] for m in messages]
+        del messages
+
+        # Пользователи: один хеш пароля на всех, иначе хеширование займёт минуты
+        password_hash = generate_password_hash(args.password)
+        users = [{'id': 1, 'username': 'admin', 'password_hash': password_hash, 'privileges': 2}]
+        for i in range(args.teachers):
+            users.append({'id': len(users) + 1, 'username': f'teacher_{i + 1:04d}',
+                          'password_hash': password_hash, 'privileges': 1})
+        first_student = len(users) + 1
+        for i in range(args.users):
+            users.append({'id': first_student + i, 'username': f'student_{i + 1:07d}',
+                          'password_hash': password_hash, 'privileges': 0})
+        bulk(User, users)
+        student_ids = list(range(first_student, first_student + args.users))
+        del users
+
+        # Группы: размер ~ N(class_size, class_size/5); 10% учеников ещё и во второй группе
+        groups = []
+        shuffled = student_ids[:]
+        rng.shuffle(shuffled)
+        position = 0
+        while position < len(shuffled):
+            size = max(5, int(rng.gauss(args.class_size, args.class_size / 5)))
+            groups.append(shuffled[position:position + size])
+            position += size
+        for student in rng.sample(student_ids, len(student_ids) // 10):
+            rng.choice(groups).append(student)
+        bulk(Group, ({'id': i + 1, 'groupname': f'Класс {i + 1:05d}', 'users': members}
+                     for i, members in enumerate(groups)))
+
+        # Уроки: 10–30 вопросов, типичные цены
+        lessons = []
+        for i in range(args.lessons):
+            count = min(rng.choice([10, 15, 20, 20, 25, 30]), len(message_ids))
+            price_correct, price_wrong = rng.choice([(1, -1), (1, 0), (2, -1), (3, -2), (5, -2)])
+            lessons.append({
+                'id': i + 1,
+                'name': f'Урок {i + 1:05d}',
+                'time': rng.choice([0, 10, 15, 20, 30]),
+                'price_correct': price_correct,
+                'price_wrong': price_wrong,
+                'questions': rng.sample(range(len(message_ids)), count),
+            })
+        bulk(Lesson, ({**lesson, 'questions': [message_ids[q] for q in lesson['questions']]}
+                      for lesson in lessons))
+
+        # Маски ответов: раскладка — вопросы урока по порядку, одна на одинаковые списки
+        layouts = {}
+        if args.answers == 'bitset':
+            for lesson in lessons:
+                questions = [message_ids[q] for q in lesson['questions']]
+                digest = bitsets.layout_digest(questions)
+                layouts.setdefault(digest, {'id': len(layouts) + 1, 'digest': digest, 'questions': questions})
+                lesson['layout_id'] = layouts[digest]['id']
+            bulk(ResultLayout, layouts.values())
+
+        # Умение ученика ~ Beta со средним accuracy
+        concentration = 8.0
+        skill = {s: rng.betavariate(args.accuracy * concentration, (1 - args.accuracy) * concentration)
+                 for s in student_ids}
+
+        # Тестирования создаются, пока не набрано нужное число результатов
+        def make_results():
+            testing_id = 0
+            produced = 0
+            while produced < args.results or testing_id < args.testings:
+                testing_id += 1
+                lesson = rng.choice(lessons)
+                n_groups = rng.choices([1, 2, 3, 4, 5], weights=[60, 25, 8, 4, 3])[0]
+                group_ids = rng.sample(range(1, len(groups) + 1), min(n_groups, len(groups)))
+                testings.append({
+                    'id': testing_id,
+                    'name': f'Тестирование {testing_id:06d}',
+                    'status': rng.random() < 0.2,
+                    'lesson_id': lesson['id'],
+                    'group_id': group_ids,
+                })
+                if produced >= args.results:
+                    continue
+
+                members = {u for g in group_ids for u in groups[g - 1]}
+                for user_id in members:
+                    if produced >= args.results:
+                        break
+                    if rng.random() > 0.85:  # не прошёл тестирование
+                        continue
+                    p = skill[user_id]
+                    correct_ids, wrong_ids = [], []
+                    for q in lesson['questions']:
+                        if rng.random() < 0.05:  # пропущенный вопрос
+                            continue
+                        (correct_ids if rng.random() < p else wrong_ids).append(message_ids[q])
+                    produced += 1
+                    row = {
+                        'testing_id': testing_id,
+                        'lesson_id': lesson['id'],
+                        'user_id': user_id,
+                        'score': len(correct_ids) * lesson['price_correct'] + len(wrong_ids) * lesson['price_wrong'],
+                        'correct_answers_id': correct_ids,
+                        'wrong_answers_id': wrong_ids,
+                        'layout_id': None,
+                        'answers': None,
+                    }
+                    if args.answers == 'bitset':
+                        questions = layouts_by_id[lesson['layout_id']]
+                        row.update(layout_id=lesson['layout_id'], correct_answers_id=[], wrong_answers_id=[],
+                                   answers=bitsets.pack(questions, correct_ids, wrong_ids))
+                    yield row
+
+        layouts_by_id = {layout['id']: layout['questions'] for layout in layouts.values()}
+        testings = []
+        results_count = bulk(Result, make_results())
+        bulk(Testing, testings)
+
+        # Вставки шли с явными id: на PostgreSQL последовательности нужно продвинуть
+        storage.reset_sequences(connection, db.metadata.sorted_tables)
+        db.session.commit()
+
+    elapsed = time.perf_counter() - started
+    print(f'{os.environ["DATABASE_URL"]}: {len(message_ids)} messages, {len(student_ids)} students, '
+          f'{args.teachers} teachers, {len(groups)} groups, {len(lessons)} lessons, '
+          f'{len(testings)} testings, {results_count} results ({args.answers}) in {elapsed:.1f}s')
+
+
+if __name__ == '__main__':
+    generate(parse_args())
@@ -0,0 +1,290 @@
+# ------------------------------------------------------------------
+# Импорт банка вопросов из файлов экспорта: CSV, JSONL или msgpack,
+# при необходимости со сжатием zstd (например, messages_export.msgpack.zst)
+#
+# Файл читается потоком: записи проверяются по одной и вставляются
+# пакетами по BATCH_ROWS одним executemany. Весь импорт — одна
+# транзакция: ошибка в любой записи отменяет его целиком, и в банке
+# не остаётся половины файла. id из файла не используются — у базы
+# школы свои id. Сообщения, уже лежащие в банке или повторяющиеся
+# в файле (совпадают текст, тип ответа и комментарии), пропускаются.
+# ------------------------------------------------------------------
+import csv
+import hashlib
+import io
+import json
+import logging
+import math
+import time
+
+from sqlalchemy import insert, select
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger('fishchat.imports')
+
+IMPORT_ROWS = Counter(
+    'fishchat_import_rows_total',
+    'Записи импорта банка вопросов: добавленные и пропущенные дубликаты',
+    ['result'],
+)
+IMPORT_SECONDS = Histogram(
+    'fishchat_import_seconds',
+    'Длительность импорта банка вопросов',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+
+FORMATS = ('csv', 'jsonl', 'msgpack')
+COMPRESSIONS = ('zstd',)
+BATCH_ROWS = 1000
+MAX_TEXT_LENGTH = 10000
+
+_TRUE = {'1', 'true', 'yes', 'да', 'фейк', 'fake'}
+_FALSE = {'0', 'false', 'no', 'нет', 'реальная', 'real'}
+
+
+class ImportDataError(ValueError):
+    pass
+
+
+def parse_options(filename, fmt=None, compress=None):
+    """Формат и сжатие: явно заданные или по имени файла (bank.jsonl.zst)"""
+    name = (filename or '').lower()
+    if compress is None and name.endswith(('.zst', '.zstd')):
+        compress = 'zstd'
+        name = name.rsplit('.', 1)[0]
+    if not fmt:
+        fmt = name.rsplit('.', 1)[-1] if '.' in name else ''
+        fmt = {'ndjson': 'jsonl', 'mpk': 'msgpack'}.get(fmt, fmt)
+    if fmt not in FORMATS:
+        raise ImportDataError(f'Неизвестный формат файла: {fmt or filename}')
+    if compress and compress not in COMPRESSIONS:
+        raise ImportDataError(f'Неизвестное сжатие: {compress}')
+    return fmt, compress or None
+
+
+def read_records(binary, fmt, compress=None):
+    """(номер записи, dict) из двоичного потока файла"""
+    if compress == 'zstd':
+        binary = io.BufferedReader(_ZstdReader(binary))
+
+    if fmt == 'msgpack':
+        yield from _msgpack_records(binary)
+        return
+    text = io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(text)
+            try:
+                if not reader.fieldnames or 'text' not in reader.fieldnames:
+                    raise ImportDataError('В первой строке CSV нет колонки text (разделитель — запятая)')
+                for row in reader:
+                    yield reader.line_num, row
+            except csv.Error as e:
+                raise ImportDataError(f'Строка {reader.line_num}: повреждённый CSV ({e})') from e
+        else:
+            for number, line in enumerate(text, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ImportDataError(f'Строка {number}: не JSON ({e})') from e
+                if not isinstance(record, dict):
+                    raise ImportDataError(f'Строка {number}: ожидается объект JSON')
+                yield number, record
+    except UnicodeDecodeError as e:
+        raise ImportDataError('Файл не в кодировке UTF-8') from e
+    finally:
+        text.detach()
+
+
+def _msgpack_records(binary):
+    """Первая запись экспорта — список колонок, далее строки-списки; записи-словари тоже принимаются"""
+    import msgpack
+
+    binary = _CountingReader(binary)
+    unpacker = msgpack.Unpacker(binary, raw=False)
+    columns = None
+    try:
+        for number, item in enumerate(unpacker, 1):
+            if isinstance(item, dict):
+                yield number, item
+            elif columns is None and isinstance(item, list) and all(isinstance(c, str) for c in item):
+                columns = item
+            elif isinstance(item, list) and columns is not None:
+                yield number, dict(zip(columns, item))
+            else:
+                raise ImportDataError(f'Запись {number}: нет заголовка с именами колонок')
+    except ImportDataError:
+        raise
+    except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError, ValueError) as e:
+        raise ImportDataError(f'Повреждённый файл msgpack: {str(e) or type(e).__name__}') from e
+    # Unpacker молча останавливается на неполной последней записи
+    if unpacker.tell() != binary.count:
+        raise ImportDataError('Повреждённый файл msgpack: файл обрывается посреди записи')
+
+
+class _CountingReader:
+    """Сколько байт прочитано из потока"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        return data
+
+
+class _ZstdReader(io.RawIOBase):
+    """Распаковка zstd потоком, кадр за кадром
+
+    stream_reader zstandard на оборванном кадре просто заканчивает поток,
+    а мусор вместо сжатых данных даёт ZstdError: здесь оба случая — ImportDataError.
+    """
+    CHUNK = 1 << 17
+
+    def __init__(self, raw):
+        import zstandard
+        self._zstd = zstandard
+        self._context = zstandard.ZstdDecompressor()
+        self._raw = raw
+        self._frame = None
+        self._pending = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._pending):
+            data = self._raw.read(self.CHUNK)
+            if not data:
+                if self._frame is not None:
+                    raise ImportDataError('Повреждённый файл zstd: файл обрывается посреди кадра')
+                return 0
+            self._pending, self._offset = self._decompress(data), 0
+        size = min(len(buffer), len(self._pending) - self._offset)
+        buffer[:size] = self._pending[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def _decompress(self, data):
+        out = []
+        while data:
+            if self._frame is None:
+                self._frame = self._context.decompressobj()
+            try:
+                out.append(self._frame.decompress(data))
+            except self._zstd.ZstdError as e:
+                raise ImportDataError(f'Повреждённый файл zstd: {e}') from e
+            if not self._frame.eof:
+                break
+            # Следующий кадр начинается в хвосте прочитанного блока
+            data = self._frame.unused_data
+            self._frame = None
+        return b''.join(out)
+
+
+def _boolean(value, number):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    text = str(value if value is not None else '').strip().lower()
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+    raise ImportDataError(f'Запись {number}: correct должно быть true/false, а не {value!r}')
+
+
+def _number(value, name, number):
+    if value is None or value == '':
+        return 0.0
+    try:
+        result = float(value)
+    except (TypeError, ValueError):
+        raise ImportDataError(f'Запись {number}: {name} — не число ({value!r})') from None
+    if not math.isfinite(result):
+        raise ImportDataError(f'Запись {number}: {name} — не число ({value!r})')
+    return result
+
+
+def _comment(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def clean(record, number):
+    """Проверенная запись: text, correct, price_correct, price_wrong, comment_yes, comment_no"""
+    text = record.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ImportDataError(f'Запись {number}: пустой текст сообщения')
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ImportDataError(f'Запись {number}: текст длиннее {MAX_TEXT_LENGTH} символов')
+    if 'correct' not in record:
+        raise ImportDataError(f'Запись {number}: нет поля correct')
+    return {
+        'text': text.strip(),
+        'correct': _boolean(record['correct'], number),
+        'price_correct': _number(record.get('price_correct'), 'price_correct', number),
+        'price_wrong': _number(record.get('price_wrong'), 'price_wrong', number),
+        'comment_yes': _comment(record.get('comment_yes')),
+        'comment_no': _comment(record.get('comment_no')),
+    }
+
+
+def content_hash(text, correct, comment_yes, comment_no):
+    """Ключ совпадения сообщений: текст, тип ответа и комментарии (цены не учитываются)"""
+    payload = json.dumps([text.strip(), bool(correct), (comment_yes or '').strip(), (comment_no or '').strip()],
+                         ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+
+
+def import_messages(db_session, table, binary, fmt, compress=None):
+    """Добавить сообщения из файла в транзакции сессии; фиксирует транзакцию вызывающий
+
+    При ImportDataError вызывающий откатывает транзакцию.
+    """
+    started = time.perf_counter()
+    report = ImportReport()
+    c = table.c
+    # Ключи банка: 16 байт на сообщение, 50 тысяч сообщений — около 4 МБ
+    seen = {content_hash(*row) for row in db_session.execute(
+        select(c.text, c.correct, c.comment_yes, c.comment_no).execution_options(yield_per=BATCH_ROWS))}
+
+    batch = []
+    for number, record in read_records(binary, fmt, compress):
+        values = clean(record, number)
+        key = content_hash(values['text'], values['correct'], values['comment_yes'], values['comment_no'])
+        if key in seen:
+            report.duplicates += 1
+            continue
+        seen.add(key)
+        batch.append(values)
+        if len(batch) >= BATCH_ROWS:
+            db_session.execute(insert(table), batch)
+            report.inserted += len(batch)
+            batch = []
+    if batch:
+        db_session.execute(insert(table), batch)
+        report.inserted += len(batch)
+
+    report.seconds = time.perf_counter() - started
+    IMPORT_ROWS.inc(report.inserted, result='inserted')
+    IMPORT_ROWS.inc(report.duplicates, result='duplicate')
+    IMPORT_SECONDS.observe(report.seconds)
+    log.info('Question bank import: %d inserted, %d duplicates in %.1fs',
+             report.inserted, report.duplicates, report.seconds)
+    return report
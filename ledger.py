@@ -0,0 +1,189 @@
+# ------------------------------------------------------------------
+# Журнал опыта (XP) и рейтинги
+#
+# Каждое начисление опыта — строка журнала xp_event, который только
+# дополняется: ответы тренировки, балл тестирования, разница баллов
+# после пересчёта результата, перенос баллов старых результатов.
+# Итог пользователя в xp_total меняется на величину события одним
+# INSERT ... ON CONFLICT DO UPDATE (SQLite и PostgreSQL) — история
+# для итога не суммируется.
+#
+# Рейтинг узла (Leaderboard) — отсортированный список (-опыт, id)
+# пользователей с опытом: первые k мест — срез, место пользователя —
+# двоичный поиск, O(log n). Список читается из xp_total по убыванию
+# опыта (индекс ix_xp_total_rank) раз в LEADERBOARD_TTL и правится на
+# месте при начислениях этого узла; начисления других узлов видны
+# после очередного чтения. Рейтинг группы — её участники в порядке
+# тех же итогов.
+# ------------------------------------------------------------------
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from metrics import Counter
+
+XP_EVENTS = Counter(
+    'fishchat_xp_events_total',
+    'События журнала опыта',
+    ['source'],
+)
+
+# Источники событий журнала
+SOURCES = ('train', 'test', 'rescore', 'backfill')
+
+_UPSERT = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+class LedgerError(ValueError):
+    pass
+
+
+class Ledger:
+    """Журнал событий event_table и итоги пользователей total_table"""
+    def __init__(self, event_table, total_table):
+        self.events = event_table
+        self.totals = total_table
+
+    def _upsert(self, db_session):
+        dialect = db_session.get_bind().dialect.name
+        if dialect not in _UPSERT:
+            raise LedgerError(f'Итоги опыта не поддерживают базу {dialect}')
+        c = self.totals.c
+        statement = _UPSERT[dialect](self.totals)
+        return statement.on_conflict_do_update(
+            index_elements=[c.user_id],
+            set_={'total': c.total + statement.excluded.total,
+                  'events': c.events + statement.excluded.events},
+        ).returning(c.user_id, c.total)
+
+    def record(self, db_session, entries):
+        """Записать события [(id пользователя, опыт, источник, id результата)] в транзакции сессии
+
+        Возвращает {id пользователя: новый итог}; фиксирует вызывающий код.
+        Нулевые начисления не записываются.
+        """
+        entries = [entry for entry in entries if entry[1]]
+        if not entries:
+            return {}
+        deltas = {}
+        for user_id, amount, source, result_id in entries:
+            if source not in SOURCES:
+                raise LedgerError(f'Неизвестный источник опыта: {source}')
+            total, count = deltas.get(user_id, (0, 0))
+            deltas[user_id] = (total + amount, count + 1)
+        db_session.execute(insert(self.events), [
+            {'user_id': user_id, 'amount': amount, 'source': source, 'result_id': result_id}
+            for user_id, amount, source, result_id in entries])
+        rows = db_session.execute(self._upsert(db_session), [
+            {'user_id': user_id, 'total': total, 'events': count}
+            for user_id, (total, count) in deltas.items()]).all()
+        for _, _, source, _ in entries:
+            XP_EVENTS.inc(source=source)
+        return {row.user_id: row.total for row in rows}
+
+    def backfill(self, db_session, result_table):
+        """Перенести в пустой журнал баллы сохранённых результатов: одно событие на пользователя"""
+        if db_session.execute(select(self.events.c.id).limit(1)).first() is not None:
+            return 0
+        r = result_table.c
+        rows = db_session.execute(select(r.user_id, func.sum(r.score)).group_by(r.user_id)).all()
+        return len(self.record(db_session, [(user_id, score, 'backfill', None) for user_id, score in rows]))
+
+
+class Leaderboard:
+    """Рейтинг по итогам loader() — [(id пользователя, опыт)]
+
+    Прочитанный список хранится ttl секунд; clear() (в том числе с шины
+    инвалидации bus под именем name) заставляет прочитать его заново.
+    """
+    def __init__(self, name, loader, ttl=60, bus=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.bus = bus
+        self._lock = threading.Lock()
+        # [(-опыт, id)] по возрастанию — места по порядку; {id: опыт}
+        self._entries = None
+        self._totals = {}
+        self._loaded_at = None
+        self._generation = 0
+        if bus is not None:
+            bus.register(name, self.clear)
+
+    def _standings(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                return self._entries, self._totals
+            generation = self._generation
+        totals = dict(self.loader())
+        # Строки уже по убыванию опыта: сортировка почти упорядоченного списка — O(n)
+        entries = sorted((-total, user_id) for user_id, total in totals.items())
+        with self._lock:
+            # Начисление или очистка во время чтения: прочитанное могло устареть, не сохраняем
+            if generation == self._generation:
+                self._entries, self._totals, self._loaded_at = entries, totals, now
+        return entries, totals
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries = None
+            self._totals = {}
+            self._loaded_at = None
+
+    def invalidate(self):
+        """Прочитать рейтинг заново на всех узлах (или только здесь, если шины нет)"""
+        if self.bus is not None:
+            self.bus.invalidate(self.name)
+        else:
+            self.clear()
+
+    def update(self, totals):
+        """Новые итоги {id: опыт} после зафиксированных начислений этого узла"""
+        if not totals:
+            return
+        with self._lock:
+            self._generation += 1
+            if self._entries is None:
+                return
+            for user_id, total in totals.items():
+                old = self._totals.get(user_id)
+                if old is not None:
+                    position = bisect_left(self._entries, (-old, user_id))
+                    if position < len(self._entries) and self._entries[position] == (-old, user_id):
+                        del self._entries[position]
+                insort(self._entries, (-total, user_id))
+                self._totals[user_id] = total
+
+    def _ordered(self, members):
+        """(места, итоги): все пользователи с опытом или только участники members
+
+        Общий список правится на месте — читать его под self._lock.
+        """
+        entries, totals = self._standings()
+        if members is None:
+            return entries, totals
+        with self._lock:
+            return sorted((-totals[user_id], user_id) for user_id in set(members) if user_id in totals), totals
+
+    def top(self, k, members=None):
+        """Первые k мест: [(место, id, опыт)]"""
+        entries, _ = self._ordered(members)
+        with self._lock:
+            head = entries[:k]
+        return [(place, user_id, -total) for place, (total, user_id) in enumerate(head, 1)]
+
+    def rank(self, user_id, members=None):
+        """(место, опыт, мест в рейтинге) пользователя; None, если опыта у него нет"""
+        if members is not None and user_id not in members:
+            return None
+        entries, totals = self._ordered(members)
+        with self._lock:
+            total = totals.get(user_id)
+            if total is None:
+                return None
+            return bisect_left(entries, (-total, user_id)) + 1, total, len(entries)
@@ -0,0 +1,327 @@
+# ------------------------------------------------------------------
+# Нагрузочная симуляция урока: ученики одновременно проходят тестирование
+#
+#   python gen_data.py --db bench/data/load.db --users 500
+#   DATABASE_URL=sqlite:///bench/data/load.db python app.py
+#   python loadsim.py --url http://127.0.0.1:5000 --students 100 --ramp-up 30
+#
+# Каждый виртуальный ученик со своей сессией (cookie) входит в систему,
+# открывает test_room_preview, начинает тестирование, отвечает на все
+# вопросы и открывает test_room_result. Между шагами — время на раздумье.
+# С --teachers учителя параллельно обновляют страницу результатов.
+# Отчёт: p50/p95/p99 по шагам, доля ошибок и время записи в базу
+# (с ожиданием блокировок SQLite) по метрикам сервера.
+#
+# Каждое пройденное тестирование сохраняет результат: запускайте
+# симуляцию на базе из gen_data.py, а не на рабочей.
+# ------------------------------------------------------------------
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+STEPS = ['login', 'preview', 'start', 'question', 'answer', 'result', 'analytics']
+
+# Страница аналитики, которую учителя обновляют во время урока
+ANALYTICS_PATH = '/dashboard/testing_management/result_list'
+
+TESTING_LINK = re.compile(r'/test_room/(\d+)/0')
+METRIC_LINE = re.compile(r'^(\w+)(\{[^}]*\})?\s+(\S+)$')
+
+
+class Journey:
+    """Путь одного ученика по уроку"""
+    def __init__(self, sim, username):
+        self.sim = sim
+        self.username = username
+        self.http = requests.Session()
+        self.rng = random.Random(f'{sim.args.seed}:{username}')
+
+    def think(self):
+        low, high = self.sim.args.think
+        time.sleep(self.rng.uniform(low, high))
+
+    def request(self, step, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.sim.args.url + path, allow_redirects=False,
+                                         timeout=self.sim.args.timeout, **kwargs)
+            error = None if response.status_code < 400 else f'HTTP {response.status_code}'
+        except requests.RequestException as e:
+            response, error = None, type(e).__name__
+        self.sim.record(step, time.perf_counter() - started, error)
+        if error:
+            raise JourneyFailed(step, error)
+        return response
+
+    def fail(self, step, error):
+        self.sim.record_error(step, error)
+        raise JourneyFailed(step, error)
+
+    def login(self):
+        data = {'username': self.username, 'password': self.sim.args.password}
+        if self.sim.args.tenant:
+            data['tenant'] = self.sim.args.tenant
+        response = self.request('login', 'POST', '/login', data=data)
+        if not response.is_redirect:
+            self.fail('login', 'неверный логин или пароль')
+
+    def run(self):
+        args = self.sim.args
+        self.login()
+        self.think()
+
+        preview = self.request('preview', 'GET', '/test_room_preview')
+        testing_id = args.testing
+        if testing_id is None:
+            available = TESTING_LINK.findall(preview.text)
+            if not available:
+                self.fail('preview', 'нет доступных тестирований')
+            testing_id = int(available[0])
+        self.think()
+
+        self.request('start', 'GET', f'/test_room/{testing_id}/0')
+        step = 0
+        while step < args.max_questions:
+            self.think()
+            response = self.request('answer', 'POST', f'/test_room/{testing_id}/{step}',
+                                    data={'answer': self.rng.choice(['yes', 'no'])})
+            location = response.headers.get('Location', '')
+            if 'test_room_result' in location:
+                break
+            step += 1
+            self.request('question', 'GET', f'/test_room/{testing_id}/{step}')
+
+        self.request('result', 'GET', '/test_room_result')
+
+
+class TeacherJourney(Journey):
+    """Учитель обновляет аналитику, пока ученики проходят тестирование"""
+    def run(self):
+        self.login()
+        while not self.sim.students_done.is_set():
+            self.think()
+            self.request('analytics', 'GET', ANALYTICS_PATH)
+
+
+class JourneyFailed(Exception):
+    def __init__(self, step, error):
+        super().__init__(f'{step}: {error}')
+        self.step = step
+        self.error = error
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self._lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.completed = 0
+        self.failed = 0
+        self.students_done = threading.Event()
+
+    def record(self, step, seconds, error):
+        with self._lock:
+            self.timings[step].append(seconds)
+            if error:
+                self.errors[step][error] += 1
+
+    def record_error(self, step, error):
+        with self._lock:
+            self.errors[step][error] += 1
+
+    def _student(self, username):
+        try:
+            Journey(self, username).run()
+            with self._lock:
+                self.completed += 1
+        except JourneyFailed:
+            with self._lock:
+                self.failed += 1
+
+    def _teacher(self, username):
+        try:
+            TeacherJourney(self, username).run()
+        except JourneyFailed:
+            pass
+
+    def run(self):
+        args = self.args
+        usernames = [args.username.format(args.first + i) for i in range(args.students)]
+        delay = args.ramp_up / max(len(usernames) - 1, 1)
+
+        before = scrape_metrics(args.url)
+        started = time.perf_counter()
+        teachers = []
+        for i in range(args.teachers):
+            thread = threading.Thread(target=self._teacher, args=(args.teacher_username.format(1 + i),),
+                                      daemon=True)
+            thread.start()
+            teachers.append(thread)
+        threads = []
+        for i, username in enumerate(usernames):
+            thread = threading.Thread(target=self._student, args=(username,), daemon=True)
+            thread.start()
+            threads.append(thread)
+            if i < len(usernames) - 1:
+                time.sleep(delay)
+        for thread in threads:
+            thread.join()
+        self.students_done.set()
+        for thread in teachers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        after = scrape_metrics(args.url)
+
+        return self.report(elapsed, before, after)
+
+    def report(self, elapsed, before, after):
+        steps = {}
+        total_requests = total_errors = 0
+        for step in STEPS:
+            timings = sorted(self.timings.get(step, []))
+            if not timings:
+                continue
+            errors = sum(self.errors[step].values())
+            total_requests += len(timings)
+            total_errors += errors
+            steps[step] = {
+                'requests': len(timings),
+                'errors': errors,
+                'error_rate': round(errors / len(timings), 4),
+                'error_kinds': dict(self.errors[step]),
+                'p50_ms': percentile_ms(timings, 50),
+                'p95_ms': percentile_ms(timings, 95),
+                'p99_ms': percentile_ms(timings, 99),
+                'max_ms': round(timings[-1] * 1000, 1),
+            }
+
+        return {
+            'meta': {
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'url': self.args.url,
+                'students': self.args.students,
+                'teachers': self.args.teachers,
+                'ramp_up_s': self.args.ramp_up,
+                'think_s': self.args.think,
+            },
+            'elapsed_s': round(elapsed, 1),
+            'journeys': {'completed': self.completed, 'failed': self.failed},
+            'requests': total_requests,
+            'throughput_rps': round(total_requests / elapsed, 1) if elapsed else 0,
+            'error_rate': round(total_errors / total_requests, 4) if total_requests else 0,
+            'steps': steps,
+            'database': database_delta(before, after),
+        }
+
+
+def percentile_ms(ordered, p):
+    """Процентиль по ближайшему рангу, миллисекунды"""
+    index = max(0, min(len(ordered) - 1, -(-len(ordered) * p // 100) - 1))
+    return round(ordered[int(index)] * 1000, 1)
+
+
+# ------------------------------------------------------------------
+# Метрики сервера: время записи и ошибки блокировки за время прогона
+# ------------------------------------------------------------------
+def scrape_metrics(url):
+    """Значения fishchat_db_* из /metrics: {(имя, метки): значение}"""
+    try:
+        text = requests.get(url + '/metrics', timeout=10).text
+    except requests.RequestException:
+        return None
+    values = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match and match.group(1).startswith('fishchat_db_') and '_bucket' not in match.group(1):
+            values[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return values
+
+
+def database_delta(before, after):
+    if before is None or after is None:
+        return None
+    delta = {'write': {}, 'lock_errors': 0}
+    for (name, labels), value in after.items():
+        diff = value - before.get((name, labels), 0.0)
+        if name == 'fishchat_db_lock_errors_total':
+            delta['lock_errors'] += int(diff)
+            continue
+        kind = re.search(r'kind="([^"]*)"', labels)
+        if not kind:
+            continue
+        entry = delta['write'].setdefault(kind.group(1), {'count': 0, 'total_ms': 0.0})
+        if name.endswith('_count'):
+            entry['count'] = int(diff)
+        elif name.endswith('_sum'):
+            entry['total_ms'] = round(diff * 1000, 1)
+    for entry in delta['write'].values():
+        entry['avg_ms'] = round(entry['total_ms'] / entry['count'], 2) if entry['count'] else 0.0
+    return delta
+
+
+def print_report(report):
+    print(f'{report["meta"]["students"]} students, {report["elapsed_s"]} s, '
+          f'{report["requests"]} requests, {report["throughput_rps"]} req/s, '
+          f'journeys ok/failed: {report["journeys"]["completed"]}/{report["journeys"]["failed"]}')
+    print(f'\n{"step":<10}{"requests":>10}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for step, row in report['steps'].items():
+        print(f'{step:<10}{row["requests"]:>10}{row["errors"]:>8}{row["p50_ms"]:>10}'
+              f'{row["p95_ms"]:>10}{row["p99_ms"]:>10}{row["max_ms"]:>10}')
+        for error, count in row['error_kinds'].items():
+            print(f'{"":<10}{error}: {count}')
+
+    database = report['database']
+    if database is None:
+        print('\n/metrics недоступен: время записи в базу не измерено')
+        return
+    print(f'\n{"db write":<10}{"count":>10}{"total ms":>12}{"avg ms":>10}')
+    for kind, row in sorted(database['write'].items()):
+        print(f'{kind:<10}{row["count"]:>10}{row["total_ms"]:>12}{row["avg_ms"]:>10}')
+    print(f'database is locked: {database["lock_errors"]}')
+
+
+def think_range(value):
+    low, _, high = value.partition(',')
+    return float(low), float(high or low)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочная симуляция урока')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--username', default='student_{:07d}', help='шаблон логина учеников')
+    parser.add_argument('--first', type=int, default=1, help='номер первого ученика')
+    parser.add_argument('--teachers', type=int, default=0, help='учителей, обновляющих аналитику во время урока')
+    parser.add_argument('--teacher-username', default='teacher_{:04d}', help='шаблон логина учителей')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--tenant', help='школа при входе (если она не определяется по хосту)')
+    parser.add_argument('--testing', type=int, help='ID тестирования (по умолчанию первое доступное ученику)')
+    parser.add_argument('--ramp-up', type=float, default=10.0, help='секунд на запуск всех учеников')
+    parser.add_argument('--think', type=think_range, default=(1.0, 3.0), help='раздумье, секунд: "min,max"')
+    parser.add_argument('--max-questions', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='сохранить отчёт в JSON')
+    args = parser.parse_args(argv)
+    args.url = args.url.rstrip('/')
+
+    report = Simulation(args).run()
+    print_report(report)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding='utf-8')
+    return 1 if report['error_rate'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
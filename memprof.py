@@ -0,0 +1,194 @@
+# ------------------------------------------------------------------
+# Профилирование памяти (tracemalloc): снимки, утечки, пики маршрутов
+# ------------------------------------------------------------------
+import linecache
+import logging
+import os
+import threading
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+from flask import g, request
+
+log = logging.getLogger('fishchat.memprof')
+
+# Служебные аллокации самого профилировщика в отчёт не попадают
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def current_rss():
+    """Resident set size процесса в байтах (Linux) или None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryProfiler:
+    def __init__(self, interval=300, frames=10, keep=4, history=288, top=25):
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.baseline = None
+        self.snapshots = deque(maxlen=keep)
+        self.history = deque(maxlen=history)
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        # start/stop; не self._lock — start снимает первый снимок под ним
+        self._control = threading.Lock()
+        # У каждого потока снимков своё событие остановки: быстрый stop/start не оживит старый поток
+        self._stop = None
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    # --------------------------------------------------------------
+    # Включение/выключение без перезапуска
+    # --------------------------------------------------------------
+    def start(self):
+        with self._control:
+            if self.enabled:
+                return
+            tracemalloc.start(self.frames)
+            self.baseline = None
+            self.snapshots.clear()
+            self.endpoints.clear()
+            self.take_snapshot()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), name='memprof', daemon=True)
+            self._thread.start()
+        log.info('memory profiling started, interval=%ss frames=%s', self.interval, self.frames)
+
+    def stop(self):
+        with self._control:
+            if not self.enabled:
+                return
+            self._stop.set()
+            tracemalloc.stop()
+            with self._lock:
+                self.baseline = None
+                self.snapshots.clear()
+            thread, self._thread = self._thread, None
+        # Снимок, начатый до остановки, завершится быстро: tracemalloc уже выключен
+        thread.join()
+        log.info('memory profiling stopped')
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.take_snapshot()
+            except Exception:
+                log.exception('memory snapshot failed')
+
+    # --------------------------------------------------------------
+    # Снимки
+    # --------------------------------------------------------------
+    def take_snapshot(self):
+        if not self.enabled:
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'current': current,
+            'peak': peak,
+            'rss': current_rss(),
+        }
+        with self._lock:
+            if self.baseline is None:
+                self.baseline = (entry, snapshot)
+            self.snapshots.append((entry, snapshot))
+            self.history.append(entry)
+        return entry
+
+    @staticmethod
+    def _format_stats(stats, limit):
+        rows = []
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            rows.append({
+                'site': f'{frame.filename}:{frame.lineno}',
+                'line': linecache.getline(frame.filename, frame.lineno).strip(),
+                'size': stat.size,
+                'size_diff': getattr(stat, 'size_diff', stat.size),
+                'count': stat.count,
+                'count_diff': getattr(stat, 'count_diff', stat.count),
+                'traceback': [f'{f.filename}:{f.lineno}' for f in stat.traceback],
+            })
+        return rows
+
+    def report(self, key_type='lineno'):
+        """Топ мест аллокации: сейчас, прирост с прошлого снимка и с начала"""
+        with self._lock:
+            snapshots = list(self.snapshots)
+            baseline = self.baseline
+        if not snapshots:
+            return {'top': [], 'since_previous': [], 'since_baseline': []}
+
+        latest = snapshots[-1][1]
+        report = {
+            'top': self._format_stats(latest.statistics(key_type), self.top),
+            'since_previous': [],
+            'since_baseline': [],
+        }
+        if len(snapshots) > 1:
+            report['since_previous'] = self._format_stats(
+                latest.compare_to(snapshots[-2][1], key_type), self.top)
+        if baseline and baseline[1] is not latest:
+            report['since_baseline'] = self._format_stats(
+                latest.compare_to(baseline[1], key_type), self.top)
+        return report
+
+    # --------------------------------------------------------------
+    # Память по маршрутам. Пик tracemalloc общий для процесса, поэтому
+    # при параллельных запросах значения приблизительные
+    # --------------------------------------------------------------
+    def request_started(self):
+        if self.enabled:
+            tracemalloc.reset_peak()
+            g.memprof_start = tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, endpoint):
+        start = g.pop('memprof_start', None)
+        if start is None or not self.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'count': 0, 'peak_max': 0, 'peak_sum': 0, 'retained_sum': 0,
+            })
+            stats['count'] += 1
+            stats['peak_max'] = max(stats['peak_max'], peak - start)
+            stats['peak_sum'] += peak - start
+            stats['retained_sum'] += current - start
+
+    def endpoint_report(self):
+        with self._lock:
+            rows = [dict(stats, endpoint=endpoint,
+                         peak_avg=stats['peak_sum'] / stats['count'],
+                         retained_avg=stats['retained_sum'] / stats['count'])
+                    for endpoint, stats in self.endpoints.items()]
+        return sorted(rows, key=lambda r: r['peak_max'], reverse=True)
+
+
+def init_app(app, profiler):
+    if os.environ.get('MEMPROFILE') == '1':
+        profiler.start()
+
+    @app.before_request
+    def _memprof_start():
+        profiler.request_started()
+
+    @app.teardown_request
+    def _memprof_finish(exc):
+        profiler.request_finished(request.endpoint or 'unknown')
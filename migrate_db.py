@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------
+# Перенос данных из app.db в другую базу (обычно PostgreSQL)
+#
+#   python migrate_db.py --target postgresql://fishchat:secret@db/fishchat
+#   python migrate_db.py --source app.db --target postgresql://... --reset
+#
+# Схема в целевой базе создаётся моделями приложения, строки копируются
+# пакетами с сохранением id, затем последовательности id продвигаются
+# до максимальных значений, и количество строк сверяется по таблицам.
+# ------------------------------------------------------------------
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, func, insert, inspect, select
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Перенести данные из SQLite в другую базу')
+    parser.add_argument('--source', default=str(Path(__file__).parent.joinpath('app.db')),
+                        help='путь к файлу SQLite или URL исходной базы')
+    parser.add_argument('--target', required=True, help='URL целевой базы')
+    parser.add_argument('--batch', type=int, default=5000, help='строк в одной пакетной вставке')
+    parser.add_argument('--reset', action='store_true', help='удалить существующие таблицы в целевой базе')
+    return parser.parse_args(argv)
+
+
+def source_url(value):
+    if '://' in value:
+        return value
+    return 'sqlite:///' + str(Path(value).resolve())
+
+
+def migrate(args):
+    # Приложение читает DATABASE_URL при импорте и создаёт схему в целевой базе
+    os.environ['DATABASE_URL'] = args.target
+
+    from app import app, db
+    import storage
+
+    source = create_engine(storage.normalize_url(source_url(args.source)))
+    started = time.perf_counter()
+    with app.app_context():
+        tables = db.metadata.sorted_tables
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        else:
+            for table in tables:
+                if db.session.execute(select(table).limit(1)).first():
+                    sys.exit(f'Таблица {table.name} в целевой базе не пуста: используйте --reset')
+
+        target = db.session.connection()
+        with source.connect() as src:
+            for table in tables:
+                if not source.dialect.has_table(src, table.name):
+                    print(f'{table.name}: нет в исходной базе, пропущена')
+                    continue
+                copied = 0
+                # Столбцы, добавленные моделям позже, в старой базе могут отсутствовать
+                present = {column['name'] for column in inspect(src).get_columns(table.name)}
+                columns = [column for column in table.columns if column.name in present]
+                rows = src.execute(select(*columns).order_by(*table.primary_key.columns)).mappings()
+                while batch := rows.fetchmany(args.batch):
+                    target.execute(insert(table), [dict(row) for row in batch])
+                    copied += len(batch)
+                expected = src.execute(select(func.count()).select_from(table)).scalar()
+                actual = target.execute(select(func.count()).select_from(table)).scalar()
+                if actual != expected:
+                    db.session.rollback()
+                    sys.exit(f'{table.name}: скопировано {actual} строк из {expected}, изменения отменены')
+                print(f'{table.name}: {copied}')
+
+        storage.reset_sequences(target, tables)
+        db.session.commit()
+        target_url = db.engine.url.render_as_string(hide_password=True)
+
+    print(f'{source.url.render_as_string(hide_password=True)} -> {target_url} '
+          f'in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    migrate(parse_args())
@@ -0,0 +1,130 @@
+# ------------------------------------------------------------------
+# Перевод ответов результатов между списками id (JSON) и битовыми
+# масками по раскладке вопросов (bitsets.py)
+#
+#   python migrate_results.py                          # JSON -> маски
+#   python migrate_results.py --to json                # маски -> JSON
+#   python migrate_results.py --database postgresql://fishchat:secret@db/school1 --vacuum
+#
+# Раскладка результата — вопросы его урока по порядку; ответы на
+# вопросы, которых в уроке уже нет, дописываются в конец раскладки.
+# Каждая порция — своя транзакция: прерванный перевод продолжается
+# повторным запуском. Новые результаты приложение пишет в формате
+# RESULT_ANSWERS — задайте его таким же, как --to.
+# ------------------------------------------------------------------
+import argparse
+import os
+import time
+
+from sqlalchemy import Text, bindparam, cast, func, select, text, update
+
+import bitsets
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Перевести ответы результатов в маски или обратно')
+    parser.add_argument('--database', help='URL базы (по умолчанию DATABASE_URL приложения)')
+    parser.add_argument('--to', choices=('bitset', 'json'), default='bitset', help='формат ответов')
+    parser.add_argument('--batch', type=int, default=1000, help='результатов в одной транзакции')
+    parser.add_argument('--vacuum', action='store_true', help='SQLite: сжать файл базы после перевода')
+    return parser.parse_args(argv)
+
+
+def layout_for(lesson_questions, correct_ids, wrong_ids):
+    """Вопросы урока и, в конце, вопросы ответов, которых в уроке уже нет"""
+    questions = list(lesson_questions or ())
+    known = set(questions)
+    for mid in list(correct_ids or ()) + list(wrong_ids or ()):
+        if mid not in known:
+            known.add(mid)
+            questions.append(mid)
+    return questions
+
+
+def answers_size(db_session, Result):
+    """(байт в списках JSON, байт в масках) по всем результатам"""
+    return db_session.execute(select(
+        func.coalesce(func.sum(func.length(cast(Result.correct_answers_id, Text))
+                               + func.length(cast(Result.wrong_answers_id, Text))), 0),
+        func.coalesce(func.sum(func.length(Result.answers)), 0))).one()
+
+
+def to_bitset(db_session, Result, Lesson, layouts, batch):
+    lessons = dict(db_session.execute(select(Lesson.id, Lesson.questions)).all())
+    statement = (update(Result.__table__).where(Result.id == bindparam('result_id'))
+                 .values(layout_id=bindparam('layout'), answers=bindparam('masks'),
+                         correct_answers_id=[], wrong_answers_id=[]))
+    converted = 0
+    last_id = 0
+    while True:
+        rows = db_session.execute(
+            select(Result.id, Result.lesson_id, Result.correct_answers_id, Result.wrong_answers_id)
+            .where(Result.answers.is_(None), Result.id > last_id)
+            .order_by(Result.id).limit(batch)).all()
+        if not rows:
+            return converted
+        last_id = rows[-1].id
+        updates = []
+        for row in rows:
+            questions = layout_for(lessons.get(row.lesson_id), row.correct_answers_id, row.wrong_answers_id)
+            updates.append({'result_id': row.id, 'layout': layouts.ensure(db_session, questions),
+                            'masks': bitsets.pack(questions, row.correct_answers_id, row.wrong_answers_id)})
+        db_session.execute(statement, updates)
+        db_session.commit()
+        converted += len(rows)
+        print(f'{converted} results', end='\r', flush=True)
+
+
+def to_json(db_session, Result, layouts, engine, batch):
+    statement = (update(Result.__table__).where(Result.id == bindparam('result_id'))
+                 .values(correct_answers_id=bindparam('correct'), wrong_answers_id=bindparam('wrong'),
+                         layout_id=None, answers=None))
+    converted = 0
+    while True:
+        # Переведённые строки выходят из условия, поэтому каждая порция — с начала
+        rows = db_session.execute(
+            select(Result.id, Result.layout_id, Result.answers)
+            .where(Result.answers.is_not(None))
+            .order_by(Result.id).limit(batch)).all()
+        if not rows:
+            return converted
+        layouts.preload(engine, {row.layout_id for row in rows})
+        updates = []
+        for row in rows:
+            correct_ids, wrong_ids = bitsets.unpack(layouts.questions(engine, row.layout_id), row.answers)
+            updates.append({'result_id': row.id, 'correct': correct_ids, 'wrong': wrong_ids})
+        db_session.execute(statement, updates)
+        db_session.commit()
+        converted += len(rows)
+        print(f'{converted} results', end='\r', flush=True)
+
+
+def migrate(args):
+    if args.database:
+        # Приложение читает DATABASE_URL при импорте и добавляет недостающие столбцы
+        os.environ['DATABASE_URL'] = args.database
+
+    from app import app, db, Lesson, Result, result_layouts
+
+    started = time.perf_counter()
+    with app.app_context():
+        engine = db.engine
+        before = answers_size(db.session, Result)
+        layouts = result_layouts.current()
+        if args.to == 'bitset':
+            converted = to_bitset(db.session, Result, Lesson, layouts, args.batch)
+        else:
+            converted = to_json(db.session, Result, layouts, engine, args.batch)
+        after = answers_size(db.session, Result)
+        db.session.close()
+        if args.vacuum and engine.dialect.name == 'sqlite':
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM'))
+        target = engine.url.render_as_string(hide_password=True)
+
+    print(f'{target}: {converted} results -> {args.to} in {time.perf_counter() - started:.1f}s')
+    print(f'answers: JSON {before[0]} -> {after[0]} bytes, masks {before[1]} -> {after[1]} bytes')
+
+
+if __name__ == '__main__':
+    migrate(parse_args())
@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------
+# Мониторинг: задержки маршрутов, SQL, шаблоны, размер сессии
+# ------------------------------------------------------------------
+import threading
+import time
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from flask.sessions import SecureCookieSessionInterface
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from metrics import Counter, Histogram
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377)
+BYTES_BUCKETS = (128, 256, 512, 1024, 2048, 3072, 4096, 8192)
+
+HTTP_REQUESTS = Counter(
+    'fishchat_http_requests_total',
+    'HTTP-запросы по маршрутам',
+    ['endpoint', 'method', 'status'],
+)
+HTTP_SECONDS = Histogram(
+    'fishchat_http_request_seconds',
+    'Длительность обработки запроса',
+    ['endpoint'],
+)
+SQL_QUERIES = Histogram(
+    'fishchat_sql_queries_per_request',
+    'Количество SQL-запросов на один HTTP-запрос',
+    ['endpoint'],
+    buckets=COUNT_BUCKETS,
+)
+SQL_SECONDS = Histogram(
+    'fishchat_sql_seconds_per_request',
+    'Время в SQL на один HTTP-запрос',
+    ['endpoint'],
+)
+DB_WRITE_SECONDS = Histogram(
+    'fishchat_db_write_seconds',
+    'Время записи в базу, включая ожидание блокировки',
+    ['kind'],
+)
+DB_LOCK_ERRORS = Counter(
+    'fishchat_db_lock_errors_total',
+    'Ошибки "database is locked"',
+)
+TEMPLATE_SECONDS = Histogram(
+    'fishchat_template_render_seconds',
+    'Время рендеринга шаблонов',
+    ['template'],
+)
+SESSION_COOKIE_BYTES = Histogram(
+    'fishchat_session_cookie_bytes',
+    'Размер cookie сессии',
+    buckets=BYTES_BUCKETS,
+)
+
+
+# ------------------------------------------------------------------
+# SQL: счётчик запросов и времени в рамках HTTP-запроса
+# ------------------------------------------------------------------
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    kind = statement.lstrip()[:6].lower()
+    if kind in WRITE_KINDS:
+        DB_WRITE_SECONDS.observe(elapsed, kind=kind)
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # Старт запроса, завершившегося ошибкой, остаётся в стеке
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+    if 'database is locked' in str(context.original_exception):
+        DB_LOCK_ERRORS.inc()
+
+
+# ------------------------------------------------------------------
+# Запись: время коммита сессии. В SQLite писатель ждёт блокировку
+# (busy_timeout) внутри INSERT/UPDATE/DELETE и на COMMIT, поэтому
+# рост этих гистограмм под нагрузкой — это ожидание блокировок
+# ------------------------------------------------------------------
+WRITE_KINDS = ('insert', 'update', 'delete')
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    session.info['commit_start'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    started = session.info.pop('commit_start', None)
+    if started is not None:
+        DB_WRITE_SECONDS.observe(time.perf_counter() - started, kind='commit')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('commit_start', None)
+
+
+# ------------------------------------------------------------------
+# Шаблоны: время рендеринга (с учётом вложенных render_template)
+# ------------------------------------------------------------------
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and g.get('template_starts'):
+        elapsed = time.perf_counter() - g.template_starts.pop()
+        TEMPLATE_SECONDS.observe(elapsed, template=template.name or 'string')
+
+
+# ------------------------------------------------------------------
+# Сессия: размер cookie после сериализации
+# ------------------------------------------------------------------
+class MeasuredSessionInterface(SecureCookieSessionInterface):
+    def save_session(self, app, session, response):
+        super().save_session(app, session, response)
+        cookie_name = self.get_cookie_name(app) + '='
+        for header in response.headers.getlist('Set-Cookie'):
+            if header.startswith(cookie_name):
+                SESSION_COOKIE_BYTES.observe(len(header.split(';', 1)[0]) - len(cookie_name))
+
+
+# ------------------------------------------------------------------
+# Кэшируемая проверка зависимостей для /health
+# ------------------------------------------------------------------
+class CachedProbe:
+    def __init__(self, probe, ttl):
+        self.probe = probe
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._result = None
+
+    def __call__(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.ttl:
+                started = time.perf_counter()
+                try:
+                    self.probe()
+                    self._result = {'ok': True}
+                except Exception as e:
+                    self._result = {'ok': False, 'error': str(e)}
+                self._result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+                self._checked_at = now
+            return dict(self._result, age_s=round(now - self._checked_at, 1))
+
+
+def init_app(app):
+    app.session_interface = MeasuredSessionInterface()
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+
+    @app.after_request
+    def _remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _observe_request(exc):
+        if 'request_start' not in g:
+            return
+        endpoint = request.endpoint or 'unknown'
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method,
+                          status=g.get('response_status', 500))
+        HTTP_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+        SQL_QUERIES.observe(g.sql_count, endpoint=endpoint)
+        SQL_SECONDS.observe(g.sql_time, endpoint=endpoint)
@@ -0,0 +1,147 @@
+# ------------------------------------------------------------------
+# Постраничная выборка по ключу (keyset) для списков панели управления
+#
+# Вместо OFFSET следующая страница начинается после последней строки
+# предыдущей: WHERE (sort, id) > (:last_sort, :last_id) ORDER BY sort, id
+# LIMIT n. Время запроса не зависит от номера страницы, а вставки и
+# удаления между запросами не сдвигают строки между страницами.
+#
+# Курсор — непрозрачная строка base64 с полем сортировки, направлением
+# и ключом последней строки; при смене сортировки он не применяется.
+# ------------------------------------------------------------------
+import base64
+import binascii
+import json
+
+from sqlalchemy import and_, or_, select
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Параметры запроса, которые не являются фильтрами
+RESERVED_ARGS = ('cursor', 'limit', 'sort', 'order')
+
+
+def encode_cursor(sort, order, value, row_id):
+    payload = json.dumps([sort, order, value, row_id], separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """[sort, order, value, id] или None для повреждённого курсора"""
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(value, list) or len(value) != 4:
+        return None
+    return value
+
+
+class Page:
+    def __init__(self, items, next_cursor, sort, order, filters, limit, first):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.sort = sort
+        self.order = order
+        self.filters = filters
+        self.limit = limit
+        # Первая страница (без курсора): ссылка «в начало» не нужна
+        self.first = first
+
+    def args(self, **extra):
+        """Параметры запроса текущего вида списка (для ссылок на страницы и сортировку)"""
+        args = dict(self.filters, sort=self.sort, order=self.order)
+        args.update(extra)
+        return {k: v for k, v in args.items() if v not in (None, '')}
+
+
+class ListSpec:
+    """Список модели: допустимые сортировки, фильтры и поиск по тексту
+
+    sorts   — {имя: колонка}; последним ключом всегда идёт id модели
+    filters — {параметр: функция(значение) -> условие или None}
+    search  — колонки для параметра q (поиск подстроки без учёта регистра)
+    """
+    def __init__(self, model, sorts, default_sort='id', default_order='asc',
+                 filters=None, search=(), serialize=None, columns=None):
+        self.model = model
+        self.sorts = sorts
+        self.default_sort = default_sort
+        self.default_order = default_order
+        self.filters = filters or {}
+        self.search = search
+        self.serialize = serialize
+        # Колонки для выборки без загрузки объектов ORM (например, без текста сообщений)
+        self.columns = columns
+
+    def statement(self, args, base=()):
+        """Запрос с фильтрами из args и активные фильтры {параметр: значение}"""
+        statement = select(*self.columns) if self.columns else select(self.model)
+        conditions = list(base)
+        active = {}
+        q = (args.get('q') or '').strip()
+        if q and self.search:
+            pattern = f'%{q}%'
+            conditions.append(or_(*(column.ilike(pattern) for column in self.search)))
+            active['q'] = q
+        for name, build in self.filters.items():
+            value = (args.get(name) or '').strip()
+            if not value:
+                continue
+            condition = build(value)
+            if condition is not None:
+                conditions.append(condition)
+                active[name] = value
+        if conditions:
+            statement = statement.where(and_(*conditions))
+        return statement, active
+
+    def page(self, db_session, args, base=()):
+        """Страница списка по параметрам cursor, limit, sort, order и фильтрам"""
+        sort = args.get('sort') if args.get('sort') in self.sorts else self.default_sort
+        order = args.get('order') if args.get('order') in ('asc', 'desc') else self.default_order
+        try:
+            limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            limit = DEFAULT_PAGE_SIZE
+
+        statement, active = self.statement(args, base)
+        column = self.sorts[sort]
+        pk = self.model.id
+        descending = order == 'desc'
+
+        cursor = decode_cursor(args.get('cursor') or '')
+        if cursor and cursor[0] == sort and cursor[1] == order:
+            _, _, value, row_id = cursor
+            if column is pk:
+                statement = statement.where(pk < row_id if descending else pk > row_id)
+            elif descending:
+                statement = statement.where(or_(column < value, and_(column == value, pk < row_id)))
+            else:
+                statement = statement.where(or_(column > value, and_(column == value, pk > row_id)))
+        else:
+            cursor = None
+
+        ordering = [column.desc(), pk.desc()] if descending else [column.asc(), pk.asc()]
+        if column is pk:
+            ordering = ordering[:1]
+        # Лишняя строка показывает, есть ли следующая страница, без COUNT(*)
+        rows = db_session.execute(statement.order_by(*ordering).limit(limit + 1))
+        items = list(rows.all() if self.columns else rows.scalars())
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            next_cursor = encode_cursor(sort, order, getattr(last, column.key), last.id)
+        return Page(items, next_cursor, sort, order, active, limit, first=cursor is None)
+
+    def to_json(self, page):
+        return {
+            'items': [self.serialize(item) for item in page.items],
+            'next_cursor': page.next_cursor,
+            'sort': page.sort,
+            'order': page.order,
+            'filters': page.filters,
+        }
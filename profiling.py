@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------
+# Профилирование отдельных запросов по требованию администратора
+# ------------------------------------------------------------------
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from flask import g, request, before_render_template, template_rendered
+
+import querylog
+
+log = logging.getLogger('fishchat.profiling')
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = '_profile'
+
+_PROFILE_ID = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+# cProfile с Python 3.12 один на процесс: одновременно профилируется один запрос,
+# остальные выполняются без профиля
+_busy = threading.Lock()
+
+
+class ProfileStore:
+    def __init__(self, directory, keep=50):
+        self.directory = Path(directory)
+        self.keep = keep
+
+    def _path(self, profile_id, suffix):
+        if not _PROFILE_ID.match(profile_id):
+            raise KeyError(profile_id)
+        return self.directory / f'{profile_id}{suffix}'
+
+    def save(self, profiler, meta):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profile_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+        meta['id'] = profile_id
+
+        profiler.dump_stats(self._path(profile_id, '.prof'))
+        self._path(profile_id, '.json').write_text(
+            json.dumps(meta, ensure_ascii=False), encoding='utf-8'
+        )
+        self._prune()
+        return profile_id
+
+    def _prune(self):
+        for old in self.list()[self.keep:]:
+            for suffix in ('.prof', '.json'):
+                self._path(old['id'], suffix).unlink(missing_ok=True)
+
+    def list(self):
+        if not self.directory.exists():
+            return []
+        profiles = []
+        for path in sorted(self.directory.glob('*.json'), reverse=True):
+            meta = json.loads(path.read_text(encoding='utf-8'))
+            meta.pop('sql', None)
+            meta.pop('templates', None)
+            profiles.append(meta)
+        return profiles
+
+    def load(self, profile_id):
+        path = self._path(profile_id, '.json')
+        if not path.exists():
+            raise KeyError(profile_id)
+        return json.loads(path.read_text(encoding='utf-8'))
+
+    def stats_path(self, profile_id):
+        path = self._path(profile_id, '.prof')
+        if not path.exists():
+            raise KeyError(profile_id)
+        return path
+
+    def stats_text(self, profile_id, sort='cumulative', limit=60):
+        out = io.StringIO()
+        stats = pstats.Stats(str(self.stats_path(profile_id)), stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+def _profile_requested():
+    return (request.headers.get(PROFILE_HEADER) == '1'
+            or request.args.get(PROFILE_PARAM) == '1')
+
+
+def _before_render(sender, template, context, **extra):
+    if 'profile' in g:
+        g.profile['template_starts'].append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if 'profile' in g and g.profile['template_starts']:
+        started = g.profile['template_starts'].pop()
+        g.profile['templates'].append({
+            'template': template.name or 'string',
+            'offset': started - g.profile['started'],
+            'duration': time.perf_counter() - started,
+        })
+
+
+def init_app(app, store, is_allowed):
+    """is_allowed() решает, можно ли профилировать текущий запрос"""
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def _start_profile():
+        if not _profile_requested():
+            return
+        try:
+            allowed = is_allowed()
+        except Exception:
+            allowed = False
+        if not allowed:
+            return
+
+        if not _busy.acquire(blocking=False):
+            log.info('profiler busy, %s %s not profiled', request.method, request.path)
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Профилировщик уже включён не нами (отладчик, py-spy в режиме sys.monitoring)
+            _busy.release()
+            log.warning('profiler unavailable: %s', e)
+            return
+
+        sql = querylog.record()
+        g.profile = {
+            'started': time.perf_counter(),
+            'profiler': profiler,
+            'sql': sql,
+            'recorder': sql.__enter__(),
+            'template_starts': [],
+            'templates': [],
+        }
+
+    def _stop(profile):
+        try:
+            profile['profiler'].disable()
+            profile['sql'].__exit__(None, None, None)
+        finally:
+            _busy.release()
+
+    @app.after_request
+    def _finish_profile(response):
+        profile = g.pop('profile', None)
+        if not profile:
+            return response
+        _stop(profile)
+        duration = time.perf_counter() - profile['started']
+
+        recorder = profile['recorder']
+        meta = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration': duration,
+            'sql_count': recorder.count,
+            'sql_time': recorder.total_time,
+            'template_time': sum(t['duration'] for t in profile['templates']),
+            'sql': recorder.queries,
+            'templates': profile['templates'],
+        }
+        try:
+            profile_id = store.save(profile['profiler'], meta)
+            response.headers['X-Profile-Id'] = profile_id
+            log.info('profiled %s %s in %.3fs id=%s', request.method, request.path,
+                     duration, profile_id)
+        except OSError as e:
+            log.error('failed to store profile: %s', e)
+        return response
+
+    @app.teardown_request
+    def _abort_profile(exc):
+        # Запрос завершился исключением до after_request — профиль не сохраняем
+        profile = g.pop('profile', None)
+        if profile:
+            _stop(profile)
@@ -0,0 +1,171 @@
+# ------------------------------------------------------------------
+# Журнал SQL-запросов: поиск N+1 и бюджеты запросов на маршрут
+# ------------------------------------------------------------------
+import logging
+import re
+import threading
+import time
+from collections import Counter as TallyCounter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Counter
+
+log = logging.getLogger('fishchat.querylog')
+
+# Сколько одинаковых по форме запросов за один HTTP-запрос считать N+1
+NPLUSONE_THRESHOLD = 5
+
+SQL_REPEATED = Counter(
+    'fishchat_sql_repeated_statements_total',
+    'Повторяющиеся однотипные SQL-запросы (подозрение на N+1)',
+    ['endpoint'],
+)
+SQL_BUDGET_EXCEEDED = Counter(
+    'fishchat_sql_budget_exceeded_total',
+    'Превышения бюджета SQL-запросов маршрута',
+    ['endpoint'],
+)
+
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)|\(\s*%\(\w+\)s(?:\s*,\s*%\(\w+\)s)*\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_SPACES = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement):
+    """Форма запроса без параметров: списки IN и числа схлопываются"""
+    shape = _IN_LIST.sub('(?)', statement)
+    shape = _NUMBER.sub('N', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+def query_budget(limit):
+    """Объявить максимальное число SQL-запросов для маршрута"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+
+    def add(self, statement, start, duration):
+        self.queries.append({
+            'statement': statement,
+            'offset': start - self.started,
+            'duration': duration,
+        })
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(q['duration'] for q in self.queries)
+
+    def repeated(self, threshold=NPLUSONE_THRESHOLD):
+        """Формы запросов, повторившиеся не менее threshold раз"""
+        shapes = TallyCounter(statement_shape(q['statement']) for q in self.queries)
+        return [(shape, n) for shape, n in shapes.most_common() if n >= threshold]
+
+
+# Активные записи на текущем потоке: HTTP-запрос и явные record()
+_local = threading.local()
+
+
+def _active():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+class record:
+    """Записать все SQL-запросы внутри блока with"""
+    def __enter__(self):
+        self.recorder = QueryRecorder()
+        _active().append(self.recorder)
+        return self.recorder
+
+    def __exit__(self, *exc):
+        _active().remove(self.recorder)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active():
+        conn.info.setdefault('querylog_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorders = _active()
+    starts = conn.info.get('querylog_start')
+    if not recorders or not starts:
+        return
+    start = starts.pop()
+    duration = time.perf_counter() - start
+    for recorder in recorders:
+        recorder.add(statement, start, duration)
+
+
+def init_app(app):
+    app.config.setdefault('QUERY_BUDGET_STRICT', False)
+    app.config.setdefault('NPLUSONE_THRESHOLD', NPLUSONE_THRESHOLD)
+
+    @app.before_request
+    def _start_query_log():
+        g.query_log = record()
+        g.query_log.__enter__()
+
+    def _check(recorder, endpoint, path, budget):
+        for shape, n in recorder.repeated(app.config['NPLUSONE_THRESHOLD']):
+            SQL_REPEATED.inc(n, endpoint=endpoint)
+            log.warning('N+1 suspected route=%s path=%s count=%d statement=%s',
+                        endpoint, path, n, shape)
+
+        if budget is not None and recorder.count > budget:
+            SQL_BUDGET_EXCEEDED.inc(endpoint=endpoint)
+            message = (f'route {endpoint} issued {recorder.count} SQL queries, '
+                       f'budget is {budget}')
+            if app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            log.warning(message)
+
+    def _after_stream(body, query_log, *check):
+        try:
+            yield from body
+        finally:
+            query_log.__exit__(None, None, None)
+        _check(query_log.recorder, *check)
+
+    @app.after_request
+    def _check_query_log(response):
+        query_log = g.get('query_log')
+        if not query_log:
+            return response
+        view = app.view_functions.get(request.endpoint)
+        check = (request.endpoint or 'unknown', request.path, getattr(view, 'query_budget', None))
+        if response.is_streamed:
+            # Потоковый ответ (stream_with_context) читает базу при отправке тела:
+            # запись и проверка продолжаются до конца потока
+            g.query_log_streamed = True
+            response.response = _after_stream(response.response, query_log, *check)
+            return response
+        _check(query_log.recorder, *check)
+        return response
+
+    @app.teardown_request
+    def _stop_query_log(exc):
+        query_log = g.pop('query_log', None)
+        if query_log and not g.pop('query_log_streamed', False):
+            query_log.__exit__(None, None, None)
@@ -0,0 +1,334 @@
+# ------------------------------------------------------------------
+# Пересчёт результатов после исправления ключа ответов или цен урока
+#
+# Результат хранит списки id сообщений, на которые участник ответил
+# правильно и неправильно, и балл. Балл — сумма цен урока:
+#   price_correct * len(correct_answers_id) + price_wrong * len(wrong_answers_id)
+#
+# Новые цены урока: балл по спискам считает сама база в запросе порции
+# (json_array_length есть в SQLite и PostgreSQL), по маскам ответов
+# (bitsets.py) — bitsets.totals сразу для всей порции.
+# Исправленный тип ответа сообщения: ответ участника на это сообщение
+# переходит из правильных в неправильные и наоборот — в списках или
+# в маске. Изменённые строки порции записываются одним executemany.
+#
+# Результаты выбираются по индексу ix_results_lesson_id порциями по BATCH
+# в порядке id, каждая порция — своя транзакция: пересчёт большого урока
+# не держит блокировку таблицы. Обработчик on_batch пишет связанные
+# изменения (журнал опыта) в транзакции порции. Пересчёт цен
+# идемпотентен — прерванный можно повторить, уже пересчитанные порции
+# не изменятся.
+# Результаты ищутся по урокам, которые сейчас содержат сообщение: ответы
+# из урока, откуда сообщение потом убрали, не пересчитываются.
+#
+# Архивные результаты (archive.py) пересчитываются после рабочей таблицы:
+# сегменты тестирований урока распаковываются по одному, изменённый
+# сегмент записывается заново вместе со сводкой тестирования, и каждый
+# такой сегмент — своя транзакция с on_batch.
+# ------------------------------------------------------------------
+import logging
+import time
+
+from sqlalchemy import bindparam, case, func, select, update
+
+import bitsets
+from archive import answer_counts
+from metrics import Counter, Histogram
+
+log = logging.getLogger('fishchat.rescoring')
+
+RESCORE_ROWS = Counter(
+    'fishchat_rescore_rows_total',
+    'Результаты, изменённые пересчётом',
+    ['reason'],
+)
+RESCORE_SECONDS = Histogram(
+    'fishchat_rescore_seconds',
+    'Длительность пересчёта результатов',
+    ['reason'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+
+# Результатов в одной транзакции пересчёта
+BATCH = 1000
+
+
+def _price(value, default):
+    """Цена урока как число: форма урока сохраняет цены строками"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+class RescoreReport:
+    def __init__(self):
+        self.checked = 0
+        self.changed = 0
+        self.lessons = 0
+        self.seconds = 0.0
+        # (id результата, id пользователя, старый балл, новый балл)
+        self.changes = []
+
+
+class Rescorer:
+    """Пересчёт таблицы результатов result_table по урокам lesson_table
+
+    layouts — bitsets.LayoutStore раскладок масок ответов, engine() —
+    база, из которой они читаются; archive — archive.ResultArchive,
+    архивные результаты которого пересчитываются вместе с рабочими.
+    """
+    def __init__(self, result_table, lesson_table, layouts, engine, archive=None):
+        self.results = result_table
+        self.lessons = lesson_table
+        self.layouts = layouts
+        self.engine = engine
+        self.archive = archive
+
+    def _score(self, price_correct, price_wrong):
+        """Балл результата при данных ценах — выражение SQL"""
+        r = self.results.c
+        return (price_correct * func.json_array_length(r.correct_answers_id)
+                + price_wrong * func.json_array_length(r.wrong_answers_id))
+
+    def _prices(self, db_session, lesson_id):
+        row = db_session.execute(select(self.lessons.c.price_correct, self.lessons.c.price_wrong)
+                                 .where(self.lessons.c.id == lesson_id)).first()
+        if row is None:
+            return None
+        return _price(row.price_correct, 1), _price(row.price_wrong, -1)
+
+    # ---------------------------------------------------------
+    # Архив
+    # ---------------------------------------------------------
+    def _archived(self, db_session, lessons, change):
+        """(id сегмента, строки, изменения) архивов уроков lessons ({id: цены})
+
+        change(строка, цены) — строка с новыми ответами и баллом или None;
+        в списке строк изменённые уже заменены новыми.
+        """
+        if self.archive is None or not lessons:
+            return
+        for segment_id, rows in self.archive.lesson_segments(db_session, lessons):
+            changes = []
+            for i, row in enumerate(rows):
+                prices = lessons.get(row['lesson_id'])
+                new = change(row, prices) if prices is not None else None
+                if new is not None:
+                    changes.append((row['id'], row['user_id'], row['score'], new['score']))
+                    rows[i] = new
+            yield segment_id, rows, changes
+
+    def _archived_preview(self, db_session, lessons, change):
+        """(архивных результатов уроков lessons, из них изменятся)"""
+        total = changed = 0
+        for _, rows, changes in self._archived(db_session, lessons, change):
+            total += sum(1 for row in rows if row['lesson_id'] in lessons)
+            changed += len(changes)
+        return total, changed
+
+    def _rescore_archived(self, db_session, lessons, change, on_batch, report):
+        for segment_id, rows, changes in self._archived(db_session, lessons, change):
+            report.checked += sum(1 for row in rows if row['lesson_id'] in lessons)
+            if not changes:
+                continue
+            self.archive.rewrite(db_session, segment_id, rows)
+            if on_batch is not None:
+                on_batch(db_session, changes)
+            report.changes.extend(changes)
+            report.changed += len(changes)
+            db_session.commit()
+
+    @staticmethod
+    def _archived_score(row, prices):
+        """Архивная строка с баллом по ценам prices; None, если балл не меняется"""
+        correct, wrong = answer_counts(row)
+        score = prices[0] * correct + prices[1] * wrong
+        return dict(row, score=score) if score != row['score'] else None
+
+    def _archived_flip(self, message_id):
+        """change для _archived: ответ на message_id оценивается наоборот"""
+        engine = self.engine()
+
+        def change(row, prices):
+            if row.get('answers') is not None:
+                masks = bitsets.flip(self.layouts.questions(engine, row['layout_id']), row['answers'], message_id)
+                if masks is None:
+                    return None
+                new = dict(row, answers=masks)
+            else:
+                correct = list(row.get('correct_answers_id') or ())
+                wrong = list(row.get('wrong_answers_id') or ())
+                if message_id in correct:
+                    correct, wrong = [mid for mid in correct if mid != message_id], wrong + [message_id]
+                elif message_id in wrong:
+                    correct, wrong = correct + [message_id], [mid for mid in wrong if mid != message_id]
+                else:
+                    return None
+                new = dict(row, correct_answers_id=correct, wrong_answers_id=wrong)
+            correct_count, wrong_count = answer_counts(new)
+            new['score'] = prices[0] * correct_count + prices[1] * wrong_count
+            return new
+        return change
+
+    # ---------------------------------------------------------
+    # Цены урока
+    # ---------------------------------------------------------
+    def _new_scores(self, rows, prices):
+        """Баллы строк порции: json_score из запроса или по маскам ответов"""
+        masked = [row.answers for row in rows if row.answers is not None]
+        correct, wrong = bitsets.totals(masked)
+        masked_scores = iter([prices[0] * c + prices[1] * w for c, w in zip(correct, wrong)])
+        return [row.json_score if row.answers is None else next(masked_scores) for row in rows]
+
+    def lesson_preview(self, db_session, lesson_id, price_correct, price_wrong):
+        """(результатов урока, из них изменят балл при ценах price_correct / price_wrong)"""
+        r = self.results.c
+        prices = _price(price_correct, 1), _price(price_wrong, -1)
+        score = self._score(*prices)
+        total, changed = db_session.execute(
+            select(func.count(), func.coalesce(func.sum(case((r.score != score, 1), else_=0)), 0))
+            .where(r.lesson_id == lesson_id, r.answers.is_(None))).one()
+        masked = db_session.execute(select(r.score, r.answers)
+                                    .where(r.lesson_id == lesson_id, r.answers.is_not(None))).all()
+        changed += sum(1 for row, new in zip(masked, self._new_scores(masked, prices)) if row.score != new)
+        archived_total, archived_changed = self._archived_preview(db_session, {lesson_id: prices},
+                                                                  self._archived_score)
+        return total + len(masked) + archived_total, changed + archived_changed
+
+    def rescore_lesson(self, db_session, lesson_id, on_batch=None):
+        """Пересчитать баллы результатов урока по его текущим ценам; фиксирует порции сам
+
+        on_batch(db_session, изменения порции) вызывается перед фиксацией
+        каждой порции с изменениями — записи в той же транзакции.
+        """
+        started = time.perf_counter()
+        report = RescoreReport()
+        prices = self._prices(db_session, lesson_id)
+        if prices is None:
+            return report
+        report.lessons = 1
+        r = self.results.c
+        score = self._score(*prices)
+        statement = update(self.results).where(r.id == bindparam('result_id')).values(score=bindparam('new_score'))
+        last_id = 0
+        while True:
+            rows = db_session.execute(
+                select(r.id, r.user_id, r.score, r.answers, score.label('json_score'))
+                .where(r.lesson_id == lesson_id, r.id > last_id)
+                .order_by(r.id).limit(BATCH)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            report.checked += len(rows)
+            changed = [(row, new) for row, new in zip(rows, self._new_scores(rows, prices)) if row.score != new]
+            if changed:
+                db_session.execute(statement, [{'result_id': row.id, 'new_score': new} for row, new in changed])
+                changes = [(row.id, row.user_id, row.score, new) for row, new in changed]
+                if on_batch is not None:
+                    on_batch(db_session, changes)
+                report.changes.extend(changes)
+                report.changed += len(changed)
+            db_session.commit()
+        self._rescore_archived(db_session, {lesson_id: prices}, self._archived_score, on_batch, report)
+        return self._finish(report, started, 'lesson_prices', f'lesson {lesson_id}')
+
+    # ---------------------------------------------------------
+    # Тип ответа сообщения
+    # ---------------------------------------------------------
+    def _lessons_with(self, db_session, message_id):
+        """{id урока: (цена правильного, цена неправильного)} уроков, содержащих сообщение"""
+        l = self.lessons.c
+        return {row.id: (_price(row.price_correct, 1), _price(row.price_wrong, -1))
+                for row in db_session.execute(select(l.id, l.questions, l.price_correct, l.price_wrong))
+                if message_id in (row.questions or ())}
+
+    def _answered(self, db_session, message_id, lesson_ids):
+        """Порции результатов уроков lesson_ids с ответом на сообщение: [(строка, маски с обратной оценкой)]
+
+        У результатов со списками вместо масок — None.
+        """
+        r = self.results.c
+        lesson_ids = sorted(lesson_ids)
+        engine = self.engine()
+        last_id = 0
+        while lesson_ids:
+            rows = db_session.execute(
+                select(r.id, r.lesson_id, r.user_id, r.score, r.correct_answers_id, r.wrong_answers_id,
+                       r.layout_id, r.answers)
+                .where(r.lesson_id.in_(lesson_ids), r.id > last_id)
+                .order_by(r.id).limit(BATCH)).all()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            self.layouts.preload(engine, {row.layout_id for row in rows})
+            answered = []
+            for row in rows:
+                if row.answers is not None:
+                    flipped = bitsets.flip(self.layouts.questions(engine, row.layout_id), row.answers, message_id)
+                    if flipped is not None:
+                        answered.append((row, flipped))
+                elif message_id in (row.correct_answers_id or ()) or message_id in (row.wrong_answers_id or ()):
+                    answered.append((row, None))
+            yield len(rows), answered
+
+    def message_preview(self, db_session, message_id):
+        """(уроков с сообщением, результатов с ответом на него) — изменятся при смене типа ответа"""
+        lessons = self._lessons_with(db_session, message_id)
+        answered = sum(len(rows) for _, rows in self._answered(db_session, message_id, lessons))
+        _, archived = self._archived_preview(db_session, lessons, self._archived_flip(message_id))
+        return len(lessons), answered + archived
+
+    def rescore_message(self, db_session, message_id, on_batch=None):
+        """Перенести ответы на сообщение между правильными и неправильными; фиксирует порции сам
+
+        Вызывается после смены типа ответа сообщения: ответ, совпадавший
+        со старым ключом, теперь неверный, и наоборот. on_batch — как
+        в rescore_lesson.
+        """
+        started = time.perf_counter()
+        report = RescoreReport()
+        lessons = self._lessons_with(db_session, message_id)
+        report.lessons = len(lessons)
+        r = self.results.c
+        statement = (update(self.results).where(r.id == bindparam('result_id'))
+                     .values(score=bindparam('new_score'), correct_answers_id=bindparam('correct'),
+                             wrong_answers_id=bindparam('wrong'), answers=bindparam('masks')))
+        # Список порции собирается целиком до записи: чтение идёт по id дальше записанного
+        for checked, rows in self._answered(db_session, message_id, lessons):
+            report.checked += checked
+            batch, changes = [], []
+            for row, masks in rows:
+                if masks is not None:
+                    correct, wrong = [], []
+                    correct_count, wrong_count = bitsets.counts(masks)
+                else:
+                    correct = [mid for mid in row.correct_answers_id or () if mid != message_id]
+                    wrong = [mid for mid in row.wrong_answers_id or () if mid != message_id]
+                    if message_id in (row.correct_answers_id or ()):
+                        wrong.append(message_id)
+                    else:
+                        correct.append(message_id)
+                    correct_count, wrong_count = len(correct), len(wrong)
+                price_correct, price_wrong = lessons[row.lesson_id]
+                new_score = price_correct * correct_count + price_wrong * wrong_count
+                batch.append({'result_id': row.id, 'new_score': new_score, 'correct': correct, 'wrong': wrong,
+                              'masks': masks})
+                changes.append((row.id, row.user_id, row.score, new_score))
+            if batch:
+                db_session.execute(statement, batch)
+                if on_batch is not None:
+                    on_batch(db_session, changes)
+                report.changes.extend(changes)
+                report.changed += len(batch)
+            db_session.commit()
+        self._rescore_archived(db_session, lessons, self._archived_flip(message_id), on_batch, report)
+        return self._finish(report, started, 'answer_key', f'message {message_id}')
+
+    def _finish(self, report, started, reason, subject):
+        report.seconds = time.perf_counter() - started
+        RESCORE_ROWS.inc(report.changed, reason=reason)
+        RESCORE_SECONDS.observe(report.seconds, reason=reason)
+        log.info('Rescored %s: %d of %d results changed in %.2fs',
+                 subject, report.changed, report.checked, report.seconds)
+        return report
@@ -0,0 +1,133 @@
+# ------------------------------------------------------------------
+# Случайный набор вопросов урока
+#
+# Вместо загрузки и перемешивания всего банка: id сообщений хранятся
+# двумя списками по типу ответа (фейк / реальная) и строятся один раз
+# на снимок банка вопросов. Набор из k вопросов выбирается случайными
+# позициями в этих списках — O(k) независимо от размера банка.
+#
+# Ограничения:
+#   fake_share — доля фейков в уроке (0..1); None — как получится
+#                при выборе из всего банка;
+#   exclude    — id, которые не должны попасть в урок (например,
+#                уже виденные группой в прошлых результатах);
+#   seed       — один и тот же seed на том же банке даёт тот же урок.
+# ------------------------------------------------------------------
+import random
+import threading
+
+# Попыток выбора на один вопрос, после которых доступные id
+# перечисляются явно: почти весь список исключён или уже выбран
+MAX_TRIES_PER_PICK = 4
+SEED_LIMIT = 2 ** 31
+
+
+class SampleError(ValueError):
+    pass
+
+
+class _Pool:
+    """Несколько списков id как один список без копирования"""
+    def __init__(self, *lists):
+        self.lists = [ids for ids in lists if ids]
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.lists)
+
+    def __getitem__(self, position):
+        for ids in self.lists:
+            if position < len(ids):
+                return ids[position]
+            position -= len(ids)
+        raise IndexError(position)
+
+    def __iter__(self):
+        for ids in self.lists:
+            yield from ids
+
+
+def _pick(rng, pool, count, exclude, chosen):
+    """count id из pool, которых нет в exclude и chosen; меньше, если доступных не хватает"""
+    size = len(pool)
+    picked = []
+    tries = MAX_TRIES_PER_PICK * count + 16
+    while len(picked) < count and tries > 0 and size:
+        tries -= 1
+        mid = pool[rng.randrange(size)]
+        if mid in exclude or mid in chosen:
+            continue
+        chosen.add(mid)
+        picked.append(mid)
+    if len(picked) < count:
+        # Случайные позиции почти всегда попадают в исключённые: выбираем из оставшихся явно
+        rest = [mid for mid in pool if mid not in exclude and mid not in chosen]
+        extra = rng.sample(rest, min(count - len(picked), len(rest)))
+        chosen.update(extra)
+        picked.extend(extra)
+    return picked
+
+
+class Sample:
+    def __init__(self, ids, fakes, seed, requested):
+        self.ids = ids
+        self.fakes = fakes
+        self.seed = seed
+        self.requested = requested
+
+    @property
+    def reals(self):
+        return len(self.ids) - self.fakes
+
+    @property
+    def short(self):
+        """Подходящих сообщений в банке меньше, чем запрошено"""
+        return len(self.ids) < self.requested
+
+
+class LessonSampler:
+    """Выбор вопросов урока по снимку банка bank_source() — {id: сообщение с полем correct}"""
+    def __init__(self, bank_source):
+        self.bank_source = bank_source
+        self._lock = threading.Lock()
+        # Последний снимок банка и его индекс по типу ответа
+        self._index = (None, None)
+
+    def snapshot(self):
+        """(снимок банка, {True: [id фейков], False: [id реальных]})"""
+        bank = self.bank_source()
+        cached = self._index
+        if cached[0] is bank:
+            return cached
+        # Новый снимок (правки банка, истёк ttl, другая школа) — один проход по id
+        index = {True: [], False: []}
+        for mid, message in bank.items():
+            index[bool(message.correct)].append(mid)
+        with self._lock:
+            self._index = (bank, index)
+        return bank, index
+
+    def sample(self, count, fake_share=None, exclude=(), seed=None):
+        """Sample: count случайных id с долей фейков fake_share, без id из exclude"""
+        if count < 0:
+            raise SampleError('Количество вопросов не может быть отрицательным')
+        if fake_share is not None and not 0 <= fake_share <= 1:
+            raise SampleError('Доля фейков — от 0 до 100 %')
+        if seed is None:
+            seed = random.randrange(SEED_LIMIT)
+        rng = random.Random(seed)
+        bank, index = self.snapshot()
+        exclude = set(exclude)
+        chosen = set()
+
+        if fake_share is None:
+            ids = _pick(rng, _Pool(index[True], index[False]), count, exclude, chosen)
+        else:
+            fakes_wanted = round(count * fake_share)
+            ids = _pick(rng, _Pool(index[True]), fakes_wanted, exclude, chosen)
+            ids += _pick(rng, _Pool(index[False]), count - fakes_wanted, exclude, chosen)
+            if len(ids) < count:
+                # Одного типа не хватило: добираем другим, чтобы урок был нужной длины
+                ids += _pick(rng, _Pool(index[True], index[False]), count - len(ids), exclude, chosen)
+        rng.shuffle(ids)
+        fakes = sum(1 for mid in ids if bank[mid].correct)
+        return Sample(ids, fakes, seed, count)
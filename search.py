@@ -0,0 +1,328 @@
+# ------------------------------------------------------------------
+# Полнотекстовый поиск по банку вопросов
+#
+# SQLite: таблица FTS5 message_fts с внешним содержимым (строки берутся
+# из таблицы message по rowid). Триггеры на вставку, изменение и удаление
+# сообщений обновляют индекс в той же транзакции — при правках из панели
+# управления, генераторе данных или импорте. Ранжирование bm25, текст
+# сообщения весит больше комментариев; фрагменты — snippet().
+#
+# PostgreSQL: tsvector по тому же выражению, что и индекс GIN,
+# ранжирование ts_rank_cd, фрагменты ts_headline.
+#
+# Без FTS5 (SQLite собран без модуля) поиск идёт подстрокой LIKE.
+#
+# Запрос пользователя разбирается на слова; ищутся сообщения, где есть
+# все слова, каждое — как начало слова («карт» находит «карты»).
+# ------------------------------------------------------------------
+import logging
+import re
+import threading
+import time
+import weakref
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import OperationalError
+
+from metrics import Histogram
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, encode_cursor
+
+log = logging.getLogger('fishchat.search')
+
+SEARCH_SECONDS = Histogram(
+    'fishchat_search_seconds',
+    'Длительность поиска по банку вопросов',
+    ['backend'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+
+# Не больше слов в запросе: длинные запросы не уточняют выдачу, а замедляют её
+MAX_TERMS = 8
+SNIPPET_TOKENS = 16
+# Границы совпадения во фрагменте: заменяются на <mark> после экранирования текста
+_START, _STOP = '\x02', '\x03'
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+# Вес колонок: текст сообщения, комментарий «да», комментарий «нет»
+FTS_WEIGHTS = (3.0, 1.0, 1.0)
+PG_CONFIG = 'russian'
+
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE message_fts USING fts5("
+    "text, comment_yes, comment_no, content='message', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER message_fts_ai AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts(rowid, text, comment_yes, comment_no) "
+    "VALUES (new.id, new.text, new.comment_yes, new.comment_no); END",
+    "CREATE TRIGGER message_fts_ad AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, text, comment_yes, comment_no) "
+    "VALUES ('delete', old.id, old.text, old.comment_yes, old.comment_no); END",
+    "CREATE TRIGGER message_fts_au AFTER UPDATE ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, text, comment_yes, comment_no) "
+    "VALUES ('delete', old.id, old.text, old.comment_yes, old.comment_no); "
+    "INSERT INTO message_fts(rowid, text, comment_yes, comment_no) "
+    "VALUES (new.id, new.text, new.comment_yes, new.comment_no); END",
+)
+FTS_OBJECTS = ('message_fts', 'message_fts_ai', 'message_fts_ad', 'message_fts_au')
+
+
+def _pg_vector(prefix='', collation=None):
+    """tsvector сообщения; запрос и индекс GIN используют одно и то же выражение
+
+    collation — правило сравнения для lower(), если база с локалью C
+    не переводит кириллицу в нижний регистр (тогда и to_tsvector её не меняет).
+    """
+    def lowered(expression):
+        return f'lower(({expression}) COLLATE "{collation}")' if collation else expression
+    comments = f"coalesce({prefix}comment_yes, '') || ' ' || coalesce({prefix}comment_no, '')"
+    return (f"(setweight(to_tsvector('{PG_CONFIG}', {lowered(prefix + 'text')}), 'A') || "
+            f"setweight(to_tsvector('{PG_CONFIG}', {lowered(comments)}), 'B'))")
+
+
+# Правила сравнения, которые могут понижать регистр кириллицы в базе с локалью C
+_PG_COLLATIONS = ('C.utf8', 'C.UTF-8', 'und-x-icu', 'ru_RU.utf8', 'en_US.utf8')
+
+
+def _pg_collation(conn):
+    """None, если lower() базы понижает регистр кириллицы, иначе подходящее правило сравнения"""
+    if conn.execute(text("SELECT lower('ЁЖ') = 'ёж'")).scalar():
+        return None
+    available = {row[0] for row in conn.execute(
+        text('SELECT collname FROM pg_collation WHERE collname IN :names').bindparams(
+            bindparam('names', list(_PG_COLLATIONS), expanding=True)))}
+    for name in _PG_COLLATIONS:
+        if name in available and conn.execute(text(f"SELECT lower('ЁЖ' COLLATE \"{name}\") = 'ёж'")).scalar():
+            return name
+    log.warning('No collation lowercases Cyrillic, question search is case-sensitive')
+    return None
+
+
+# Движки, для которых индекс уже проверен: {engine: backend}
+_backends = weakref.WeakKeyDictionary()
+# Правило сравнения для lower() в выражении индекса PostgreSQL: {engine: collation}
+_collations = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def ensure_index(engine):
+    """Создать индекс, если его нет, и вернуть способ поиска: fts5, tsvector или like"""
+    backend = _backends.get(engine)
+    if backend:
+        return backend
+    with _lock:
+        backend = _backends.get(engine)
+        if not backend:
+            backend = _create_index(engine)
+            _backends[engine] = backend
+    return backend
+
+
+def _create_index(engine):
+    started = time.perf_counter()
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            collation = _collations[engine] = _pg_collation(conn)
+            conn.execute(text('CREATE INDEX IF NOT EXISTS message_search_idx '
+                              f'ON message USING gin ({_pg_vector(collation=collation)})'))
+        return 'tsvector'
+    if engine.dialect.name != 'sqlite':
+        return 'like'
+
+    try:
+        with engine.begin() as conn:
+            names = {row[0] for row in conn.execute(
+                text("SELECT name FROM sqlite_master WHERE name LIKE 'message_fts%'"))}
+            if set(FTS_OBJECTS) <= names:
+                return 'fts5'
+            # Неполная схема (например, после пересоздания таблицы message) — строим заново
+            for name in ('message_fts_ai', 'message_fts_ad', 'message_fts_au'):
+                conn.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+            conn.execute(text('DROP TABLE IF EXISTS message_fts'))
+            for statement in FTS_SCHEMA:
+                conn.execute(text(statement))
+            conn.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+    except OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        log.warning('SQLite built without FTS5, question search falls back to LIKE')
+        return 'like'
+    log.info('message_fts index built in %.2fs', time.perf_counter() - started)
+    return 'fts5'
+
+
+def terms(query):
+    return [t.lower() for t in _WORD.findall(query or '')][:MAX_TERMS]
+
+
+def highlight(snippet):
+    """Фрагмент с границами совпадений -> безопасный HTML с <mark>"""
+    if snippet is None:
+        return None
+    return Markup(str(escape(snippet)).replace(_START, '<mark>').replace(_STOP, '</mark>'))
+
+
+def _like_snippet(value, words):
+    """Фрагмент вокруг первого совпадения для поиска без индекса"""
+    lowered = value.lower()
+    positions = [lowered.find(w) for w in words if lowered.find(w) >= 0]
+    if not positions:
+        return value[:120]
+    start = max(min(positions) - 40, 0)
+    fragment = value[start:start + 160]
+    for w in sorted(set(words), key=len, reverse=True):
+        fragment = re.sub(re.escape(w), lambda m: _START + m.group(0) + _STOP, fragment, flags=re.IGNORECASE)
+    return ('…' if start else '') + fragment + ('…' if start + 160 < len(value) else '')
+
+
+class SearchPage:
+    def __init__(self, items, next_cursor, backend, query, filters):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.backend = backend
+        self.query = query
+        self.filters = filters
+        # Фрагменты с подсветкой по id сообщения
+        self.snippets = {item.id: highlight(item.snippet) for item in items}
+
+
+def _filters(args):
+    """Условия фильтров (kind, id, only, exclude) для всех способов поиска"""
+    conditions, params, active = [], {}, {}
+    kind = args.get('kind')
+    if kind in ('fake', 'real'):
+        # Фейк — correct = True
+        conditions.append('m.correct = :correct')
+        params['correct'] = kind == 'fake'
+        active['kind'] = kind
+    if (args.get('id') or '').strip().isdigit():
+        conditions.append('m.id = :message_id')
+        params['message_id'] = int(args['id'])
+        active['id'] = args['id']
+    for name, op in (('only', 'IN'), ('exclude', 'NOT IN')):
+        value = args.get(name) or ''
+        ids = [int(v) for v in value.split(',') if v.strip().isdigit()]
+        if ids or (name == 'only' and value):
+            conditions.append(f'm.id {op} :{name}_ids')
+            params[f'{name}_ids'] = ids or [0]
+            active[name] = value
+    return conditions, params, active
+
+
+def search_messages(db_session, engine, args):
+    """Страница результатов поиска ?q=&cursor=&limit=&kind=&id=&only=&exclude="""
+    backend = ensure_index(engine)
+    words = terms(args.get('q'))
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+
+    conditions, params, active = _filters(args)
+    if not words:
+        return SearchPage([], None, backend, '', active)
+
+    # Курсор: [«search», запрос, оценка, id]; оценка — чем меньше, тем выше в выдаче
+    query_key = ' '.join(words)
+    cursor = decode_cursor(args.get('cursor') or '')
+    after = None
+    if cursor and cursor[0] == 'search' and cursor[1] == query_key:
+        after = (cursor[2], cursor[3])
+
+    started = time.perf_counter()
+    collation = _collations.get(engine)
+    statement = _statement(backend, words, conditions, params, after, collation)
+    params['limit'] = limit + 1
+    # Списки id (only/exclude) раскрываются в IN (...)
+    statement = statement.bindparams(*(
+        bindparam(name, value, expanding=isinstance(value, list)) for name, value in params.items()))
+    rows = db_session.execute(statement).all()
+    if backend == 'like' or collation:
+        # Фрагменты строятся здесь: ts_headline в базе с локалью C не находит слова с заглавной буквы
+        rows = [_LikeRow(row, words) for row in rows]
+    SEARCH_SECONDS.observe(time.perf_counter() - started, backend=backend)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor('search', query_key, last.score, last.id)
+    return SearchPage(rows, next_cursor, backend, query_key, active)
+
+
+class _LikeRow:
+    def __init__(self, row, words):
+        self.id, self.text, self.correct = row.id, row.text, row.correct
+        self.price_correct, self.price_wrong = row.price_correct, row.price_wrong
+        self.score = row.score
+        self.snippet = _like_snippet(row.text, words)
+
+
+_COLUMNS = 'm.id, m.text, m.correct, m.price_correct, m.price_wrong'
+
+
+def _statement(backend, words, conditions, params, after, collation=None):
+    """SQL страницы: строки упорядочены по (score, id), after — ключ последней строки"""
+    if backend == 'fts5':
+        params['match'] = ' '.join('"%s"*' % w for w in words)
+        weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+        where = ' AND '.join(['message_fts MATCH :match'] + conditions)
+        keyset = ''
+        if after:
+            keyset = 'WHERE score > :after_score OR (score = :after_score AND id > :after_id)'
+            params.update(after_score=after[0], after_id=after[1])
+        return text(
+            f'SELECT * FROM ('
+            f'SELECT {_COLUMNS}, bm25(message_fts, {weights}) AS score, '
+            f"snippet(message_fts, -1, '{_START}', '{_STOP}', '…', {SNIPPET_TOKENS}) AS snippet "
+            f'FROM message_fts JOIN message m ON m.id = message_fts.rowid WHERE {where}'
+            f') {keyset} ORDER BY score, id LIMIT :limit'
+        )
+
+    if backend == 'tsvector':
+        params['tsquery'] = ' & '.join(f'{w}:*' for w in words)
+        vector = _pg_vector('m.', collation)
+        score = f'-ts_rank_cd({vector}, q)'
+        where = [f'{vector} @@ q'] + conditions
+        if after:
+            where.append(f'({score} > :after_score OR ({score} = :after_score AND m.id > :after_id))')
+            params.update(after_score=after[0], after_id=after[1])
+        page = (f'SELECT {_COLUMNS}, {score} AS score '
+                f"FROM message m, to_tsquery('{PG_CONFIG}', :tsquery) q WHERE {' AND '.join(where)} "
+                f'ORDER BY score, m.id LIMIT :limit')
+        if collation:
+            return text(page)
+        # Фрагменты только для строк страницы: ts_headline заново разбирает весь текст
+        return text(
+            f"SELECT page.*, ts_headline('{PG_CONFIG}', page.text, q, "
+            f"'StartSel={_START}, StopSel={_STOP}, MaxWords=24, MinWords=10') AS snippet "
+            f'FROM ({page}) page, '
+            f"to_tsquery('{PG_CONFIG}', :tsquery) q ORDER BY page.score, page.id"
+        )
+
+    # Без индекса: все слова подстрокой (lower() SQLite меняет регистр только латиницы), порядок по id
+    where = list(conditions)
+    for i, w in enumerate(words):
+        where.append(f"lower(m.text || ' ' || coalesce(m.comment_yes, '') || ' ' || coalesce(m.comment_no, '')) "
+                     f'LIKE :word{i}')
+        params[f'word{i}'] = f'%{w}%'
+    if after:
+        where.append('m.id > :after_id')
+        params['after_id'] = after[1]
+    return text(f"SELECT {_COLUMNS}, 0 AS score FROM message m WHERE {' AND '.join(where)} "
+                f'ORDER BY m.id LIMIT :limit')
+
+
+def to_json(page):
+    return {
+        'items': [
+            {'id': item.id, 'text': item.text, 'correct': bool(item.correct),
+             'price_correct': item.price_correct, 'price_wrong': item.price_wrong,
+             'snippet': page.snippets.get(item.id)}
+            for item in page.items
+        ],
+        'next_cursor': page.next_cursor,
+        'query': page.query,
+        'filters': page.filters,
+        'backend': page.backend,
+    }
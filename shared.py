@@ -0,0 +1,336 @@
+# ------------------------------------------------------------------
+# Общее состояние узлов: сессии, кэши, счётчики лимитов, шина инвалидации
+#
+# SHARED_STATE_URL выбирает хранилище:
+#   local://             — в памяти процесса (один узел, тесты; по умолчанию)
+#   redis://host:6379/0  — сервер с протоколом Redis (Redis, Valkey, KeyDB)
+#
+# Кэши узла (NodeCache) живут в памяти процесса и очищаются на всех
+# узлах сразу через шину инвалидации (pub/sub хранилища).
+# ------------------------------------------------------------------
+import json
+import logging
+import secrets
+import threading
+import time
+import uuid
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer
+
+from admission import MAX_BUCKETS, TokenBucket
+from metrics import Counter
+
+log = logging.getLogger('fishchat.shared')
+
+CACHE_REQUESTS = Counter(
+    'fishchat_node_cache_total',
+    'Обращения к кэшам узла',
+    ['cache', 'result'],
+)
+INVALIDATIONS = Counter(
+    'fishchat_cache_invalidations_total',
+    'Инвалидации кэшей, полученные от других узлов',
+    ['cache'],
+)
+
+INVALIDATION_CHANNEL = 'fishchat:invalidate'
+
+# Ключи корзин лимитов без обращений удаляются через это время после заполнения
+_IDLE_BUCKET_TTL = 3600
+
+
+class LocalBackend:
+    """Хранилище в памяти процесса: замена Redis для одного узла и тестов"""
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._buckets = {}
+        self._subscribers = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+            # Просроченные ключи удаляются при записи, чтобы память не росла
+            if len(self._values) % 1024 == 0:
+                now = time.monotonic()
+                for k in [k for k, (_, exp) in self._values.items() if exp is not None and exp <= now]:
+                    del self._values[k]
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def take_token(self, key, rate_per_minute, burst):
+        """Списать токен из корзины key; вернуть 0 или секунды до следующего токена"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_BUCKETS:
+                    now = time.monotonic()
+                    for k in [k for k, b in self._buckets.items() if b.idle(now)]:
+                        del self._buckets[k]
+                bucket = self._buckets[key] = TokenBucket(rate_per_minute, burst)
+            else:
+                bucket.configure(rate_per_minute, burst)
+            return bucket.take()
+
+    def refund_token(self, key, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.refund()
+
+    def publish(self, channel, message):
+        for callback in list(self._subscribers.get(channel, ())):
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+
+class RedisBackend:
+    """Хранилище на сервере с протоколом Redis (пакет redis)"""
+    shared = True
+
+    # Корзина токенов атомарно на сервере; время берётся у сервера, а не у узлов
+    TAKE_TOKEN = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local rate = tonumber(ARGV[1]) / 60
+        local burst = tonumber(ARGV[2])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        elseif rate <= 0 then
+            wait = 60
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+        return tostring(wait)
+    """
+    REFUND_TOKEN = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+        if tokens then
+            redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+        end
+        return 1
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('Для SHARED_STATE_URL=redis://… установите пакет redis') from e
+        self.client = redis.Redis.from_url(url)
+        self._take_token = self.client.register_script(self.TAKE_TOKEN)
+        self._refund_token = self.client.register_script(self.REFUND_TOKEN)
+        self._pubsub = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def take_token(self, key, rate_per_minute, burst):
+        return float(self._take_token(keys=[key], args=[rate_per_minute, burst, _IDLE_BUCKET_TTL]))
+
+    def refund_token(self, key, burst):
+        self._refund_token(keys=[key], args=[burst])
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            if self._pubsub is None:
+                self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{channel: lambda m: callback(m['data'].decode())})
+            if self._thread is None:
+                # Пропущенные при обрыве связи сообщения покрывает ttl кэшей узла
+                self._thread = self._pubsub.run_in_thread(
+                    sleep_time=1.0, daemon=True, exception_handler=self._pubsub_error)
+
+    @staticmethod
+    def _pubsub_error(error, pubsub, thread):
+        # redis переподключается и восстанавливает подписку при следующем чтении
+        log.warning('pubsub error: %s', error)
+        time.sleep(1.0)
+
+
+def backend_from_url(url):
+    if not url or url.startswith('local://'):
+        return LocalBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f'Неизвестное хранилище общего состояния: {url}')
+
+
+# ------------------------------------------------------------------
+# Кэши узла и шина инвалидации
+# ------------------------------------------------------------------
+class InvalidationBus:
+    def __init__(self, backend):
+        self.backend = backend
+        self.node_id = uuid.uuid4().hex[:12]
+        self._handlers = {}
+        backend.subscribe(INVALIDATION_CHANNEL, self._receive)
+
+    def register(self, name, handler):
+        self._handlers.setdefault(name, []).append(handler)
+
+    def invalidate(self, name):
+        """Очистить кэш name на этом узле сразу, на остальных — через pub/sub"""
+        self._run_handlers(name)
+        self.backend.publish(INVALIDATION_CHANNEL, json.dumps({'cache': name, 'node': self.node_id}))
+
+    def _run_handlers(self, name):
+        for handler in self._handlers.get(name, ()):
+            handler()
+
+    def _receive(self, message):
+        try:
+            payload = json.loads(message)
+        except (TypeError, ValueError):
+            log.warning('invalid invalidation message: %r', message)
+            return
+        if payload.get('node') == self.node_id:
+            return
+        INVALIDATIONS.inc(cache=payload.get('cache'))
+        self._run_handlers(payload.get('cache'))
+
+
+class NodeCache:
+    """Значение, загружаемое loader и хранимое в памяти узла до инвалидации или ttl"""
+    def __init__(self, name, loader, ttl=300, bus=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.bus = bus
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at = None
+        self._generation = 0
+        if bus is not None:
+            bus.register(name, self.clear)
+
+    def get(self):
+        now = time.monotonic()
+        value, loaded_at, generation = self._value, self._loaded_at, self._generation
+        if loaded_at is not None and now - loaded_at < self.ttl:
+            CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            return value
+        CACHE_REQUESTS.inc(cache=self.name, result='miss')
+        value = self.loader()
+        with self._lock:
+            # Инвалидация во время загрузки: значение могло устареть, не сохраняем
+            if generation == self._generation:
+                self._value, self._loaded_at = value, now
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._value = None
+            self._loaded_at = None
+
+    def invalidate(self):
+        """Очистить кэш на всех узлах (или только здесь, если шины нет)"""
+        if self.bus is not None:
+            self.bus.invalidate(self.name)
+        else:
+            self.clear()
+
+
+# ------------------------------------------------------------------
+# Серверные сессии: в cookie только подписанный идентификатор
+# ------------------------------------------------------------------
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None, new=False):
+        super().__init__(initial)
+        self.sid = sid
+        self.new = new
+
+
+class SharedSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+    key_prefix = 'session:'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='fishchat-session')
+
+    def _ttl(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.backend.get(self.key_prefix + sid)
+                if data is not None:
+                    return ServerSession(self.serializer.loads(data), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not self.should_set_cookie(app, session):
+            return
+
+        self.backend.set(self.key_prefix + session.sid, self.serializer.dumps(dict(session)).encode(),
+                         ttl=self._ttl(app))
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
@@ -0,0 +1,400 @@
+# ------------------------------------------------------------------
+# Несколько школ на одной установке: у каждой своя база
+#
+# Школы описаны в TENANTS_FILE (по умолчанию tenants.json):
+#   {"school1": {"url": "sqlite:////srv/fishchat/tenants/school1.db",
+#                "hosts": ["school1.example.org"], "title": "Школа № 1"},
+#    "school2": {"url": "postgresql://fishchat:secret@db/fishchat",
+#                "schema": "school2"}}
+#
+# Школа запроса выбирается по имени хоста, иначе — по выбору при входе
+# (сохраняется в сессии). Без школы запросы идут в основную базу
+# (DATABASE_URL). Файл перечитывается при изменении, перезапуск не нужен.
+#
+#   python tenants.py add school1 --host school1.example.org --copy-messages
+#   python tenants.py list
+#   python tenants.py report --workers 8
+# ------------------------------------------------------------------
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from flask import g, has_app_context, request, session
+from flask_login import user_logged_in
+from sqlalchemy import create_engine, event, func, insert, select, text
+
+import search
+import storage
+from metrics import Counter
+
+log = logging.getLogger('fishchat.tenants')
+
+TENANT_REQUESTS = Counter(
+    'fishchat_tenant_requests_total',
+    'Запросы по школам',
+    ['tenant'],
+)
+
+BASE_DIR = Path(__file__).parent.resolve()
+DEFAULT_TENANTS_FILE = BASE_DIR.joinpath('tenants.json')
+DEFAULT_TENANTS_DIR = BASE_DIR.joinpath('tenants')
+
+TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+
+# Маршруты, на которых школа выбирается полем tenant формы
+LOGIN_ENDPOINTS = ('login', 'register')
+
+
+class TenantRegistry:
+    """Школы из файла настроек и их движки SQLAlchemy"""
+    def __init__(self, path, metadata=None):
+        self.path = Path(path)
+        self.metadata = metadata
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._tenants = {}
+        self._hosts = {}
+        self._engines = {}
+
+    def _reload(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            tenants = json.loads(self.path.read_text(encoding='utf-8')) if mtime else {}
+            for name in tenants:
+                if not TENANT_NAME.match(name):
+                    raise ValueError(f'{self.path}: недопустимое имя школы {name!r}')
+            self._tenants = tenants
+            self._hosts = {host.lower(): name for name, config in tenants.items()
+                           for host in config.get('hosts', ())}
+            # Движки школ с изменённым адресом или удалённых школ закрываются
+            for name, (config, engine) in list(self._engines.items()):
+                if tenants.get(name) != config:
+                    del self._engines[name]
+                    engine.dispose()
+            self._mtime = mtime
+            log.info('tenants: %s', ', '.join(tenants) or 'none')
+
+    def names(self):
+        self._reload()
+        return list(self._tenants)
+
+    def config(self, name):
+        self._reload()
+        return self._tenants.get(name)
+
+    def by_host(self, host):
+        self._reload()
+        return self._hosts.get(host.split(':', 1)[0].lower())
+
+    def engine(self, name):
+        self._reload()
+        entry = self._engines.get(name)
+        if entry is None:
+            config = self._tenants[name]
+            with self._lock:
+                entry = self._engines.get(name)
+                if entry is None:
+                    entry = self._engines[name] = (config, create_tenant_engine(config, self.metadata))
+        return entry[1]
+
+    def save(self, tenants):
+        """Записать настройки школ атомарно (для provisioning)"""
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(tenants, indent=2, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp, self.path)
+        self._mtime = None
+
+    def dispose(self):
+        with self._lock:
+            for _, engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+def create_tenant_engine(config, metadata=None):
+    url = storage.normalize_url(config['url'])
+    engine = create_engine(url, **storage.engine_options(url))
+    schema = config.get('schema')
+    if schema:
+        if engine.dialect.name != 'postgresql':
+            raise ValueError(f'schema поддерживается только для PostgreSQL: {url}')
+        quoted = engine.dialect.identifier_preparer.quote_identifier(schema)
+
+        @event.listens_for(engine, 'connect')
+        def _set_search_path(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET search_path TO {quoted}')
+            cursor.close()
+            dbapi_connection.commit()
+
+        with engine.begin() as conn:
+            conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS {quoted}'))
+    elif engine.dialect.name == 'sqlite' and engine.url.database:
+        Path(engine.url.database).parent.mkdir(parents=True, exist_ok=True)
+        storage.configure_sqlite(engine)
+    if metadata is not None:
+        # Как db.create_all() для основной базы: недостающие таблицы при первом подключении
+        metadata.create_all(engine)
+        storage.ensure_columns(engine, metadata)
+        storage.ensure_indexes(engine, metadata)
+        # Индекс поиска по банку вопросов и триггеры, поддерживающие его
+        search.ensure_index(engine)
+    return engine
+
+
+# ------------------------------------------------------------------
+# Школа текущего запроса
+# ------------------------------------------------------------------
+def current():
+    """Имя школы текущего запроса или None (основная база)"""
+    return g.get('tenant') if has_app_context() else None
+
+
+def key_prefix():
+    """Префикс ключей, общих для всех школ (лимиты, кэши)"""
+    name = current()
+    return f'{name}:' if name else ''
+
+
+def activate(registry, name):
+    """Направить запросы текущего контекста приложения в базу школы name"""
+    g.tenant = name
+    g.tenant_engine = registry.engine(name) if name else None
+
+
+class PerTenant:
+    """Отдельный объект factory(name) для каждой школы; атрибуты — объекта текущей школы"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def current(self):
+        name = current()
+        item = self._items.get(name)
+        if item is None:
+            with self._lock:
+                item = self._items.get(name)
+                if item is None:
+                    item = self._items[name] = self._factory(name)
+        return item
+
+    def __getattr__(self, attr):
+        return getattr(self.current(), attr)
+
+
+def init_app(app, db):
+    """Выбор базы школы для каждого запроса; вернуть TenantRegistry"""
+    registry = TenantRegistry(os.environ.get('TENANTS_FILE') or DEFAULT_TENANTS_FILE, db.metadata)
+    names = registry.names()
+    if names:
+        log.info('multi-tenant mode: %d schools', len(names))
+
+    @app.before_request
+    def _select_tenant():
+        if not registry.names() and 'tenant' not in session:
+            return
+        name = registry.by_host(request.host)
+        g.tenant_by_host = name is not None
+        if name is None:
+            if request.method == 'POST' and request.endpoint in LOGIN_ENDPOINTS:
+                name = request.form.get('tenant') or None
+            else:
+                name = session.get('tenant')
+        if name is not None and registry.config(name) is None:
+            name = None
+        # Вход выполнен в другой школе: id пользователя в этой базе ничего не значит
+        if session.get('tenant') != name and session.get('_user_id'):
+            session.clear()
+        activate(registry, name)
+        TENANT_REQUESTS.inc(tenant=name or 'default')
+
+    @user_logged_in.connect_via(app)
+    def _remember_tenant(sender, user, **extra):
+        if current():
+            session['tenant'] = current()
+        else:
+            session.pop('tenant', None)
+
+    @app.context_processor
+    def _tenant_choices():
+        if g.get('tenant_by_host'):
+            return {'tenant_choices': []}
+        return {'tenant_choices': [(name, registry.config(name).get('title') or name)
+                                   for name in registry.names()]}
+
+    return registry
+
+
+# ------------------------------------------------------------------
+# Администрирование: добавление школ и отчёты по всем школам
+# ------------------------------------------------------------------
+def fan_out(registry, func, workers=8, include_default=None):
+    """func(engine) для каждой школы параллельно: {имя: (результат, ошибка)}"""
+    targets = {name: None for name in registry.names()}
+    if include_default is not None:
+        targets = {'default': include_default, **targets}
+
+    def run(name):
+        started = time.perf_counter()
+        try:
+            engine = targets[name] or registry.engine(name)
+            result, error = func(engine), None
+        except Exception as e:
+            log.exception('tenant %s failed', name)
+            result, error = None, f'{type(e).__name__}: {e}'
+        return name, result, error, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return {name: (result, error, elapsed)
+                for name, result, error, elapsed in pool.map(run, targets)}
+
+
+def tenant_summary(engine):
+    """Сводка по базе школы для отчёта"""
+    from app import Message, Result, Testing, User
+
+    with engine.connect() as conn:
+        users = dict(conn.execute(select(User.privileges, func.count()).group_by(User.privileges)).all())
+        results, avg_score = conn.execute(select(func.count(), func.avg(Result.score))).one()
+        return {
+            'students': users.get(0, 0),
+            'teachers': users.get(1, 0),
+            'admins': users.get(2, 0),
+            'messages': conn.execute(select(func.count()).select_from(Message)).scalar(),
+            'testings_open': conn.execute(select(func.count()).where(Testing.status.is_(True))).scalar(),
+            'results': results,
+            'avg_score': round(float(avg_score), 2) if avg_score is not None else None,
+        }
+
+
+def provision(registry, name, url=None, schema=None, hosts=(), title=None, admin=None,
+              copy_messages_from=None):
+    if not TENANT_NAME.match(name):
+        sys.exit(f'Недопустимое имя школы: {name} (латиница в нижнем регистре, цифры, _ и -)')
+    tenants = {n: registry.config(n) for n in registry.names()}
+    if name in tenants:
+        sys.exit(f'Школа {name} уже есть в {registry.path}')
+    taken = {h for config in tenants.values() for h in config.get('hosts', ())}
+    if taken & set(hosts):
+        sys.exit(f'Хосты уже заняты: {", ".join(sorted(taken & set(hosts)))}')
+
+    config = {'url': url or f'sqlite:///{DEFAULT_TENANTS_DIR.joinpath(name + ".db")}'}
+    if schema:
+        config['schema'] = schema
+    if hosts:
+        config['hosts'] = list(hosts)
+    if title:
+        config['title'] = title
+
+    from app import Message, User
+
+    engine = create_tenant_engine(config, registry.metadata)
+    with engine.begin() as conn:
+        if conn.execute(select(func.count()).select_from(User)).scalar():
+            sys.exit(f'В базе {engine.url.render_as_string(hide_password=True)} уже есть пользователи')
+        if admin:
+            username, _, password = admin.partition(':')
+            user = User(username=username, privileges=2)
+            user.set_password(password)
+            conn.execute(insert(User), [{'username': user.username, 'password_hash': user.password_hash,
+                                         'privileges': user.privileges}])
+        if copy_messages_from is not None:
+            with copy_messages_from.connect() as src:
+                rows = [dict(row) for row in src.execute(select(Message.__table__)).mappings()]
+            if rows:
+                conn.execute(insert(Message), rows)
+                storage.reset_sequences(conn, [Message.__table__])
+            print(f'{name}: скопировано сообщений: {len(rows)}')
+    engine.dispose()
+
+    tenants[name] = config
+    registry.save(tenants)
+    print(f'{name}: {storage.normalize_url(config["url"])}'
+          + (f' schema={schema}' if schema else '') + (f' hosts={",".join(hosts)}' if hosts else ''))
+
+
+def print_report(report):
+    columns = ['students', 'teachers', 'messages', 'testings_open', 'results', 'avg_score']
+    print(f'{"tenant":<16}' + ''.join(f'{c:>15}' for c in columns) + f'{"ms":>10}')
+    totals = dict.fromkeys(columns[:-1], 0)
+    for name, (row, error, elapsed) in report.items():
+        if error:
+            print(f'{name:<16}ошибка: {error}')
+            continue
+        print(f'{name:<16}' + ''.join(f'{str(row[c]):>15}' for c in columns) + f'{elapsed * 1000:>10.0f}')
+        for c in totals:
+            totals[c] += row[c]
+    print(f'{"total":<16}' + ''.join(f'{totals[c]:>15}' for c in columns[:-1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Школы на одной установке')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='список школ')
+    add = commands.add_parser('add', help='создать базу школы и добавить её в TENANTS_FILE')
+    add.add_argument('name')
+    add.add_argument('--url', help='адрес базы (по умолчанию tenants/<name>.db)')
+    add.add_argument('--schema', help='схема PostgreSQL (несколько школ в одной базе)')
+    add.add_argument('--host', action='append', default=[], help='имя хоста школы (можно несколько)')
+    add.add_argument('--title', help='название школы на странице входа')
+    add.add_argument('--admin', help='создать администратора: логин:пароль')
+    add.add_argument('--copy-messages', action='store_true', help='скопировать банк вопросов из основной базы')
+    remove = commands.add_parser('remove', help='убрать школу из TENANTS_FILE (база не удаляется)')
+    remove.add_argument('name')
+    report = commands.add_parser('report', help='сводка по всем школам')
+    report.add_argument('--workers', type=int, default=8, help='школ, опрашиваемых параллельно')
+    report.add_argument('--include-default', action='store_true', help='включить основную базу')
+    report.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    from app import app, db, tenant_registry as registry
+
+    if args.command == 'list':
+        for name in registry.names():
+            config = registry.config(name)
+            url = storage.normalize_url(config['url'])
+            print(f'{name:<16}{config.get("title", ""):<24}{",".join(config.get("hosts", ())):<32}{url}'
+                  + (f' schema={config["schema"]}' if config.get('schema') else ''))
+    elif args.command == 'add':
+        with app.app_context():
+            main_engine = db.engine
+        provision(registry, args.name, url=args.url, schema=args.schema, hosts=args.host, title=args.title,
+                  admin=args.admin, copy_messages_from=main_engine if args.copy_messages else None)
+    elif args.command == 'remove':
+        tenants = {n: registry.config(n) for n in registry.names()}
+        if tenants.pop(args.name, None) is None:
+            sys.exit(f'Школы {args.name} нет в {registry.path}')
+        registry.save(tenants)
+    elif args.command == 'report':
+        with app.app_context():
+            main_engine = db.engine
+        started = time.perf_counter()
+        result = fan_out(registry, tenant_summary, workers=args.workers,
+                         include_default=main_engine if args.include_default else None)
+        if args.json:
+            print(json.dumps({name: row if not error else {'error': error}
+                              for name, (row, error, _) in result.items()}, ensure_ascii=False, indent=2))
+        else:
+            print_report(result)
+            print(f'{len(result)} баз за {time.perf_counter() - started:.2f} с')
+        return 1 if any(error for _, error, _ in result.values()) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+# ------------------------------------------------------------------
+# Общая настройка тестов
+#
+# Приложение читает DATABASE_URL и QUERY_BUDGET_STRICT при импорте,
+# поэтому они задаются здесь, до импорта app любым модулем тестов:
+# база — временный файл SQLite, бюджеты запросов — в строгом режиме.
+# ------------------------------------------------------------------
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+_DB_DIR = tempfile.mkdtemp(prefix='fishchat-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + str(Path(_DB_DIR, 'app.db'))
+os.environ['QUERY_BUDGET_STRICT'] = '1'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ['PROFILE_DIR'] = str(Path(_DB_DIR, 'profiles'))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """Отдельная база SQLite со схемой приложения: тесты не видят данных друг друга"""
+    from app import db
+    engine = create_engine('sqlite:///' + str(tmp_path / 'fishchat.db'))
+    db.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session(engine):
+    with Session(engine) as session:
+        yield session
@@ -0,0 +1,168 @@
+# ------------------------------------------------------------------
+# Контроль допуска: корзины токенов, предел параллельности, форма лимитов
+# ------------------------------------------------------------------
+import threading
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, InvalidLimit, TokenBucket, parse_limits
+
+
+def controller(**limits):
+    settings = dict(user_rate=60.0, user_burst=100, group_rate=60.0, group_burst=100,
+                    max_concurrency=1, max_queue=0, queue_timeout=1.0)
+    settings.update(limits)
+    return AdmissionController(**settings)
+
+
+def test_bucket_refill():
+    bucket = TokenBucket(rate_per_minute=60, burst=2)
+    now = bucket.updated
+    assert bucket.take(now) == 0
+    assert bucket.take(now) == 0
+    assert bucket.take(now) == pytest.approx(1.0)
+    # Через полсекунды накопилась половина токена
+    assert bucket.take(now + 0.5) == pytest.approx(0.5)
+    assert bucket.take(now + 1.0) == 0
+    # Корзина не наполняется сверх burst
+    assert bucket.idle(now + 100)
+    assert bucket.tokens == 2
+
+
+def test_bucket_clock_before_creation():
+    bucket = TokenBucket(rate_per_minute=60, burst=1)
+    assert bucket.take(bucket.updated - 0.01) == 0
+
+
+def test_bucket_zero_rate():
+    bucket = TokenBucket(rate_per_minute=0, burst=1)
+    now = bucket.updated
+    assert bucket.take(now) == 0
+    assert bucket.take(now + 3600) == 60.0
+
+
+def test_user_rate_limit():
+    admission = controller(user_rate=1.0, user_burst=2, max_concurrency=4)
+    for _ in range(2):
+        with admission.admit('u1'):
+            pass
+    with pytest.raises(AdmissionRejected) as rejected:
+        with admission.admit('u1'):
+            pass
+    assert rejected.value.reason == 'user_rate'
+    assert rejected.value.retry_after >= 1
+    # Лимит отдельный для каждого пользователя
+    with admission.admit('u2'):
+        pass
+
+
+def test_group_rate_refunds_user_token():
+    admission = controller(user_burst=5, group_rate=1.0, group_burst=1, max_concurrency=4)
+    with admission.admit('u1', ['g1']):
+        pass
+    with pytest.raises(AdmissionRejected) as rejected:
+        with admission.admit('u2', ['g1']):
+            pass
+    assert rejected.value.reason == 'group_rate'
+    assert admission._buckets[('user', 'u2')].tokens == pytest.approx(5, abs=0.01)
+
+
+def test_concurrency_cap_queue_full():
+    admission = controller(max_concurrency=1, max_queue=0)
+    with admission.admit('u1'):
+        assert admission.snapshot()['active'] == 1
+        with pytest.raises(AdmissionRejected) as rejected:
+            with admission.admit('u2'):
+                pass
+        assert rejected.value.reason == 'queue_full'
+    # Отказ очереди токены не расходует
+    assert admission._buckets[('user', 'u2')].tokens == pytest.approx(100, abs=0.01)
+    assert admission.snapshot()['active'] == 0
+
+
+def test_concurrency_cap_queue_timeout():
+    admission = controller(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+    with admission.admit('u1'):
+        with pytest.raises(AdmissionRejected) as rejected:
+            with admission.admit('u2'):
+                pass
+        assert rejected.value.reason == 'queue_timeout'
+    assert admission.snapshot()['waiting'] == 0
+
+
+def test_queued_request_admitted_after_release():
+    admission = controller(max_concurrency=1, max_queue=1, queue_timeout=5.0)
+    peak = []
+    entered = threading.Event()
+
+    def worker():
+        with admission.admit('u2'):
+            peak.append(admission.snapshot()['active'])
+
+    with admission.admit('u1'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        while admission.snapshot()['waiting'] == 0:
+            entered.wait(0.001)
+        assert peak == []
+    thread.join(5)
+    assert peak == [1]
+
+
+def test_update_raises_concurrency():
+    admission = controller(max_concurrency=1, max_queue=1, queue_timeout=5.0)
+    done = threading.Event()
+
+    def worker():
+        with admission.admit('u2'):
+            done.set()
+
+    with admission.admit('u1'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        while admission.snapshot()['waiting'] == 0:
+            done.wait(0.001)
+        admission.update(max_concurrency=2)
+        assert done.wait(5)
+    thread.join(5)
+
+
+def test_parse_limits_types():
+    assert parse_limits({'user_rate': '2.5', 'user_burst': '3'}) == {'user_rate': 2.5, 'user_burst': 3}
+    for bad in [{'user_burst': '2.5'}, {'user_rate': 'abc'}, {'max_queue': '-1'},
+                {'max_concurrency': '0'}, {'unknown': '1'}]:
+        with pytest.raises(InvalidLimit):
+            parse_limits(bad)
+
+
+def test_update_all_or_nothing():
+    admission = controller()
+    before = dict(admission.limits)
+    with pytest.raises(InvalidLimit):
+        admission.update(user_rate='10', user_burst='2.5')
+    assert admission.limits == before
+
+
+def test_console_limits_form():
+    from werkzeug.security import generate_password_hash
+    from app import app, admission, db, User
+
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.session.add(User(username='admin_limits', password_hash=generate_password_hash('x'), privileges=2))
+        db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['curent_user'] = 'admin_limits'
+
+    before = dict(admission.limits)
+    response = client.post('/cons/limits', data={'user_rate': '12', 'user_burst': '2.5'})
+    assert response.status_code == 302
+    assert admission.limits == before
+
+    response = client.post('/cons/limits', data={'user_rate': '12', 'user_burst': '5', 'max_queue': ''})
+    assert response.status_code == 302
+    assert admission.limits['user_rate'] == 12.0
+    assert admission.limits['user_burst'] == 5
+    assert admission.limits['max_queue'] == before['max_queue']
+    admission.update(**before)
@@ -0,0 +1,214 @@
+# ------------------------------------------------------------------
+# Архив результатов: перенос и возврат без потерь, перезапись сегментов,
+# удаление пользователя, виденные вопросы и пересчёт архивных баллов
+# ------------------------------------------------------------------
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import insert, select, update
+
+import archive
+import bitsets
+import rescoring
+from app import Lesson, Result, ResultLayout, ResultSegment, ResultSummary
+# Имя Testing pytest принял бы за класс тестов
+from app import Testing as ModelTesting
+
+results = Result.__table__
+summary = ResultSummary.__table__
+QUESTIONS = [1, 2, 3, 4, 5, 6]
+
+
+@pytest.fixture
+def layouts():
+    return bitsets.LayoutStore(ResultLayout.__table__)
+
+
+@pytest.fixture
+def store(engine, layouts):
+    return archive.ResultArchive(results, ResultSegment.__table__, summary, ModelTesting.__table__,
+                                 layouts, lambda: engine, cache_size=4)
+
+
+def add_results(session, layouts, testing_id, answers, first_id):
+    """Результаты тестирования: answers — [(пользователь, правильные, неправильные, маски?)]"""
+    rows = []
+    for result_id, (user_id, correct, wrong, masked) in enumerate(answers, first_id):
+        row = {'id': result_id, 'testing_id': testing_id, 'lesson_id': 1, 'user_id': user_id,
+               'score': len(correct) - len(wrong), 'correct_answers_id': correct, 'wrong_answers_id': wrong,
+               'layout_id': None, 'answers': None, 'created_at': datetime(2020, 1, result_id % 28 + 1, 12, 30)}
+        if masked:
+            row.update(correct_answers_id=[], wrong_answers_id=[],
+                       layout_id=layouts.ensure(session, QUESTIONS),
+                       answers=bitsets.pack(QUESTIONS, correct, wrong))
+        rows.append(row)
+    session.execute(insert(results), rows)
+
+
+@pytest.fixture
+def dataset(session, layouts):
+    session.execute(insert(Lesson.__table__).values(id=1, name='Урок 1', time=0, price_correct=1,
+                                                    price_wrong=-1, questions=QUESTIONS))
+    session.execute(insert(ModelTesting.__table__), [
+        {'id': testing_id, 'name': f'Тестирование {testing_id}', 'status': False, 'lesson_id': 1, 'group_id': [1]}
+        for testing_id in (1, 2)])
+    add_results(session, layouts, 1, [(10, [1, 2], [3], False), (11, [1], [2, 4], True),
+                                      (10, [1, 2, 3], [], True), (12, [5], [], False)], first_id=1)
+    add_results(session, layouts, 2, [(10, [6], [], False), (11, [], [6], True)], first_id=5)
+    session.commit()
+
+
+def working_rows(session, testing_id=None):
+    statement = select(results).order_by(results.c.id)
+    if testing_id is not None:
+        statement = statement.where(results.c.testing_id == testing_id)
+    return [dict(row) for row in session.execute(statement).mappings()]
+
+
+def summaries(session, testing_id):
+    return {row.user_id: row for row in session.execute(select(summary).where(summary.c.testing_id == testing_id))}
+
+
+def segment(session, testing_id):
+    g = ResultSegment.__table__.c
+    return session.execute(select(g.id, g.data).where(g.testing_id == testing_id)).first()
+
+
+@pytest.mark.usefixtures('dataset')
+def test_archive_restore_identical(session, store):
+    before = working_rows(session)
+    report = archive.ArchiveReport()
+    assert store.archive(session, [1, 2], report) == 6
+    session.commit()
+    assert working_rows(session) == []
+    assert (report.testings, report.results) == (2, 6)
+    assert report.stored_bytes < report.raw_bytes
+
+    assert store.testing_rows(session, 1) == before[:4]
+    assert [row['id'] for batch in store.segment_rows(session, user_id=11) for row in batch] == [2, 6]
+
+    assert store.restore_testing(session, 1) == 4
+    assert store.restore_testing(session, 2) == 2
+    session.commit()
+    assert working_rows(session) == before
+    assert session.execute(select(summary)).all() == []
+    assert store.restore_testing(session, 1) == 0
+
+
+@pytest.mark.usefixtures('dataset')
+def test_summary(session, store):
+    store.archive(session, [1], None)
+    session.commit()
+    totals = summaries(session, 1)
+    assert (totals[10].results, totals[10].score_sum, totals[10].score_min, totals[10].score_max) == (2, 4, 1, 3)
+    assert (totals[10].correct, totals[10].wrong, totals[10].seen) == (5, 1, [1, 2, 3])
+    assert (totals[11].score_sum, totals[11].seen) == (-1, [1, 2, 4])
+    assert totals[12].seen == [5]
+
+
+@pytest.mark.usefixtures('dataset')
+def test_run_candidates(session, store, monkeypatch):
+    monkeypatch.setattr(archive, 'BATCH', 3)
+    # Открытое тестирование не архивируется
+    session.execute(update(ModelTesting.__table__).where(ModelTesting.__table__.c.id == 2).values(status=True))
+    session.commit()
+    report = store.run(session, days=30)
+    assert (report.testings, report.results) == (1, 4)
+    assert [row['testing_id'] for row in working_rows(session)] == [2, 2]
+    with pytest.raises(archive.ArchiveError):
+        store.run(session, days=-1)
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rearchive_replaces_cached_segment(session, store, layouts):
+    store.archive(session, [1], None)
+    session.commit()
+    first = store.unpack(segment(session, 1))
+    assert len(first) == 4
+    # Тестирование снова открывали: новые результаты дописываются в сегмент
+    add_results(session, layouts, 1, [(13, [4, 5], [], False)], first_id=20)
+    store.archive(session, [1], None)
+    session.commit()
+    rows = store.unpack(segment(session, 1))
+    assert [row['id'] for row in rows] == [1, 2, 3, 4, 20]
+    assert summaries(session, 1)[13].seen == [4, 5]
+    assert summaries(session, 1)[10].results == 2
+
+
+@pytest.mark.usefixtures('dataset')
+def test_delete_user(session, store):
+    store.archive(session, [1, 2], None)
+    session.commit()
+    # Сегменты уже в кэше узла
+    assert {row['user_id'] for row in store.unpack(segment(session, 1))} == {10, 11, 12}
+    assert store.delete_user(session, 10) == 3
+    assert store.delete_user(session, 12) == 1
+    session.commit()
+    assert [row['user_id'] for row in store.unpack(segment(session, 1))] == [11]
+    assert [row['user_id'] for row in store.testing_rows(session, 2)] == [11]
+    assert set(summaries(session, 1)) == {11}
+    assert session.scalar(select(ResultSegment.results).where(ResultSegment.testing_id == 1)) == 1
+    assert [row['id'] for batch in store.segment_rows(session) for row in batch] == [2, 6]
+    # Удаление последнего участника удаляет сегмент
+    assert store.delete_user(session, 11) == 2
+    session.commit()
+    assert segment(session, 1) is None
+    assert store.testing_rows(session, 1) == []
+
+
+def test_cache_key_follows_data(store):
+    """Сегмент с тем же id, но другими данными не берётся из кэша"""
+    columns = ['id', 'testing_id', 'user_id']
+    old, _ = archive.encode(columns, [{'id': 1, 'testing_id': 1, 'user_id': 10}])
+    new, _ = archive.encode(columns, [{'id': 2, 'testing_id': 1, 'user_id': 11}])
+    first = store.unpack(SimpleNamespace(id=1, data=old))
+    second = store.unpack(SimpleNamespace(id=1, data=new))
+    assert [row['user_id'] for row in first] == [10]
+    assert [row['user_id'] for row in second] == [11]
+    assert store.unpack(None) == []
+
+
+@pytest.mark.usefixtures('dataset')
+def test_seen(session, store):
+    store.archive(session, [1, 2], None)
+    session.commit()
+    assert store.seen(session, [10]) == {1, 2, 3, 6}
+    assert store.seen(session, [11, 12]) == {1, 2, 4, 5, 6}
+    # Сводка, записанная до появления столбца seen: ответы берутся из сегмента
+    session.execute(update(summary).values(seen=None))
+    session.commit()
+    assert store.seen(session, [11, 12]) == {1, 2, 4, 5, 6}
+    assert store.seen(session, [404]) == set()
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rescore_archived(session, store, layouts, engine):
+    store.archive(session, [1], None)
+    session.commit()
+    rescorer = rescoring.Rescorer(results, Lesson.__table__, layouts, lambda: engine, archive=store)
+    session.execute(update(Lesson.__table__).values(price_correct=2, price_wrong=-3))
+    session.commit()
+    # Тестирование 2 в рабочей таблице, тестирование 1 — в архиве; балл результата 1 не меняется
+    assert rescorer.lesson_preview(session, 1, 2, -3) == (6, 5)
+    batches = []
+    report = rescorer.rescore_lesson(session, 1, on_batch=lambda s, changes: batches.append(changes))
+    assert report.checked == 6
+    assert sorted(report.changes) == [(2, 11, -1, -4), (3, 10, 3, 6), (4, 12, 1, 2), (5, 10, 1, 2), (6, 11, -1, -3)]
+    # Порция рабочей таблицы и сегмент архива
+    assert [sorted(changes) for changes in batches] == [[(5, 10, 1, 2), (6, 11, -1, -3)],
+                                                        [(2, 11, -1, -4), (3, 10, 3, 6), (4, 12, 1, 2)]]
+    rows = {row['id']: row for row in store.testing_rows(session, 1)}
+    assert {i: row['score'] for i, row in rows.items()} == {1: 1, 2: -4, 3: 6, 4: 2}
+    assert summaries(session, 1)[10].score_sum == 7
+    # Повторный пересчёт ничего не меняет
+    assert rescorer.rescore_lesson(session, 1).changed == 0
+
+    # Смена типа ответа сообщения 2: правильный ответ пользователя 10 становится неправильным
+    assert rescorer.message_preview(session, 2) == (1, 3)
+    report = rescorer.rescore_message(session, 2)
+    assert sorted(report.changes) == [(1, 10, 1, -4), (2, 11, -4, 1), (3, 10, 6, 1)]
+    rows = {row['id']: row for row in store.testing_rows(session, 1)}
+    assert (sorted(rows[1]['correct_answers_id']), sorted(rows[1]['wrong_answers_id'])) == ([1], [2, 3])
+    assert bitsets.unpack(QUESTIONS, rows[2]['answers']) == ([1, 2], [4])
+    assert (summaries(session, 1)[10].correct, summaries(session, 1)[10].wrong) == (3, 3)
@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------
+# Маски ответов (bitsets.py) с numpy и без него; перевод JSON <-> маски
+# ------------------------------------------------------------------
+import random
+
+import pytest
+from sqlalchemy import insert, select
+
+import bitsets
+import migrate_results
+from app import Lesson, Result, ResultLayout
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(bitsets, 'numpy', None)
+    return request.param
+
+
+def random_answers(rng, questions):
+    answered = rng.sample(questions, rng.randint(0, len(questions)))
+    split = rng.randint(0, len(answered))
+    return answered[:split], answered[split:]
+
+
+@pytest.mark.parametrize('count', [0, 1, 7, 8, 9, 30, 64, 65])
+def test_pack_unpack(count):
+    rng = random.Random(count)
+    questions = list(range(100, 100 + count))
+    rng.shuffle(questions)
+    for _ in range(20):
+        correct, wrong = random_answers(rng, questions)
+        blob = bitsets.pack(questions, correct, wrong)
+        assert len(blob) == 2 * bitsets.mask_size(count)
+        assert bitsets.unpack(questions, blob) == ([q for q in questions if q in correct],
+                                                   [q for q in questions if q in wrong])
+        assert bitsets.counts(blob) == (len(correct), len(wrong))
+
+
+def test_pack_errors():
+    with pytest.raises(bitsets.BitsetError):
+        bitsets.pack([1, 2], [3], [])
+    with pytest.raises(bitsets.BitsetError):
+        bitsets.unpack([1, 2, 3], b'\x00' * 4)
+
+
+def test_pack_repeated_question():
+    blob = bitsets.pack([5, 6, 5], [5], [])
+    assert bitsets.unpack([5, 6, 5], blob) == ([5], [])
+
+
+def test_flip():
+    questions = [1, 2, 3, 4]
+    blob = bitsets.pack(questions, [1, 2], [3])
+    flipped = bitsets.flip(questions, blob, 2)
+    assert bitsets.unpack(questions, flipped) == ([1], [2, 3])
+    assert bitsets.flip(questions, flipped, 2) == blob
+    assert bitsets.unpack(questions, bitsets.flip(questions, blob, 3)) == ([1, 2, 3], [])
+    # На вопрос 4 не отвечали, вопроса 9 нет в раскладке
+    assert bitsets.flip(questions, blob, 4) is None
+    assert bitsets.flip(questions, blob, 9) is None
+
+
+def test_totals(backend):
+    rng = random.Random(1)
+    blobs, expected = [], []
+    # Раскладки разной длины в одном вызове
+    for count in (3, 12, 12, 40, 0, 12):
+        questions = list(range(count))
+        correct, wrong = random_answers(rng, questions)
+        blobs.append(bitsets.pack(questions, correct, wrong))
+        expected.append((len(correct), len(wrong)))
+    correct, wrong = bitsets.totals(blobs)
+    assert list(zip(correct, wrong)) == expected
+    assert bitsets.totals([]) == ([], [])
+
+
+def test_matrices_and_question_totals(backend):
+    questions = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+    answers = [([10, 20], [90]), ([], []), ([90], [10, 50]), ([10, 20, 30], [40])]
+    blobs = [bitsets.pack(questions, correct, wrong) for correct, wrong in answers]
+    answered, correct = bitsets.matrices(blobs, len(questions))
+    assert [[bool(x) for x in row] for row in answered] == [
+        [q in c or q in w for q in questions] for c, w in answers]
+    assert [[bool(x) for x in row] for row in correct] == [[q in c for q in questions] for c, w in answers]
+    assert bitsets.question_totals(blobs, len(questions)) == (
+        [3, 2, 1, 1, 1, 0, 0, 0, 2], [2, 2, 1, 0, 0, 0, 0, 0, 1])
+    assert bitsets.question_totals([], len(questions)) == ([0] * 9, [0] * 9)
+    with pytest.raises(bitsets.BitsetError):
+        bitsets.matrices([b'\x00\x00'], len(questions))
+
+
+def test_layout_store(engine, session):
+    layouts = bitsets.LayoutStore(ResultLayout.__table__)
+    first = layouts.ensure(session, [3, 1, 2])
+    assert layouts.ensure(session, [3, 1, 2]) == first
+    second = layouts.ensure(session, [1, 2, 3])
+    assert second != first
+    session.commit()
+    fresh = bitsets.LayoutStore(ResultLayout.__table__)
+    fresh.preload(engine, [first, second, None])
+    assert fresh.questions(engine, first) == (3, 1, 2)
+    assert fresh.ensure(session, [1, 2, 3]) == second
+    with pytest.raises(bitsets.BitsetError):
+        fresh.questions(engine, 404)
+
+
+def test_migrate_results_round_trip(engine, session):
+    rng = random.Random(2)
+    questions = list(range(1, 21))
+    session.execute(insert(Lesson.__table__), [
+        {'id': 1, 'name': 'Урок 1', 'time': 0, 'questions': questions},
+        # Из урока 2 вопрос 30 потом убрали: он уходит в конец раскладки
+        {'id': 2, 'name': 'Урок 2', 'time': 0, 'questions': [21, 22]},
+    ])
+    rows = []
+    for result_id in range(1, 26):
+        correct, wrong = random_answers(rng, questions)
+        rows.append({'id': result_id, 'testing_id': 0, 'lesson_id': 1, 'user_id': result_id % 4,
+                     'score': len(correct) - len(wrong), 'correct_answers_id': correct, 'wrong_answers_id': wrong})
+    rows.append({'id': 26, 'testing_id': 0, 'lesson_id': 2, 'user_id': 1, 'score': 1,
+                 'correct_answers_id': [30, 21], 'wrong_answers_id': [22]})
+    rows.append({'id': 27, 'testing_id': 0, 'lesson_id': 404, 'user_id': 1, 'score': 0,
+                 'correct_answers_id': [], 'wrong_answers_id': []})
+    session.execute(insert(Result.__table__), rows)
+    session.commit()
+
+    def answers():
+        layouts = bitsets.LayoutStore(ResultLayout.__table__)
+        found = {}
+        for row in session.execute(select(Result.__table__).order_by(Result.id)):
+            if row.answers is None:
+                found[row.id] = (set(row.correct_answers_id), set(row.wrong_answers_id))
+            else:
+                assert row.correct_answers_id == [] and row.wrong_answers_id == []
+                correct, wrong = bitsets.unpack(layouts.questions(engine, row.layout_id), row.answers)
+                found[row.id] = (set(correct), set(wrong))
+        return found
+
+    before = answers()
+    assert before[26] == ({30, 21}, {22})
+    layouts = bitsets.LayoutStore(ResultLayout.__table__)
+    assert migrate_results.to_bitset(session, Result, Lesson, layouts, batch=10) == 27
+    assert session.scalar(select(Result.id).where(Result.answers.is_(None)).limit(1)) is None
+    assert answers() == before
+    # Повторный запуск ничего не переводит
+    assert migrate_results.to_bitset(session, Result, Lesson, layouts, batch=10) == 0
+
+    assert migrate_results.to_json(session, Result, layouts, engine, batch=10) == 27
+    assert session.scalar(select(Result.id).where(Result.answers.is_not(None)).limit(1)) is None
+    assert answers() == before
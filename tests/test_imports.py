@@ -0,0 +1,145 @@
+# ------------------------------------------------------------------
+# Импорт банка вопросов: форматы, сжатие, дубликаты и повреждённые файлы
+# ------------------------------------------------------------------
+import io
+import json
+
+import msgpack
+import pytest
+import zstandard
+from sqlalchemy import Boolean, Column, Float, Integer, MetaData, Table, Text, create_engine, func, select
+from sqlalchemy.orm import Session
+
+import imports
+from imports import ImportDataError
+
+metadata = MetaData()
+message = Table(
+    'message', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('text', Text, nullable=False),
+    Column('correct', Boolean, nullable=False),
+    Column('price_correct', Float),
+    Column('price_wrong', Float),
+    Column('comment_yes', Text),
+    Column('comment_no', Text),
+)
+
+RECORDS = [
+    {'text': 'Ваш аккаунт заблокирован, перейдите по ссылке', 'correct': True,
+     'price_correct': 1, 'price_wrong': -1, 'comment_yes': 'Фишинг', 'comment_no': None},
+    {'text': 'Урок переносится на среду', 'correct': False,
+     'price_correct': 1, 'price_wrong': -2, 'comment_yes': None, 'comment_no': 'Обычное письмо'},
+    {'text': 'Подтвердите пароль в течение часа', 'correct': True,
+     'price_correct': 2, 'price_wrong': -1, 'comment_yes': None, 'comment_no': None},
+]
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def run(session, data, fmt, compress=None):
+    return imports.import_messages(session, message, io.BytesIO(data), fmt, compress)
+
+
+def count(session):
+    return session.scalar(select(func.count()).select_from(message))
+
+
+def as_csv(records):
+    lines = ['text,correct,price_correct,price_wrong,comment_yes,comment_no']
+    for r in records:
+        lines.append(','.join('"{}"'.format(str(r[k] if r[k] is not None else '').replace('"', '""'))
+                              for k in ('text', 'correct', 'price_correct', 'price_wrong',
+                                        'comment_yes', 'comment_no')))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def as_jsonl(records):
+    return ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records).encode()
+
+
+def as_msgpack(records):
+    columns = list(records[0])
+    return msgpack.packb(columns) + b''.join(msgpack.packb([r[c] for c in columns]) for r in records)
+
+
+@pytest.mark.parametrize('fmt, encode', [('csv', as_csv), ('jsonl', as_jsonl), ('msgpack', as_msgpack)])
+@pytest.mark.parametrize('compress', [None, 'zstd'])
+def test_formats(session, fmt, encode, compress):
+    data = encode(RECORDS)
+    if compress:
+        data = zstandard.ZstdCompressor().compress(data)
+    report = run(session, data, fmt, compress)
+    assert (report.inserted, report.duplicates) == (3, 0)
+    rows = session.execute(select(message.c.text, message.c.correct, message.c.price_wrong,
+                                  message.c.comment_yes).order_by(message.c.id)).all()
+    assert rows == [(r['text'], r['correct'], r['price_wrong'], r['comment_yes']) for r in RECORDS]
+
+
+def test_zstd_several_frames(session):
+    compressor = zstandard.ZstdCompressor()
+    data = compressor.compress(as_jsonl(RECORDS[:1])) + compressor.compress(as_jsonl(RECORDS[1:]))
+    assert run(session, data, 'jsonl', 'zstd').inserted == 3
+
+
+def test_duplicates(session):
+    run(session, as_jsonl(RECORDS[:2]), 'jsonl')
+    # Совпадение с банком и повтор внутри файла; цена в ключ не входит
+    repeated = dict(RECORDS[0], price_correct=5)
+    report = run(session, as_jsonl([repeated, RECORDS[2], RECORDS[2]]), 'jsonl')
+    assert (report.inserted, report.duplicates) == (1, 2)
+    # Другой комментарий — уже другое сообщение
+    report = run(session, as_jsonl([dict(RECORDS[1], comment_no='Другой комментарий')]), 'jsonl')
+    assert (report.inserted, report.duplicates) == (1, 0)
+    assert count(session) == 4
+
+
+def test_batches(session, monkeypatch):
+    monkeypatch.setattr(imports, 'BATCH_ROWS', 2)
+    records = [dict(RECORDS[0], text=f'Сообщение {i}') for i in range(5)]
+    assert run(session, as_jsonl(records), 'jsonl').inserted == 5
+    assert count(session) == 5
+
+
+def test_parse_options():
+    assert imports.parse_options('bank.msgpack.zst') == ('msgpack', 'zstd')
+    assert imports.parse_options('bank.ndjson') == ('jsonl', None)
+    assert imports.parse_options('bank.bin', 'csv') == ('csv', None)
+    with pytest.raises(ImportDataError):
+        imports.parse_options('bank.xlsx')
+
+
+def corrupt(name):
+    """Повреждённые файлы: (формат, сжатие, данные)"""
+    zstd = zstandard.ZstdCompressor().compress(as_jsonl(RECORDS * 200))
+    packed = as_msgpack(RECORDS)
+    return {
+        'not_zstd': ('jsonl', 'zstd', as_jsonl(RECORDS)),
+        'zstd_truncated': ('jsonl', 'zstd', zstd[:len(zstd) // 2]),
+        'csv_huge_field': ('csv', None, b'text,correct\n"' + b'x' * 200000 + b'",true\n'),
+        'csv_no_text': ('csv', None, b'message,correct\nabc,true\n'),
+        'csv_not_utf8': ('csv', None, 'text,correct\nпривет,true\n'.encode('cp1251')),
+        'jsonl_broken': ('jsonl', None, as_jsonl(RECORDS) + b'{"text": \n'),
+        'jsonl_not_object': ('jsonl', None, b'[1, 2]\n'),
+        'msgpack_truncated': ('msgpack', None, packed[:-10]),
+        'msgpack_no_header': ('msgpack', None, msgpack.packb([1, 2])),
+        'bad_correct': ('jsonl', None, as_jsonl([dict(RECORDS[0], correct='может быть')])),
+        'empty_text': ('jsonl', None, as_jsonl([dict(RECORDS[0], text='  ')])),
+    }[name]
+
+
+@pytest.mark.parametrize('name', [
+    'not_zstd', 'zstd_truncated', 'csv_huge_field', 'csv_no_text', 'csv_not_utf8',
+    'jsonl_broken', 'jsonl_not_object', 'msgpack_truncated', 'msgpack_no_header',
+    'bad_correct', 'empty_text',
+])
+def test_corrupt_file(session, name):
+    fmt, compress, data = corrupt(name)
+    with pytest.raises(ImportDataError):
+        run(session, data, fmt, compress)
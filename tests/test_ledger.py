@@ -0,0 +1,138 @@
+# ------------------------------------------------------------------
+# Журнал опыта: итоги по событиям, перенос баллов, опыт при пересчёте
+# ------------------------------------------------------------------
+import pytest
+from sqlalchemy import delete, func, insert, select, update
+from werkzeug.security import generate_password_hash
+
+import ledger
+import rescoring
+from app import app, db, rescore_with_xp, rescorer, xp_ledger, Lesson, Result, User, XpEvent, XpTotal
+
+LESSON_ID = 9001
+
+
+def totals(session):
+    return dict(session.execute(select(XpTotal.user_id, XpTotal.total)).all())
+
+
+def test_record(session):
+    assert xp_ledger.record(session, [(1, 5, 'train', None), (2, 3, 'test', 10), (1, -2, 'rescore', 11)]) \
+        == {1: 3, 2: 3}
+    # Нулевые начисления не записываются
+    assert xp_ledger.record(session, [(2, 0, 'train', None)]) == {}
+    assert xp_ledger.record(session, [(2, 4, 'train', None)]) == {2: 7}
+    session.commit()
+    assert totals(session) == {1: 3, 2: 7}
+    assert session.execute(select(XpTotal.user_id, XpTotal.events).order_by(XpTotal.user_id)).all() == [(1, 2), (2, 2)]
+    assert session.scalar(select(func.count()).select_from(XpEvent)) == 4
+
+
+def test_record_unknown_source(session):
+    with pytest.raises(ledger.LedgerError):
+        xp_ledger.record(session, [(1, 5, 'train', None), (1, 1, 'bonus', None)])
+    assert session.scalar(select(func.count()).select_from(XpEvent)) == 0
+
+
+def test_backfill(session):
+    session.execute(insert(Result.__table__), [
+        {'testing_id': 0, 'lesson_id': 1, 'user_id': user_id, 'score': score,
+         'correct_answers_id': [], 'wrong_answers_id': []}
+        for user_id, score in [(1, 4), (1, 2), (2, -1), (3, 0)]])
+    assert xp_ledger.backfill(session, Result.__table__) == 2
+    assert totals(session) == {1: 6, 2: -1}
+    # Журнал уже не пуст — повторный перенос ничего не делает
+    assert xp_ledger.backfill(session, Result.__table__) == 0
+
+
+@pytest.fixture
+def lesson():
+    """Урок с результатами в базе приложения: rescore_with_xp работает с db.session"""
+    with app.app_context():
+        db.session.add_all([User(username=f'xp_user_{i}', password_hash=generate_password_hash('x'), privileges=0)
+                            for i in range(3)])
+        db.session.flush()
+        user_ids = [u.id for u in User.query.filter(User.username.like('xp_user_%')).order_by(User.id)]
+        db.session.execute(insert(Lesson.__table__).values(
+            id=LESSON_ID, name='Урок опыта', time=0, price_correct=1, price_wrong=-1, questions=[1, 2, 3, 4]))
+        answers = [([1, 2, 3], [4]), ([1], [2, 3]), ([], [1, 2, 3, 4]), ([1, 2, 3, 4], [])]
+        rows = [{'testing_id': 0, 'lesson_id': LESSON_ID, 'user_id': user_ids[i % 3],
+                 'score': len(correct) - len(wrong), 'correct_answers_id': correct, 'wrong_answers_id': wrong}
+                for i, (correct, wrong) in enumerate(answers)]
+        db.session.execute(insert(Result.__table__), rows)
+        # Опыт за прохождение — баллы результатов
+        xp_ledger.record(db.session, [(row['user_id'], row['score'], 'test', None) for row in rows])
+        db.session.commit()
+        yield user_ids
+
+        db.session.rollback()
+        db.session.execute(delete(Result.__table__).where(Result.lesson_id == LESSON_ID))
+        db.session.execute(delete(Lesson.__table__).where(Lesson.__table__.c.id == LESSON_ID))
+        for table in (XpEvent.__table__, XpTotal.__table__):
+            db.session.execute(delete(table).where(table.c.user_id.in_(user_ids)))
+        User.query.filter(User.id.in_(user_ids)).delete()
+        db.session.commit()
+
+
+def scores_match_xp(user_ids):
+    """Опыт каждого участника равен сумме баллов его результатов"""
+    scores = dict(db.session.execute(select(Result.user_id, func.sum(Result.score))
+                                     .where(Result.user_id.in_(user_ids)).group_by(Result.user_id)).all())
+    xp = dict(db.session.execute(select(XpTotal.user_id, XpTotal.total).where(XpTotal.user_id.in_(user_ids))).all())
+    events = dict(db.session.execute(select(XpEvent.user_id, func.sum(XpEvent.amount))
+                                     .where(XpEvent.user_id.in_(user_ids)).group_by(XpEvent.user_id)).all())
+    return scores == xp == events, scores
+
+
+def set_prices(price_correct, price_wrong):
+    db.session.execute(update(Lesson.__table__).where(Lesson.__table__.c.id == LESSON_ID)
+                       .values(price_correct=price_correct, price_wrong=price_wrong))
+    db.session.commit()
+
+
+def test_rescore_xp_deltas(lesson):
+    user_ids = lesson
+    assert scores_match_xp(user_ids) == (True, {user_ids[0]: 2 + 4, user_ids[1]: -1, user_ids[2]: -4})
+    set_prices(3, -2)
+    report = rescore_with_xp(rescorer.rescore_lesson, LESSON_ID)
+    # 3*3-2*1=7 и 3*4=12; 3-2*2=-1 (без изменений); -2*4=-8
+    assert report.changed == 3
+    assert scores_match_xp(user_ids) == (True, {user_ids[0]: 19, user_ids[1]: -1, user_ids[2]: -8})
+    rescore_events = db.session.execute(select(XpEvent.user_id, XpEvent.amount).where(
+        XpEvent.source == 'rescore', XpEvent.user_id.in_(user_ids))).all()
+    assert sorted(rescore_events) == sorted([(user_ids[0], 5), (user_ids[2], -4), (user_ids[0], 8)])
+    assert sorted(amount for _, amount in rescore_events) == sorted(new - old for _, _, old, new in report.changes)
+
+    # Вопрос 4 меняет тип ответа: +5, +5 и -5
+    report = rescore_with_xp(rescorer.rescore_message, 4)
+    assert report.changed == 3
+    assert scores_match_xp(user_ids) == (True, {user_ids[0]: 19, user_ids[1]: -1, user_ids[2]: -3})
+
+
+def test_rescore_xp_failed_batch(lesson, monkeypatch):
+    """Упавшая порция откатывается вместе со своим опытом, зафиксированные порции согласованы"""
+    user_ids = lesson
+    monkeypatch.setattr(rescoring, 'BATCH', 2)
+    calls = []
+    record = xp_ledger.record
+
+    def failing_record(db_session, entries):
+        calls.append(entries)
+        if len(calls) == 2:
+            raise RuntimeError('сбой базы')
+        return record(db_session, entries)
+
+    monkeypatch.setattr(xp_ledger, 'record', failing_record)
+    set_prices(2, -1)
+    with pytest.raises(RuntimeError):
+        rescore_with_xp(rescorer.rescore_lesson, LESSON_ID)
+    db.session.rollback()
+    assert scores_match_xp(user_ids)[0]
+    changed = db.session.scalar(select(func.count()).select_from(XpEvent).where(
+        XpEvent.source == 'rescore', XpEvent.user_id.in_(user_ids)))
+    assert changed == 2
+
+    # Повторный пересчёт доводит оставшийся результат
+    monkeypatch.setattr(xp_ledger, 'record', record)
+    assert rescore_with_xp(rescorer.rescore_lesson, LESSON_ID).changed == 1
+    assert scores_match_xp(user_ids)[0]
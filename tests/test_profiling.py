@@ -0,0 +1,52 @@
+# ------------------------------------------------------------------
+# Профилирование по ?_profile=1: один профиль на процесс
+# ------------------------------------------------------------------
+import cProfile
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import profiling
+import querylog
+from app import app, db, User
+
+
+@pytest.fixture(scope='module')
+def client():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.session.add(User(username='admin_profiling', password_hash=generate_password_hash('x'),
+                            privileges=2))
+        db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['curent_user'] = 'admin_profiling'
+    return client
+
+
+def test_profile_saved(client):
+    response = client.get('/cons/limits?_profile=1')
+    assert response.status_code == 200
+    assert 'X-Profile-Id' in response.headers
+    assert not profiling._busy.locked()
+
+
+def test_busy_profiler_skips(client):
+    with profiling._busy:
+        response = client.get('/cons/limits?_profile=1')
+    assert response.status_code == 200
+    assert 'X-Profile-Id' not in response.headers
+
+
+def test_foreign_profiler_skips(client):
+    foreign = cProfile.Profile()
+    foreign.enable()
+    try:
+        response = client.get('/cons/limits?_profile=1')
+    finally:
+        foreign.disable()
+    assert response.status_code == 200
+    assert 'X-Profile-Id' not in response.headers
+    assert not profiling._busy.locked()
+    # Запись SQL-запросов профиля не осталась открытой
+    assert querylog._active() == []
@@ -0,0 +1,151 @@
+# ------------------------------------------------------------------
+# Бюджеты SQL-запросов маршрутов (@query_budget) в строгом режиме
+#
+#   python -m pytest tests
+#
+# DATABASE_URL и строгий режим задаёт conftest.py. Превышение бюджета
+# в строгом режиме — исключение QueryBudgetExceeded из after_request,
+# тестовый клиент Flask пробрасывает его в тест.
+# ------------------------------------------------------------------
+import pytest
+from flask import Response, stream_with_context
+from sqlalchemy import insert, text
+from werkzeug.security import generate_password_hash
+
+from app import app, db, results_archive, Group, Lesson, Message, Result, User
+# Имя Testing pytest принял бы за класс тестов
+from app import Testing as ModelTesting
+from querylog import QueryBudgetExceeded, query_budget
+
+MESSAGES = 20
+STUDENTS = ['student_1', 'student_2', 'student_3']
+TESTING_ID = 1
+GROUP_ID = 1
+
+
+# Маршрут сверх бюджета; регистрируется до первого запроса к приложению
+@app.route('/_tests/over_budget')
+@query_budget(1)
+def _over_budget():
+    for _ in range(3):
+        db.session.execute(text('SELECT 1'))
+    return 'ok'
+
+
+# То же в потоковом ответе: запросы выполняются при чтении тела
+@app.route('/_tests/over_budget_stream')
+@query_budget(1)
+def _over_budget_stream():
+    def rows():
+        for _ in range(3):
+            yield str(db.session.execute(text('SELECT 1')).scalar())
+    return Response(stream_with_context(rows()))
+
+
+@pytest.fixture(scope='module', autouse=True)
+def dataset():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.session.execute(insert(Message.__table__), [
+            {'id': i, 'text': f'Сообщение {i}: перейдите по ссылке', 'correct': i % 2 == 0,
+             'price_correct': 1.0, 'price_wrong': -1.0, 'comment_yes': 'Верно', 'comment_no': 'Неверно'}
+            for i in range(1, MESSAGES + 1)])
+        password_hash = generate_password_hash('password')
+        db.session.execute(insert(User.__table__), [
+            {'username': name, 'password_hash': password_hash, 'privileges': privileges}
+            for name, privileges in [('admin_tests', 2)] + [(name, 0) for name in STUDENTS]])
+        student_ids = [user.id for user in User.query.filter(User.username.in_(STUDENTS))]
+        questions = list(range(1, 11))
+        db.session.execute(insert(Group.__table__), [
+            {'id': GROUP_ID, 'groupname': 'Класс 1', 'users': student_ids}])
+        db.session.execute(insert(Lesson.__table__), [
+            {'id': 1, 'name': 'Урок 1', 'time': 0, 'price_correct': 1, 'price_wrong': -1,
+             'questions': questions}])
+        db.session.execute(insert(ModelTesting.__table__), [
+            {'id': TESTING_ID, 'name': 'Тестирование 1', 'status': True, 'lesson_id': 1,
+             'group_id': [GROUP_ID]}])
+        db.session.execute(insert(Result.__table__), [
+            {'testing_id': TESTING_ID, 'lesson_id': 1, 'user_id': user_id, 'score': 4,
+             'correct_answers_id': questions[:7], 'wrong_answers_id': questions[7:]}
+            for user_id in student_ids[:2]])
+        db.session.commit()
+    yield
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def login(client, username):
+    with client.session_transaction() as s:
+        s.clear()
+        s['curent_user'] = username
+
+
+def get(client, url, **kwargs):
+    """Запрос с чтением всего тела: потоковые выгрузки выполняют запросы при чтении"""
+    response = client.get(url, **kwargs)
+    response.get_data()
+    assert response.status_code < 400, f'{url}: HTTP {response.status_code}'
+    return response
+
+
+def test_over_budget_raises(client):
+    with pytest.raises(QueryBudgetExceeded):
+        client.get('/_tests/over_budget')
+
+
+def test_over_budget_stream_raises(client):
+    with pytest.raises(QueryBudgetExceeded):
+        client.get('/_tests/over_budget_stream').get_data()
+
+
+def test_train(client):
+    login(client, STUDENTS[0])
+    get(client, '/train/0')
+    get(client, '/train/1')
+
+
+def test_test_room(client):
+    login(client, STUDENTS[2])
+    get(client, '/test_room_preview')
+    get(client, f'/test_room/{TESTING_ID}/0')
+    get(client, f'/test_room/{TESTING_ID}/1')
+    response = client.post(f'/test_room/{TESTING_ID}/1', data={'action': 'finish'})
+    assert response.status_code < 400
+
+
+@pytest.mark.parametrize('url', [
+    f'/dashboard/testing_management/results_detailed/{TESTING_ID}',
+    f'/dashboard/testing_management/group_results/{TESTING_ID}/{GROUP_ID}',
+    f'/dashboard/testing_management/testing_report/{TESTING_ID}',
+    '/dashboard/lists/students',
+    '/dashboard/lists/testings',
+    '/dashboard/search/messages?q=ссылке',
+    '/cons/export/users_csv',
+    '/cons/export/results?format=jsonl',
+])
+def test_result_pages(client, url):
+    login(client, 'admin_tests')
+    get(client, url)
+
+
+def test_export_archived_results(client):
+    with app.app_context():
+        count = Result.query.count()
+        results_archive.archive(db.session, [TESTING_ID])
+        db.session.commit()
+    try:
+        login(client, 'admin_tests')
+        response = get(client, '/cons/export/results?format=jsonl')
+        assert len(response.get_data().splitlines()) == count
+    finally:
+        with app.app_context():
+            results_archive.restore_testing(db.session, TESTING_ID)
+            db.session.commit()
+
+
+def test_history_list(client):
+    login(client, STUDENTS[0])
+    get(client, '/dashboard/lists/history')
@@ -0,0 +1,117 @@
+# ------------------------------------------------------------------
+# Пересчёт баллов: цены урока и тип ответа сообщения, списки и маски
+# ------------------------------------------------------------------
+import pytest
+from sqlalchemy import insert, select, update
+
+import bitsets
+import rescoring
+from app import Lesson, Result, ResultLayout
+
+results = Result.__table__
+QUESTIONS = [1, 2, 3, 4, 5]
+
+
+@pytest.fixture
+def rescorer(engine):
+    layouts = bitsets.LayoutStore(ResultLayout.__table__)
+    return rescoring.Rescorer(results, Lesson.__table__, layouts, lambda: engine)
+
+
+def add_lesson(session, lesson_id, questions, price_correct=1, price_wrong=-1):
+    session.execute(insert(Lesson.__table__).values(id=lesson_id, name=f'Урок {lesson_id}', time=0,
+                                                    price_correct=price_correct, price_wrong=price_wrong,
+                                                    questions=questions))
+
+
+def add_result(session, rescorer, result_id, lesson_id, user_id, correct, wrong, masked=False,
+               prices=(1, -1), questions=QUESTIONS):
+    values = {'id': result_id, 'testing_id': 0, 'lesson_id': lesson_id, 'user_id': user_id,
+              'score': prices[0] * len(correct) + prices[1] * len(wrong),
+              'correct_answers_id': correct, 'wrong_answers_id': wrong}
+    if masked:
+        values.update(correct_answers_id=[], wrong_answers_id=[],
+                      layout_id=rescorer.layouts.ensure(session, questions),
+                      answers=bitsets.pack(questions, correct, wrong))
+    session.execute(insert(results).values(**values))
+
+
+def answers(session, rescorer, result_id):
+    """(score, правильные, неправильные) результата в любом формате"""
+    row = session.execute(select(results).where(results.c.id == result_id)).one()
+    if row.answers is None:
+        return row.score, sorted(row.correct_answers_id), sorted(row.wrong_answers_id)
+    correct, wrong = bitsets.unpack(rescorer.layouts.questions(rescorer.engine(), row.layout_id), row.answers)
+    return row.score, sorted(correct), sorted(wrong)
+
+
+@pytest.fixture
+def dataset(session, rescorer):
+    add_lesson(session, 1, QUESTIONS)
+    add_lesson(session, 2, [6, 7])
+    add_result(session, rescorer, 1, 1, 10, [1, 2, 3], [4])
+    add_result(session, rescorer, 2, 1, 11, [1, 2, 3], [4], masked=True)
+    add_result(session, rescorer, 3, 1, 12, [1], [2, 3, 4, 5], masked=True)
+    add_result(session, rescorer, 4, 1, 13, [4, 5], [])
+    add_result(session, rescorer, 5, 2, 10, [6], [7])
+    session.commit()
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rescore_lesson(session, rescorer):
+    session.execute(update(Lesson.__table__).where(Lesson.__table__.c.id == 1)
+                    .values(price_correct=2, price_wrong=-3))
+    session.commit()
+    assert rescorer.lesson_preview(session, 1, 2, -3) == (4, 4)
+
+    report = rescorer.rescore_lesson(session, 1)
+    assert (report.checked, report.changed) == (4, 4)
+    assert sorted(report.changes) == [(1, 10, 2, 3), (2, 11, 2, 3), (3, 12, -3, -10), (4, 13, 2, 4)]
+    assert [answers(session, rescorer, i)[0] for i in (1, 2, 3, 4, 5)] == [3, 3, -10, 4, 0]
+    # Повторный пересчёт ничего не меняет
+    assert rescorer.rescore_lesson(session, 1).changed == 0
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rescore_lesson_batches(session, rescorer, monkeypatch):
+    monkeypatch.setattr(rescoring, 'BATCH', 1)
+    session.execute(update(Lesson.__table__).where(Lesson.__table__.c.id == 1).values(price_correct=2))
+    session.commit()
+    batches = []
+    report = rescorer.rescore_lesson(session, 1, on_batch=lambda s, changes: batches.append(changes))
+    assert report.changed == 4
+    assert [len(changes) for changes in batches] == [1, 1, 1, 1]
+
+
+def test_rescore_missing_lesson(session, rescorer):
+    report = rescorer.rescore_lesson(session, 404)
+    assert (report.lessons, report.changed) == (0, 0)
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rescore_message(session, rescorer):
+    assert rescorer.message_preview(session, 3) == (1, 3)
+    report = rescorer.rescore_message(session, 3)
+    assert report.lessons == 1
+    assert sorted(report.changes) == [(1, 10, 2, 0), (2, 11, 2, 0), (3, 12, -3, -1)]
+    assert answers(session, rescorer, 1) == (0, [1, 2], [3, 4])
+    assert answers(session, rescorer, 2) == (0, [1, 2], [3, 4])
+    assert answers(session, rescorer, 3) == (-1, [1, 3], [2, 4, 5])
+    # Без ответа на сообщение и из другого урока — без изменений
+    assert answers(session, rescorer, 4) == (2, [4, 5], [])
+    assert answers(session, rescorer, 5) == (0, [6], [7])
+
+    # Обратная смена типа ответа возвращает исходные баллы
+    report = rescorer.rescore_message(session, 3)
+    assert sorted(report.changes) == [(1, 10, 0, 2), (2, 11, 0, 2), (3, 12, -1, -3)]
+    assert answers(session, rescorer, 3) == (-3, [1], [2, 3, 4, 5])
+
+
+@pytest.mark.usefixtures('dataset')
+def test_rescore_message_lesson_prices(session, rescorer):
+    session.execute(update(Lesson.__table__).where(Lesson.__table__.c.id == 2)
+                    .values(price_correct=5, price_wrong=-2))
+    session.commit()
+    report = rescorer.rescore_message(session, 7)
+    assert report.changes == [(5, 10, 0, 10)]
+    assert answers(session, rescorer, 5) == (10, [6, 7], [])